@@ -0,0 +1 @@
+"""Офлайн-бенчмарки команд бота на заглушках Discord (запуск: python -m bench)"""
@@ -0,0 +1,294 @@
+"""Запуск офлайн-бенчмарков.
+
+Примеры:
+    python -m bench                          # сценарий smoke
+    python -m bench -s large -s voice-peak   # несколько сценариев
+    python -m bench --save-baseline          # сохранить результаты как эталон
+    python -m bench --latency-ms 30 --ratelimit 0.02
+
+Реальные методы когов вызываются на заглушках серверов, участников и REST,
+поэтому подключение к Discord не нужно. Бот импортируется во временном
+каталоге, чтобы не трогать рабочие файлы данных.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "bench", "baseline.json")
+
+SCENARIOS = {
+    "smoke": dict(guilds=10, members_per_guild=200, friends=200, voice_events=1000, repeat=5),
+    "large": dict(guilds=200, members_per_guild=300, friends=10_000, voice_events=2000, repeat=3),
+    "voice-peak": dict(guilds=50, members_per_guild=200, friends=100, voice_events=5000, repeat=3),
+    "ratelimited": dict(guilds=10, members_per_guild=200, friends=300, voice_events=500, repeat=3,
+                        latency_ms=20, ratelimit=0.02),
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def import_bot(workdir: str):
+    """Импортировать bot.py так, чтобы файлы данных создавались во временном каталоге"""
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    os.chdir(workdir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import bot
+    return bot
+
+
+class BenchRunner:
+    def __init__(self, bot_module, args):
+        self.bot_module = bot_module
+        self.args = args
+
+    def install(self, world) -> None:
+        """Подменить состояние бота заглушками сценария"""
+        bot_module = self.bot_module
+        bot_module.bot._connection._guilds = {guild.id: guild for guild in world.guilds}
+        bot_module.bot.fetch_user = world.fetch_user
+        bot_module.presence_index.build(world.guilds)
+        bot_module.friend_graph.remove_user(world.caller.id)
+        for friend_id in world.friend_ids:
+            bot_module.friend_graph.add(world.caller.id, friend_id)
+
+    def reset_caches(self) -> None:
+        # Каждый прогон - новая рассылка, а не повтор в окне объединения /callvoice
+        self.bot_module.call_throttle.reset()
+        if not self.args.warm:
+            self.bot_module.user_resolver._cache.clear()
+
+    async def measure(self, name: str, http, repeat: int, run: Callable) -> Dict[str, float]:
+        """Выполнить run() repeat раз и собрать задержки, REST-вызовы и 429"""
+        latencies = []
+        rest_calls = []
+        ratelimited = 0
+        for _ in range(repeat):
+            self.reset_caches()
+            http.reset()
+            started = time.perf_counter()
+            await run()
+            latencies.append(time.perf_counter() - started)
+            rest_calls.append(http.total_calls)
+            ratelimited += sum(http.ratelimited.values())
+
+        # Отдельный прогон под tracemalloc, чтобы не искажать задержки
+        self.reset_caches()
+        tracemalloc.start()
+        await run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "mean_ms": statistics.fmean(latencies) * 1000,
+            "rest_calls": statistics.fmean(rest_calls),
+            "ratelimited": ratelimited / repeat,
+            "peak_alloc_kib": peak / 1024,
+        }
+
+    def load_voice_history(self, world, users: int) -> None:
+        """Заполнить статистику войса случайными минутами за последний год"""
+        from voicestats import BLOCK_DAYS, GUILD_SERIES, USER_SERIES, series_key
+
+        voice_stats = self.bot_module.voice_stats
+        today = voice_stats.day()
+        blocks = range((today - 365) // BLOCK_DAYS, today // BLOCK_DAYS + 1)
+        user_block = b"".join(world.random.randrange(0, 120).to_bytes(2, "little") for _ in range(BLOCK_DAYS))
+        guild_block = b"".join(world.random.randrange(0, 20000).to_bytes(4, "little") for _ in range(BLOCK_DAYS))
+        rows = [(series_key(GUILD_SERIES, guild.id), block, guild_block) for guild in world.guilds for block in blocks]
+        user_ids = [world.caller.id] + [member.id for member in world.members[:users]]
+        rows.extend((series_key(USER_SERIES, user_id), block, user_block) for user_id in user_ids for block in blocks)
+        voice_stats.load(rows)
+
+    async def run_scenario(self, name: str, params: dict) -> Dict[str, Dict[str, float]]:
+        from bench.fakes import FakeHTTP, FakeVoiceState, FakeWorld
+
+        http = FakeHTTP(
+            latency=params.get("latency_ms", 0) / 1000,
+            ratelimit_ratio=params.get("ratelimit", 0.0),
+        )
+        world = FakeWorld(http, params["guilds"], params["members_per_guild"], params["friends"])
+        self.install(world)
+
+        bot_module = self.bot_module
+        friends = bot_module.bot.get_cog("FriendCommands")
+        repeat = params["repeat"]
+        results = {}
+
+        # /callvoice только ставит рассылку в очередь - замеряем вместе с ее отправкой и повторами после 429
+        async def callvoice_online():
+            await friends.callvoice.callback(friends, world.interaction("callvoice"), режим="Онлайн")
+            await bot_module.notification_outbox.drain(retries=True)
+
+        async def callvoice_all():
+            await friends.callvoice.callback(friends, world.interaction("callvoice"), режим="Все")
+            await bot_module.notification_outbox.drain(retries=True)
+
+        async def whoisplaying():
+            await friends.whoisplaying.callback(friends, world.interaction("whoisplaying"))
+
+        async def friendlist():
+            await friends.friendlist.callback(friends, world.interaction("friendlist"))
+
+        for label, run in (
+            ("callvoice[Онлайн]", callvoice_online),
+            ("callvoice[Все]", callvoice_all),
+            ("whoisplaying", whoisplaying),
+            ("friendlist", friendlist),
+        ):
+            results[label] = await self.measure(label, http, repeat, run)
+
+        # /voicestats по году истории для всех друзей и серверов сценария
+        self.load_voice_history(world, params["friends"])
+        scores = bot_module.bot.get_cog("ScoreCommands")
+
+        async def voicestats():
+            await scores.voicestats.callback(scores, world.interaction("voicestats"), участник=None)
+
+        results["voicestats"] = await self.measure("voicestats", http, repeat, voicestats)
+
+        # Поток событий голосовых каналов: вход, переход и выход участников
+        voice_members = world.members[:max(params["voice_events"] // 3, 1)]
+        per_event = []
+
+        async def voice_events():
+            per_event.clear()
+            for index in range(params["voice_events"]):
+                member = voice_members[index % len(voice_members)]
+                channels = member.guild.voice_channels
+                phase = (index // len(voice_members)) % 3
+                if phase == 0:
+                    before, after = FakeVoiceState(None), FakeVoiceState(channels[0])
+                elif phase == 1:
+                    before, after = FakeVoiceState(channels[0]), FakeVoiceState(channels[1])
+                else:
+                    before, after = FakeVoiceState(channels[1]), FakeVoiceState(None)
+                member.voice = after if after.channel else None
+                started = time.perf_counter()
+                await bot_module.on_voice_state_update(member, before, after)
+                per_event.append(time.perf_counter() - started)
+
+        result = await self.measure("on_voice_state_update", http, repeat, voice_events)
+        # Для потока событий интереснее задержка одного события
+        result["event_p50_us"] = percentile(per_event, 0.5) * 1e6
+        result["event_p99_us"] = percentile(per_event, 0.99) * 1e6
+        result["events_per_sec"] = params["voice_events"] / (result["mean_ms"] / 1000) if result["mean_ms"] else 0.0
+        results[f"on_voice_state_update x{params['voice_events']}"] = result
+        return results
+
+
+def print_report(name: str, params: dict, results: Dict[str, Dict[str, float]], out) -> None:
+    print(f"\n=== {name}: {params} ===", file=out)
+    print(f"{'бенчмарк':<36}{'p50, мс':>10}{'p99, мс':>10}{'REST':>9}{'429':>7}{'пик, КиБ':>11}", file=out)
+    for label, r in results.items():
+        print(
+            f"{label:<36}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['rest_calls']:>9.1f}"
+            f"{r['ratelimited']:>7.1f}{r['peak_alloc_kib']:>11.1f}",
+            file=out
+        )
+        if "events_per_sec" in r:
+            print(
+                f"{'':<4}событие: p50 {r['event_p50_us']:.1f} мкс, p99 {r['event_p99_us']:.1f} мкс, "
+                f"{r['events_per_sec']:.0f} событий/с",
+                file=out
+            )
+
+
+def compare(baseline: dict, current: dict, tolerance: float, out) -> List[str]:
+    """Сравнить с эталоном: рост p99 больше допуска или рост числа REST-вызовов"""
+    regressions = []
+    for scenario, results in current.items():
+        for label, r in results.items():
+            base = baseline.get(scenario, {}).get(label)
+            if base is None:
+                continue
+            if r["p99_ms"] > base["p99_ms"] * (1 + tolerance) and r["p99_ms"] - base["p99_ms"] > 1.0:
+                regressions.append(f"{scenario}/{label}: p99 {base['p99_ms']:.2f} -> {r['p99_ms']:.2f} мс")
+            if r["rest_calls"] > base["rest_calls"] + 0.5:
+                regressions.append(f"{scenario}/{label}: REST {base['rest_calls']:.1f} -> {r['rest_calls']:.1f}")
+    if regressions:
+        print("\nРегрессии относительно эталона:", file=out)
+        for line in regressions:
+            print(f"  - {line}", file=out)
+    else:
+        print("\nРегрессий относительно эталона нет.", file=out)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки kisel-bot")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="сценарий (можно указать несколько раз), по умолчанию smoke")
+    parser.add_argument("--repeat", type=int, help="количество повторов вместо значения сценария")
+    parser.add_argument("--latency-ms", type=float, help="задержка заглушки REST, мс")
+    parser.add_argument("--ratelimit", type=float, help="доля запросов, получающих 429")
+    parser.add_argument("--warm", action="store_true", help="не сбрасывать кэш пользователей между повторами")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="файл эталонных результатов")
+    parser.add_argument("--save-baseline", action="store_true", help="сохранить результаты как эталон")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимый рост p99 (доля)")
+    args = parser.parse_args()
+
+    scenarios = args.scenario or ["smoke"]
+    workdir = tempfile.mkdtemp(prefix="kisel-bench-")
+    bot_module = import_bot(workdir)
+    runner = BenchRunner(bot_module, args)
+
+    current = {}
+    out = sys.stdout
+
+    async def run_all() -> None:
+        # Все сценарии в одном цикле событий: объекты бота привязываются к нему
+        for name in scenarios:
+            params = dict(SCENARIOS[name])
+            if args.repeat:
+                params["repeat"] = args.repeat
+            if args.latency_ms is not None:
+                params["latency_ms"] = args.latency_ms
+            if args.ratelimit is not None:
+                params["ratelimit"] = args.ratelimit
+            # Отладочный вывод команд в stdout искажает замеры - подавляем его
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = await runner.run_scenario(name, params)
+            current[name] = results
+            print_report(name, params, results, out)
+
+    asyncio.run(run_all())
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        baseline.update(current)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4, ensure_ascii=False)
+        print(f"\nЭталон сохранен в {args.baseline}", file=out)
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        return 1 if compare(baseline, current, args.tolerance, out) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+import asyncio
+import random
+from collections import Counter
+from typing import Dict, List, Optional
+
+import disnake
+
+
+class FakeResponse:
+    """Минимальная замена aiohttp.ClientResponse для disnake.HTTPException"""
+
+    def __init__(self, status: int, reason: str = "", headers: Optional[dict] = None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+
+class FakeHTTP:
+    """Заглушка REST API Discord с настраиваемой задержкой и 429.
+
+    Считает вызовы по маршрутам; ``reset()`` обнуляет счетчики между замерами.
+    """
+
+    def __init__(self, latency: float = 0.0, ratelimit_ratio: float = 0.0, retry_after: float = 0.05, seed: int = 0):
+        self.latency = latency
+        self.ratelimit_ratio = ratelimit_ratio
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.ratelimited: Counter = Counter()
+        self._random = random.Random(seed)
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.ratelimited.clear()
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    async def request(self, method: str, path: str) -> None:
+        route = f"{method} {path}"
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.ratelimit_ratio and self._random.random() < self.ratelimit_ratio:
+            self.ratelimited[route] += 1
+            raise disnake.HTTPException(
+                FakeResponse(429, "Too Many Requests", {"Retry-After": str(self.retry_after)}),
+                {"message": "You are being rate limited.", "code": 0}
+            )
+
+
+class FakeAsset:
+    def __init__(self, url: str):
+        self.url = url
+
+
+class FakeUser:
+    """Пользователь, которого «вернул» REST (нет ни на одном общем сервере)"""
+
+    def __init__(self, user_id: int, http: FakeHTTP, bot: bool = False):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.global_name = None
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+        self.display_avatar = FakeAsset(f"https://cdn.invalid/avatars/{user_id}.png")
+        self._http = http
+
+    async def send(self, *args, **kwargs):
+        # Как и настоящий клиент: сначала создание DM-канала, затем сообщение
+        await self._http.request("POST", "/users/@me/channels")
+        await self._http.request("POST", "/channels/{channel_id}/messages")
+        return FakeMessage(random.getrandbits(60), self.id)
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, channel_id: int):
+        self.id = message_id
+        self.channel = FakeChannel(channel_id, "dm")
+
+    async def edit(self, *args, **kwargs):
+        return self
+
+
+class FakeActivity:
+    def __init__(self, name: str, activity_type=disnake.ActivityType.playing, details: Optional[str] = None):
+        self.name = name
+        self.type = activity_type
+        self.details = details
+
+
+class FakeVoiceState:
+    def __init__(self, channel=None, self_mute: bool = False, self_deaf: bool = False, afk: bool = False):
+        self.channel = channel
+        self.self_mute = self_mute
+        self.self_deaf = self_deaf
+        self.mute = False
+        self.deaf = False
+        self.afk = afk
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, name: str, guild=None):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.members: List["FakeMember"] = []
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FakeChannel) and other.id == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+
+class FakeMember(FakeUser):
+    """Участник сервера со статусом, активностями и голосовым состоянием"""
+
+    def __init__(self, user_id: int, guild: "FakeGuild", http: FakeHTTP, status=disnake.Status.offline,
+                 activities=(), bot: bool = False):
+        super().__init__(user_id, http, bot)
+        self.guild = guild
+        self.status = status
+        self.activities = tuple(activities)
+        self.voice: Optional[FakeVoiceState] = None
+        self.roles = []
+        self.nick = None
+
+    @property
+    def activity(self):
+        return self.activities[0] if self.activities else None
+
+    async def add_roles(self, *roles, **kwargs):
+        self.roles.extend(roles)
+
+    async def remove_roles(self, *roles, **kwargs):
+        self.roles = [role for role in self.roles if role not in roles]
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+        self._members: Dict[int, FakeMember] = {}
+        self.voice_channels: List[FakeChannel] = []
+        self.stage_channels: List[FakeChannel] = []
+        self.afk_channel = None
+
+    @property
+    def members(self) -> List[FakeMember]:
+        return list(self._members.values())
+
+    def get_member(self, user_id: int) -> Optional[FakeMember]:
+        return self._members.get(user_id)
+
+    def add_member(self, member: FakeMember) -> None:
+        self._members[member.id] = member
+
+    def get_role(self, role_id: int):
+        return None
+
+
+class FakeInteractionResponse:
+    def __init__(self):
+        self.messages = []
+        self.deferred = False
+
+    async def defer(self, *args, **kwargs):
+        self.deferred = True
+
+    async def send_message(self, content=None, **kwargs):
+        self.messages.append((content, kwargs))
+
+    async def edit_message(self, content=None, **kwargs):
+        self.messages.append((content, kwargs))
+
+    async def send_modal(self, modal):
+        self.messages.append(("modal", {"modal": modal}))
+
+
+class FakeCommand:
+    def __init__(self, name: str):
+        self.name = name
+        self.qualified_name = name
+
+
+class FakeInteraction:
+    """Заглушка ApplicationCommandInteraction для прямого вызова методов когов"""
+
+    _next_id = 1
+
+    def __init__(self, author: FakeMember, guild: FakeGuild, command: str = ""):
+        FakeInteraction._next_id += 1
+        self.id = FakeInteraction._next_id
+        self.author = author
+        self.user = author
+        self.guild = guild
+        self.guild_id = guild.id
+        self.application_command = FakeCommand(command)
+        self.response = FakeInteractionResponse()
+        self.edits = []
+
+    async def edit_original_message(self, content=None, **kwargs):
+        self.edits.append((content, kwargs))
+
+    async def edit_original_response(self, content=None, **kwargs):
+        self.edits.append((content, kwargs))
+
+
+class FakeWorld:
+    """Набор серверов и участников для сценария бенчмарка"""
+
+    GAMES = ("Dota 2", "Counter-Strike 2", "Minecraft", "Valorant", "Rust", "Apex Legends")
+
+    def __init__(self, http: FakeHTTP, guilds: int, members_per_guild: int, friends: int,
+                 online_ratio: float = 0.5, playing_ratio: float = 0.3, unknown_ratio: float = 0.05, seed: int = 0):
+        self.http = http
+        self.random = random.Random(seed)
+        self.guilds = [FakeGuild(1000 + i, f"guild-{i}") for i in range(guilds)]
+        for guild in self.guilds:
+            guild.voice_channels = [FakeChannel(guild.id * 100 + n, f"voice-{n}", guild) for n in range(5)]
+        self.caller = FakeMember(1, self.guilds[0], http, disnake.Status.online)
+        self.guilds[0].add_member(self.caller)
+
+        # Друзья: большинство состоят на 1-3 общих серверах, часть - ни на одном
+        self.friend_ids: List[int] = []
+        self.members: List[FakeMember] = []
+        next_id = 10_000
+        for _ in range(friends):
+            next_id += 1
+            self.friend_ids.append(next_id)
+            if self.random.random() < unknown_ratio:
+                continue
+            status = disnake.Status.online if self.random.random() < online_ratio else disnake.Status.offline
+            activities = ()
+            if status != disnake.Status.offline and self.random.random() < playing_ratio:
+                activities = (FakeActivity(self.random.choice(self.GAMES)),)
+            for guild in self.random.sample(self.guilds, k=min(len(self.guilds), self.random.randint(1, 3))):
+                member = FakeMember(next_id, guild, http, status, activities)
+                guild.add_member(member)
+                self.members.append(member)
+
+        # Остальные участники серверов, не связанные с вызывающим
+        for guild in self.guilds:
+            while len(guild._members) < members_per_guild:
+                next_id += 1
+                member = FakeMember(next_id, guild, http, self.random.choice(list(disnake.Status)))
+                guild.add_member(member)
+                self.members.append(member)
+
+    def interaction(self, command: str, in_voice: bool = True) -> FakeInteraction:
+        guild = self.guilds[0]
+        self.caller.voice = FakeVoiceState(guild.voice_channels[0]) if in_voice else None
+        return FakeInteraction(self.caller, guild, command)
+
+    async def fetch_user(self, user_id: int) -> FakeUser:
+        """Замена bot.fetch_user: один REST-запрос GET /users/{user_id}"""
+        await self.http.request("GET", "/users/{user_id}")
+        return FakeUser(user_id, self.http)
@@ -1,11 +1,33 @@
 import disnake
-from disnake.ext import commands
+from disnake.ext import commands, tasks
+import asyncio
 import json
+import logging
+import math
 import os
 import time
 import random
-from typing import List, Dict, Any, Optional
+import re
+from typing import List, Dict, Any, Optional, Tuple
 from config import TOKEN, DATA_FILE, SCORE_FILE
+from storage import create_storage, PURCHASE_DUPLICATE, PURCHASE_INSUFFICIENT, PURCHASE_OWNED
+from shop import PurchaseEngine, PURCHASE_COMPLETED
+from friends import FriendGraph
+from persistence import PersistenceWorker
+from scores import ScoreStore
+from leaderboard import Leaderboard
+from voice import VoiceLedger, DEFAULT_VOICE_EXCLUDE, SECONDS_PER_POINT
+from voicestats import VoiceStats, GUILD_SERIES, USER_SERIES, series_key
+from presence import PresenceIndex
+from resolver import UserResolver
+from names import FriendNameIndex
+from throttle import CallThrottle
+from metrics import metrics, resident_memory
+from botlog import setup_logging, get_logger
+from commandsync import sync_commands
+from members import MemberLoader, CHUNK_EAGER, CHUNK_LAZY, CHUNK_STRATEGIES
+from dispatch import STATUS_SKIPPED
+from outbox import NotificationOutbox
 
 # Попытка импорта ID серверов из config.py
 try:
@@ -13,48 +35,544 @@ try:
 except ImportError:
     GUILD_IDS = []  # Если не определены, используем пустой список
 
+# Бэкенд хранилища: "sqlite" (по умолчанию) или "json"
+try:
+    from config import STORAGE_BACKEND
+except ImportError:
+    STORAGE_BACKEND = "sqlite"
+
+try:
+    from config import DB_FILE
+except ImportError:
+    DB_FILE = "bot_data.db"
+
+# Интервал пакетной записи измененных счетов (сек)
+try:
+    from config import SCORE_FLUSH_INTERVAL
+except ImportError:
+    SCORE_FLUSH_INTERVAL = 10
+
+# Интервал сохранения контрольной точки открытых голосовых сессий (сек)
+try:
+    from config import VOICE_CHECKPOINT_INTERVAL
+except ImportError:
+    VOICE_CHECKPOINT_INTERVAL = 60
+
+# Начисление за войс: как часто выдавать очки (сек) и какое время не засчитывать:
+# "afk" - AFK-канал сервера, "solo" - один в канале, "self_deaf"/"self_mute" - выключен
+# звук/микрофон, "bots" - боты (по умолчанию правил нет, засчитывается все время)
+try:
+    from config import VOICE_TICK_INTERVAL
+except ImportError:
+    VOICE_TICK_INTERVAL = 60
+
+try:
+    from config import VOICE_EXCLUDE
+except ImportError:
+    VOICE_EXCLUDE = DEFAULT_VOICE_EXCLUDE
+
+# Статистика войса по дням: интервал записи в хранилище (сек) и смещение часового
+# пояса (ч), по которому считаются сутки
+try:
+    from config import VOICE_STATS_FLUSH_INTERVAL
+except ImportError:
+    VOICE_STATS_FLUSH_INTERVAL = 300
+
+try:
+    from config import VOICE_STATS_UTC_OFFSET
+except ImportError:
+    VOICE_STATS_UTC_OFFSET = 0
+
+# Количество одновременных отправок личных сообщений в /callvoice
+try:
+    from config import DM_CONCURRENCY
+except ImportError:
+    DM_CONCURRENCY = 8
+
+# Ограничение /callvoice: не больше CALLVOICE_RATE вызовов за CALLVOICE_PER секунд на пользователя.
+# Повтор в течение CALLVOICE_COALESCE_WINDOW секунд обновляет уже отправленные сообщения
+try:
+    from config import CALLVOICE_RATE, CALLVOICE_PER
+except ImportError:
+    CALLVOICE_RATE = 3
+    CALLVOICE_PER = 600
+
+try:
+    from config import CALLVOICE_COALESCE_WINDOW
+except ImportError:
+    CALLVOICE_COALESCE_WINDOW = 120
+
+# Очередь уведомлений: сколько раз пробовать доставить сообщение и на сколько секунд
+# перестать писать пользователю, закрывшему личные сообщения
+try:
+    from config import OUTBOX_MAX_ATTEMPTS
+except ImportError:
+    OUTBOX_MAX_ATTEMPTS = 8
+
+try:
+    from config import OUTBOX_BLOCK_FOR
+except ImportError:
+    OUTBOX_BLOCK_FOR = 86400
+
+# Размер и время жизни кэша пользователей, загруженных через REST
+try:
+    from config import USER_CACHE_SIZE, USER_CACHE_TTL
+except ImportError:
+    USER_CACHE_SIZE = 5000
+    USER_CACHE_TTL = 3600
+
 # Инициализация бота с синхронизацией команд
 intents = disnake.Intents.default()
 intents.members = True
 intents.message_content = True
 intents.presences = True  # Для получения информации о статусах пользователей
 
+# Загрузка участников при запуске: "eager" - все участники всех серверов,
+# "lazy" - только пользователи из списков друзей (быстрее и меньше памяти на больших серверах)
+try:
+    from config import CHUNK_STRATEGY
+except ImportError:
+    CHUNK_STRATEGY = CHUNK_EAGER
+
+if CHUNK_STRATEGY not in CHUNK_STRATEGIES:
+    raise ValueError(f"Неизвестная стратегия загрузки участников: {CHUNK_STRATEGY}")
+
+# Как часто подтягивать изменения других процессов, работающих с той же базой (сек)
+try:
+    from config import STATE_SYNC_INTERVAL
+except ImportError:
+    STATE_SYNC_INTERVAL = 2
+
+# Журнал в формате JSON-строк: общий уровень, уровни отдельных категорий
+# (например {"callvoice": "DEBUG"}), лимит отладочных записей в секунду на категорию
+# и файл (None - stdout)
+try:
+    from config import LOG_LEVEL
+except ImportError:
+    LOG_LEVEL = "INFO"
+
+try:
+    from config import LOG_LEVELS
+except ImportError:
+    LOG_LEVELS = {}
+
+try:
+    from config import LOG_SAMPLE_LIMIT
+except ImportError:
+    LOG_SAMPLE_LIMIT = 20
+
+try:
+    from config import LOG_FILE
+except ImportError:
+    LOG_FILE = None
+
+# Запись журнала идет в отдельном потоке и никогда не задерживает обработчики
+log_pipeline = setup_logging(LOG_LEVEL, LOG_LEVELS, sample_limit=LOG_SAMPLE_LIMIT, log_file=LOG_FILE)
+callvoice_log = get_logger("callvoice")
+voice_log = get_logger("voice")
+commands_log = get_logger("commands")
+
+# Локальный HTTP-порт для метрик в формате Prometheus (None - не запускать)
+try:
+    from config import METRICS_PORT
+except ImportError:
+    METRICS_PORT = None
+
+# Синхронизация слэш-команд при запуске: "changed" - только если изменился хэш команд
+# (названия, параметры, варианты, guild_ids), "always" - сверка disnake при каждом запуске
+try:
+    from config import COMMAND_SYNC
+except ImportError:
+    COMMAND_SYNC = "changed"
+
+if COMMAND_SYNC not in ("changed", "always"):
+    raise ValueError(f"Неизвестный режим синхронизации команд: {COMMAND_SYNC}")
+
+# Ключ таблицы meta с хэшами команд по областям (глобальные и серверы)
+COMMAND_SIGNATURE_KEY = "command_signatures"
+
 # Использование CommandSyncFlags вместо устаревших параметров
 command_sync_flags = commands.CommandSyncFlags.default()
-command_sync_flags.sync_commands = True
-command_sync_flags.sync_commands_debug = True
+# В режиме "changed" бот синхронизирует команды сам, по хэшу
+command_sync_flags.sync_commands = COMMAND_SYNC == "always"
+
+# Шардирование: несколько подключений к шлюзу в одном процессе
+try:
+    from config import SHARDED
+except ImportError:
+    SHARDED = False
+
+# Общее количество шардов и ID шардов этого процесса (None - все шарды, их количество выбирает Discord)
+try:
+    from config import SHARD_COUNT
+except ImportError:
+    SHARD_COUNT = None
+
+try:
+    from config import SHARD_IDS
+except ImportError:
+    SHARD_IDS = None
+
+if SHARD_IDS is not None and SHARD_COUNT is None:
+    raise ValueError("SHARD_IDS задан без SHARD_COUNT: укажите общее количество шардов")
+
+if SHARDED:
+    bot = commands.AutoShardedBot(
+        command_prefix="/",
+        intents=intents,
+        command_sync_flags=command_sync_flags,
+        shard_count=SHARD_COUNT,
+        shard_ids=SHARD_IDS,
+        chunk_guilds_at_startup=CHUNK_STRATEGY == CHUNK_EAGER,
+        enable_debug_events=True
+    )
+else:
+    bot = commands.Bot(
+        command_prefix="/", 
+        intents=intents,
+        command_sync_flags=command_sync_flags,
+        chunk_guilds_at_startup=CHUNK_STRATEGY == CHUNK_EAGER,
+        enable_debug_events=True  # Нужно для подсчета событий шлюза (on_socket_event_type)
+    )
+
+# Метрики REST-запросов и ограничений скорости
+metrics.instrument_http(bot.http)
+metrics_server = None
+
+@bot.before_slash_command_invoke
+async def before_slash_command(inter: disnake.ApplicationCommandInteraction):
+    inter._metrics_started = time.perf_counter()
+
+@bot.after_slash_command_invoke
+async def after_slash_command(inter: disnake.ApplicationCommandInteraction):
+    started = getattr(inter, "_metrics_started", None)
+    if started is not None:
+        metrics.observe("command_latency_seconds", inter.application_command.qualified_name, time.perf_counter() - started)
+    metrics.inc("commands_total", inter.application_command.qualified_name)
+
+@bot.event
+async def on_socket_event_type(event_type: str):
+    metrics.inc("gateway_events_total", event_type)
 
-bot = commands.Bot(
-    command_prefix="/", 
-    intents=intents,
-    command_sync_flags=command_sync_flags
+# Хранилище данных (при первом запуске SQLite переносит данные из JSON-файлов)
+# Несколько процессов бота (например, по группе шардов) могут работать с одной базой SQLite;
+# контрольная точка голосовых сессий у каждого своя
+storage = create_storage(
+    STORAGE_BACKEND, DB_FILE, DATA_FILE, SCORE_FILE,
+    scope=",".join(map(str, SHARD_IDS)) if SHARD_IDS else ""
 )
 
-# Управление данными о друзьях
-def load_friend_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    return {}
+# Все записи на диск выполняются в отдельном потоке, чтобы не блокировать цикл событий
+persistence = PersistenceWorker()
+
+# Граф друзей с обратным индексом (общий для всех команд)
+friend_graph = FriendGraph.from_json(storage.load_friends())
+
+# Общие для всех команд счета пользователей с отложенной записью
+score_store = ScoreStore(storage)
+
+# Рейтинг по очкам, обновляется при каждом изменении счета
+leaderboard = Leaderboard(dict(score_store.items()))
+score_store.add_listener(leaderboard.update)
+
+# Минуты в голосовых каналах по дням для пользователей и серверов
+voice_stats = VoiceStats(VOICE_STATS_UTC_OFFSET)
+voice_stats.load(storage.load_voice_stats())
+
+# Совершенные покупки в магазине: ID пользователя -> список покупок
+purchases: Dict[str, List[str]] = storage.load_purchases()
+
+# Покупки: блокировка на пользователя, резерв очков и журнал покупок в хранилище
+shop_engine = PurchaseEngine(storage, score_store, persistence, purchases)
+
+# Количество строк на странице /leaderboard
+LEADERBOARD_PAGE_SIZE = 10
+
+# Упоминание пользователя <@id>/<@!id> или ID числом; упоминания ролей (<@&id>),
+# каналов (<#id>) и эмодзи (<:name:id>) не подходят
+USER_MENTION_PATTERN = re.compile(r"<@!?(\d{15,20})>|(?<![&#:\d])\b(\d{15,20})\b(?!>)")
+
+# Последняя обработанная запись журнала изменений хранилища
+shared_state_seq = storage.last_change()
+
+def read_shared_changes(seq: int):
+    """Прочитать изменения других процессов (выполняется в потоке записи).
+
+    Счета обновляются прямо здесь, последовательно с записью приращений,
+    поэтому незаписанные локальные изменения не теряются.
+    """
+    seq, changes = storage.changes_since(seq)
+    if changes is None:
+        score_store.refresh(storage.load_scores())
+    elif changes:
+        scores = {str(user_id): int(value) for kind, user_id, _, value in changes if kind == "score"}
+        if scores:
+            score_store.refresh(scores)
+    if changes is None:
+        # Журнал уже обрезан - перечитываем все
+        return seq, None, storage.load_friends(), storage.load_purchases()
+    return seq, changes, None, None
+
+def apply_shared_changes(changes, friends_data, purchases_data) -> None:
+    """Применить изменения других процессов к кэшам в памяти"""
+    if changes is None:
+        friend_graph.sync(friends_data)
+        for user_id, items in purchases_data.items():
+            purchases[user_id] = items
+        return
+    for kind, user_id, other_id, value in changes:
+        if kind == "friend_add":
+            friend_graph.add(user_id, other_id)
+        elif kind == "friend_remove":
+            friend_graph.remove(user_id, other_id)
+        elif kind == "user_remove":
+            friend_graph.remove_user(user_id)
+        elif kind == "purchase":
+            items = purchases.setdefault(str(user_id), [])
+            if value not in items:
+                items.append(value)
+
+@tasks.loop(seconds=STATE_SYNC_INTERVAL)
+async def sync_shared_state():
+    """Подтягивать изменения, сделанные другими процессами с той же базой"""
+    global shared_state_seq
+    try:
+        seq, changes, friends_data, purchases_data = await persistence.submit(
+            read_shared_changes, shared_state_seq, key="sync"
+        )
+    except Exception as e:
+        print(f"Ошибка при чтении изменений хранилища: {e}")
+        return
+    shared_state_seq = seq
+    apply_shared_changes(changes, friends_data, purchases_data)
 
-def save_friend_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+def persist_scores():
+    """Поставить запись измененных счетов в очередь (одинаковые запросы объединяются)"""
+    return persistence.submit(score_store.flush, key="scores")
 
-# Управление данными о счетах пользователей
-def load_score_data():
-    if os.path.exists(SCORE_FILE):
-        with open(SCORE_FILE, "r") as f:
-            return json.load(f)
-    return {}
+@tasks.loop(seconds=SCORE_FLUSH_INTERVAL)
+async def flush_scores():
+    """Периодическая запись измененных счетов одной пачкой"""
+    try:
+        await persist_scores()
+    except Exception as e:
+        print(f"Ошибка при записи счетов: {e}")
 
-def save_score_data(data):
-    with open(SCORE_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+async def persist_voice_stats() -> None:
+    """Записать накопленные минуты статистики войса приращениями"""
+    pending = voice_stats.take_pending()
+    if not pending:
+        return
+    try:
+        merged = await persistence.submit(storage.add_voice_minutes, pending)
+    except Exception:
+        voice_stats.restore_pending(pending)
+        raise
+    voice_stats.refresh(merged)
+
+@tasks.loop(seconds=VOICE_STATS_FLUSH_INTERVAL)
+async def flush_voice_stats():
+    """Периодическая запись статистики войса"""
+    try:
+        await persist_voice_stats()
+    except Exception as e:
+        print(f"Ошибка при записи статистики войса: {e}")
 
 # Обработчики событий
-# Словарь для отслеживания времени в голосовых каналах. Ключ - ID пользователя, значение - время входа
-voice_time_tracker = {}
+# Журнал открытых сессий в голосовых каналах (переживает перезапуск через контрольные точки)
+voice_ledger = VoiceLedger(VOICE_EXCLUDE)
+# Сессии из контрольной точки загружаются один раз, при первом on_ready
+voice_ledger_restored = False
+# Видит ли бот сейчас события шлюза (пока нет - контрольные точки не сдвигаются)
+voice_ledger_live = False
+
+# Состояние шардов: время последней готовности и отключенные сейчас шарды.
+# Без шардирования единственное подключение считается шардом 0
+shard_ready_at: Dict[int, float] = {}
+disconnected_shards = set()
+
+def shard_latencies() -> List[tuple]:
+    """Пары (ID шарда, задержка шлюза в секундах)"""
+    return list(getattr(bot, "latencies", [(0, bot.latency)]))
+
+# Индекс статусов и активностей участников всех серверов бота
+# (общий для всех шардов процесса: кэш участников у них один)
+presence_index = PresenceIndex()
+
+# Ленивая загрузка участников: только друзья, найденные через запросы к шлюзу
+member_loader = MemberLoader(friend_graph, presence_index, lambda: bot.guilds) if CHUNK_STRATEGY == CHUNK_LAZY else None
+member_load_task: Optional[asyncio.Task] = None
+
+# Время запуска: через сколько секунд бот готов и загружены участники
+startup_stats: Dict[str, float] = {}
+
+def forget_user(user_id: int) -> None:
+    """Удалить несуществующего пользователя из всех списков друзей"""
+    if friend_graph.remove_user(user_id):
+        persistence.submit(storage.remove_user, str(user_id))
+
+# Общий кэш пользователей для всех команд вместо bot.fetch_user
+# (удаленные аккаунты убираются из списков друзей, как раньше в /removefriend)
+user_resolver = UserResolver(
+    bot, presence_index,
+    maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL,
+    on_not_found=forget_user
+)
+
+def cached_display_name(user_id: int) -> Optional[str]:
+    """Отображаемое имя пользователя только из кэшей, без REST"""
+    user = presence_index.get_member(user_id) or user_resolver.peek(user_id)
+    if user is None:
+        return None
+    return getattr(user, "global_name", None) or user.name
+
+# Префиксный индекс имен друзей для автодополнения /removefriend
+friend_names = FriendNameIndex(friend_graph, cached_display_name)
+if member_loader is not None:
+    # Друзья, загруженные лениво, получают имя вместо ID
+    member_loader.add_listener(lambda member: friend_names.rename(member.id))
+
+# Корзины токенов и окна объединения для /callvoice
+call_throttle = CallThrottle(CALLVOICE_RATE, CALLVOICE_PER, CALLVOICE_COALESCE_WINDOW)
+
+def callvoice_rate_limit(inter: disnake.ApplicationCommandInteraction) -> bool:
+    """Проверка перед /callvoice: при пустой корзине - CommandOnCooldown (токен забирает сама команда)"""
+    retry_after = call_throttle.check(inter.author.id)
+    if retry_after:
+        raise commands.CommandOnCooldown(
+            commands.Cooldown(CALLVOICE_RATE, CALLVOICE_PER), retry_after, commands.BucketType.user
+        )
+    return True
+
+async def deliver_notification(friend_id: int, payload: dict, target: Optional[Tuple[int, int]]) -> Tuple[int, int]:
+    """Отправить (или обновить) уведомление из очереди. Возвращает (ID канала, ID сообщения)"""
+    embed = disnake.Embed.from_dict(payload["embed"])
+    view = None
+    if payload.get("voice_url"):
+        view = disnake.ui.View()
+        view.add_item(disnake.ui.Button(
+            style=disnake.ButtonStyle.primary,
+            label="Войс",
+            emoji="🎤",
+            url=payload["voice_url"]
+        ))
+    if target is not None:
+        # Редактирование - один запрос вместо создания канала и нового сообщения
+        channel_id, message_id = target
+        channel = bot.get_partial_messageable(channel_id, type=disnake.ChannelType.private)
+        try:
+            await channel.get_partial_message(message_id).edit(embed=embed, view=view)
+            return target
+        except disnake.NotFound:
+            # Сообщение удалено - отправим новое
+            pass
+    # Отправка личного сообщения другу
+    friend = await user_resolver.resolve(friend_id)
+    if friend is None:
+        raise LookupError("пользователь не найден")
+    message = await friend.send(embed=embed, view=view)
+    return message.channel.id, message.id
+
+# Постоянная очередь уведомлений /callvoice с повторами и учетом лимитов Discord
+notification_outbox = NotificationOutbox(
+    storage, persistence, deliver_notification,
+    concurrency=DM_CONCURRENCY,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    block_for=OUTBOX_BLOCK_FOR
+)
+
+# Значения, которые показываются в /botstats и отдаются в Prometheus
+metrics.register_gauge("user_cache", user_resolver.stats)
+metrics.register_gauge("score_store", score_store.stats)
+metrics.register_gauge("persistence", persistence.stats)
+metrics.register_gauge("presence_index", lambda: {"users": len(presence_index)})
+metrics.register_gauge("voice_ledger", lambda: {"open_sessions": len(voice_ledger)})
+metrics.register_gauge("voice_stats", voice_stats.stats)
+metrics.register_gauge("call_throttle", call_throttle.stats)
+metrics.register_gauge("outbox", notification_outbox.stats)
+metrics.register_gauge("log", log_pipeline.stats)
+metrics.register_gauge("startup", lambda: {
+    **startup_stats,
+    "rss_bytes": resident_memory(),
+    "cached_members": sum(len(guild.members) for guild in bot.guilds),
+})
+if member_loader is not None:
+    metrics.register_gauge("member_loader", member_loader.stats)
+metrics.register_gauge("shards", lambda: {
+    "ready": len(shard_ready_at),
+    "disconnected": len(disconnected_shards),
+    **{f"latency_ms_{shard_id}": latency * 1000 for shard_id, latency in shard_latencies() if math.isfinite(latency)}
+})
+
+def voice_state(member: disnake.Member, state: disnake.VoiceState) -> dict:
+    """Состояние участника для правил начисления за войс"""
+    return {
+        "bot": member.bot,
+        "afk": state.afk,
+        "self_mute": state.self_mute,
+        "self_deaf": state.self_deaf,
+    }
+
+def credit_voice_points(credits: Dict[str, int], guilds: Dict[str, int]) -> None:
+    """Начислить очки за такт и учесть эти минуты в статистике войса"""
+    # Одно обновление счетов за такт (запишется в хранилище пачкой по таймеру)
+    score_store.add_many(credits)
+    voice_stats.record(
+        {user_id: round(points * SECONDS_PER_POINT / 60) for user_id, points in credits.items()}, guilds
+    )
+
+@tasks.loop(seconds=VOICE_TICK_INTERVAL)
+async def accrue_voice_time():
+    """Начислить очки за время в голосовых каналах (1 очко за минуту) одним пакетом"""
+    if not voice_ledger_live:
+        # Пока события теряются, время досчитается после сверки
+        return
+    guilds: Dict[str, int] = {}
+    credits = voice_ledger.tick(guilds=guilds)
+    if credits:
+        credit_voice_points(credits, guilds)
+        voice_log.info(
+            "Начислены очки за время в голосовых каналах",
+            extra={"users": len(credits), "points": sum(credits.values()), "open_sessions": len(voice_ledger)}
+        )
+
+def reconcile_voice_sessions():
+    """Сверить журнал голосовых сессий с участниками каналов за один проход"""
+    global voice_ledger_restored, voice_ledger_live
+    if not voice_ledger_restored:
+        sessions, checkpoint_at, leftovers = storage.load_voice_sessions()
+        voice_ledger.restore(sessions, checkpoint_at, leftovers)
+        voice_ledger_restored = True
+    
+    voice_members = []
+    for guild in bot.guilds:
+        for channel in guild.voice_channels + guild.stage_channels:
+            for member in channel.members:
+                state = member.voice
+                voice_members.append((
+                    str(member.id), guild.id, channel.id,
+                    voice_state(member, state) if state is not None else {"bot": member.bot}
+                ))
+    
+    # Время закрытых сессий начислится на ближайшем такте
+    voice_ledger.reconcile(voice_members)
+    # Пока какой-то шард отключен, его события теряются
+    voice_ledger_live = not disconnected_shards
+    print(f"Голосовые сессии сверены: открыто {len(voice_ledger)}")
+
+@tasks.loop(seconds=VOICE_CHECKPOINT_INTERVAL)
+async def checkpoint_voice_sessions():
+    """Периодическое сохранение открытых голосовых сессий"""
+    if not voice_ledger_live:
+        return
+    voice_ledger.mark_confirmed()
+    try:
+        await persistence.submit(
+            storage.save_voice_sessions, voice_ledger.snapshot(), voice_ledger.confirmed_at, voice_ledger.leftovers(),
+            key="voice"
+        )
+    except Exception as e:
+        print(f"Ошибка при сохранении голосовых сессий: {e}")
 
 @bot.event
 async def on_ready():
@@ -62,11 +580,71 @@ async def on_ready():
     print(f"Бот {bot.user} успешно подключен к Discord!")
     print(f"ID бота: {bot.user.id}")
     print(f"Количество серверов: {len(bot.guilds)}")
+    if SHARDED:
+        print(f"Шарды: {sorted(bot.shards)} из {bot.shard_count}")
     for guild in bot.guilds:
         print(f"- {guild.name} (ID: {guild.id})")
     print(f"==========================================")
     print(f"Используйте Ctrl+C для остановки бота")
     
+    # Запуск HTTP-сервера метрик, если он включен в config.py
+    global metrics_server
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = await metrics.serve_prometheus("127.0.0.1", METRICS_PORT)
+        print(f"Метрики доступны на http://127.0.0.1:{METRICS_PORT}/metrics")
+    
+    # Подписчики счетов (рейтинг) вызываются только в цикле событий
+    score_store.bind_loop(asyncio.get_running_loop())
+    
+    # Запуск периодической записи счетов и синхронизации с другими процессами
+    if not flush_scores.is_running():
+        flush_scores.start()
+    if not sync_shared_state.is_running():
+        sync_shared_state.start()
+    
+    # Фоновая отправка уведомлений из очереди (в том числе оставшихся с прошлого запуска)
+    notification_outbox.start()
+    
+    # Возврат очков за покупки, прерванные падением процесса
+    try:
+        await shop_engine.recover()
+    except Exception as e:
+        print(f"Ошибка при проверке незавершенных покупок: {e}")
+    
+    if not SHARDED:
+        # Без шардирования on_shard_ready не приходит
+        shard_ready_at[0] = time.time()
+        disconnected_shards.discard(0)
+    
+    # Построение индекса статусов по кэшу участников (по всем шардам процесса)
+    presence_index.build(bot.guilds)
+    print(f"Индекс статусов построен: {len(presence_index)} пользователей")
+    if "ready_seconds" not in startup_stats:
+        startup_stats["ready_seconds"] = time.time() - metrics.started_at
+        print(
+            f"Бот готов через {startup_stats['ready_seconds']:.1f} с после запуска "
+            f"(загрузка участников: {CHUNK_STRATEGY}), RSS {resident_memory() / 2 ** 20:.0f} МиБ"
+        )
+    
+    # Синхронизация команд только при изменении их хэша (в фоне, не задерживая запуск)
+    global command_sync_task
+    if COMMAND_SYNC == "changed" and command_sync_task is None:
+        command_sync_task = asyncio.create_task(sync_commands_on_start())
+    
+    # В ленивом режиме друзья подгружаются в фоне (после переподключения кэш участников пуст)
+    global member_load_task
+    if member_loader is not None and (member_load_task is None or member_load_task.done()):
+        member_load_task = asyncio.create_task(load_friend_members())
+    
+    # Восстановление и сверка голосовых сессий (в том числе после переподключения)
+    reconcile_voice_sessions()
+    if not checkpoint_voice_sessions.is_running():
+        checkpoint_voice_sessions.start()
+    if not accrue_voice_time.is_running():
+        accrue_voice_time.start()
+    if not flush_voice_stats.is_running():
+        flush_voice_stats.start()
+    
     # Установка статуса бота
     await bot.change_presence(
         activity=disnake.Activity(
@@ -75,53 +653,267 @@ async def on_ready():
         )
     )
 
+# Синхронизация команд по хэшу выполняется один раз за запуск
+command_sync_task: Optional[asyncio.Task] = None
+
+async def sync_changed_commands(force: bool = False) -> List[str]:
+    """Перезаписать команды в областях с измененным хэшем. Возвращает синхронизированные области"""
+    stored = await persistence.submit(storage.get_meta, COMMAND_SIGNATURE_KEY)
+    signatures, synced = await sync_commands(bot, json.loads(stored) if stored else {}, force)
+    await persistence.submit(
+        storage.set_meta, COMMAND_SIGNATURE_KEY, json.dumps(signatures, sort_keys=True), key="commands"
+    )
+    return synced
+
+async def sync_commands_on_start():
+    started = time.perf_counter()
+    try:
+        synced = await sync_changed_commands()
+    except Exception as e:
+        print(f"Ошибка при синхронизации команд: {e}")
+        return
+    if synced:
+        print(f"Команды синхронизированы ({', '.join(sorted(synced))}) за {time.perf_counter() - started:.1f} с")
+    else:
+        print("Команды не изменились, синхронизация пропущена")
+
+async def load_friend_members():
+    """Загрузить участников из списков друзей на всех серверах (ленивый режим)"""
+    found = await member_loader.load_all()
+    startup_stats.setdefault("members_loaded_seconds", time.time() - metrics.started_at)
+    print(
+        f"Загружено участников из списков друзей: {found} за {member_loader.last_load_seconds:.1f} с "
+        f"(запросов: {member_loader.requests}), RSS {resident_memory() / 2 ** 20:.0f} МиБ"
+    )
+
+@bot.event
+@metrics.timed("on_presence_update")
+async def on_presence_update(before: disnake.Member, after: disnake.Member):
+    """Обновление индекса при смене статуса или активности"""
+    presence_index.update_member(after)
+
+@bot.event
+async def on_member_join(member: disnake.Member):
+    presence_index.update_member(member)
+    if member_loader is not None:
+        member_loader.forget_member(member.guild.id, member.id)
+    # Имя друга могло быть неизвестно, пока он не появился на общем сервере
+    friend_names.rename(member.id)
+
+@bot.event
+async def on_user_update(before: disnake.User, after: disnake.User):
+    """Смена имени пользователя - обновляем индекс автодополнения"""
+    friend_names.rename(after.id, after.global_name or after.name)
+
+@bot.event
+async def on_member_update(before: disnake.Member, after: disnake.Member):
+    presence_index.update_member(after)
+    friend_names.rename(after.id)
+
+@bot.event
+async def on_member_remove(member: disnake.Member):
+    presence_index.remove_member(member.guild.id, member.id)
+
+@bot.event
+async def on_guild_join(guild: disnake.Guild):
+    presence_index.add_guild(guild)
+    if member_loader is not None:
+        # Без выгрузки всех участников друзей на новом сервере нужно запросить
+        try:
+            await member_loader.load_guild(guild)
+        except Exception as e:
+            print(f"Не удалось загрузить участников сервера {guild.id}: {e}")
+
+@bot.event
+async def on_guild_remove(guild: disnake.Guild):
+    presence_index.remove_guild(guild)
+    if member_loader is not None:
+        member_loader.forget_guild(guild.id)
+
+def connection_lost(shard_id: int) -> None:
+    """Потеря соединения: дальше журнал сессий может расходиться с реальностью"""
+    global voice_ledger_live
+    if voice_ledger_live:
+        voice_ledger.mark_confirmed()
+    voice_ledger_live = False
+    disconnected_shards.add(shard_id)
+
+def connection_resumed(shard_id: int) -> None:
+    # При RESUME Discord досылает пропущенные события, сверка не нужна
+    global voice_ledger_live
+    disconnected_shards.discard(shard_id)
+    if voice_ledger_restored and not disconnected_shards:
+        voice_ledger_live = True
+
+@bot.event
+async def on_disconnect():
+    # С шардированием то же событие приходит как on_shard_disconnect с ID шарда
+    if not SHARDED:
+        connection_lost(0)
+
+@bot.event
+async def on_resumed():
+    if not SHARDED:
+        connection_resumed(0)
+
+@bot.event
+async def on_shard_disconnect(shard_id: int):
+    connection_lost(shard_id)
+
 @bot.event
+async def on_shard_resumed(shard_id: int):
+    connection_resumed(shard_id)
+
+@bot.event
+async def on_shard_ready(shard_id: int):
+    """Шард загрузил свои серверы; общая сверка выполнится в on_ready"""
+    shard_ready_at[shard_id] = time.time()
+    disconnected_shards.discard(shard_id)
+    latency = dict(shard_latencies()).get(shard_id, float("nan"))
+    guilds = sum(1 for guild in bot.guilds if guild.shard_id == shard_id)
+    print(f"Шард {shard_id} готов: серверов {guilds}, задержка {latency * 1000:.0f} мс")
+
+@bot.event
+@metrics.timed("on_voice_state_update")
 async def on_voice_state_update(member: disnake.Member, before: disnake.VoiceState, after: disnake.VoiceState):
     """Обработчик события изменения состояния голосового канала"""
     user_id = str(member.id)
     
-    # Пользователь вошел в голосовой канал
-    if before.channel is None and after.channel is not None:
-        voice_time_tracker[user_id] = time.time()
+    # Быстрый путь: включение/выключение микрофона или звука в том же канале -
+    # только досчитать время сессии по прежнему состоянию, без записи в хранилище
+    if (
+        before.channel is not None and before.channel == after.channel
+        and voice_ledger.update_flags(user_id, after.self_mute, after.self_deaf)
+    ):
+        return
     
-    # Пользователь вышел из голосового канала
-    elif before.channel is not None and (after.channel is None or after.channel != before.channel):
-        if user_id in voice_time_tracker:
-            enter_time = voice_time_tracker[user_id]
-            current_time = time.time()
-            minutes_in_voice = int((current_time - enter_time) // 60)  # Получаем количество минут
-            
-            if minutes_in_voice > 0:
-                # Загружаем данные о счетах
-                scores = load_score_data()
-                
-                # Обновляем счет пользователя
-                if user_id not in scores:
-                    scores[user_id] = 0
-                
-                scores[user_id] += minutes_in_voice
-                
-                # Сохраняем данные
-                save_score_data(scores)
-                
-                print(f"Пользователь {member.name} (ID: {user_id}) получил {minutes_in_voice} очков за {minutes_in_voice} минут в голосовом канале")
-            
-            # Удаляем запись о времени входа
-            del voice_time_tracker[user_id]
+    # Пользователь вошел в голосовой канал, или его сессия не открыта (вошел, пока бот
+    # был выключен) - открываем ее с фактическим состоянием
+    if after.channel is not None and user_id not in voice_ledger:
+        voice_ledger.start(user_id, member.guild.id, after.channel.id, **voice_state(member, after))
+    
+    # Пользователь вышел из голосового канала (очки начислит ближайший такт)
+    elif before.channel is not None and after.channel is None:
+        voice_ledger.stop(user_id)
     
-    # Если пользователь сменил канал, обновляем время входа
-    elif before.channel is not None and after.channel is not None and before.channel != after.channel:
-        voice_time_tracker[user_id] = time.time()
+    # Если пользователь сменил канал (или вошел с уже открытой сессией), сессия продолжается
+    elif after.channel is not None:
+        voice_ledger.move(
+            user_id, member.guild.id, after.channel.id,
+            afk=after.afk, self_mute=after.self_mute, self_deaf=after.self_deaf
+        )
+
+# Количество друзей на одной странице /friendlist
+FRIENDLIST_PAGE_SIZE = 10
+
+# Лимиты встраиваемого сообщения Discord
+EMBED_MAX_FIELDS = 25
+EMBED_FIELD_NAME_LIMIT = 256
+EMBED_FIELD_VALUE_LIMIT = 1024
+EMBED_TOTAL_LIMIT = 6000
+# Запас под заголовок, описание и подпись, которые задаются отдельно
+EMBED_RESERVED = 500
+
+def capped_lines(lines: List[str], limit: int) -> str:
+    """Строки через перевод строки не длиннее limit; не поместившиеся заменяются на «…и еще N»"""
+    text = ""
+    for i, line in enumerate(lines):
+        # Если строка не последняя, оставляем место под "…и еще N"
+        reserve = len(f"…и еще {len(lines)}") if i < len(lines) - 1 else 0
+        if len(text) + len(line) + 1 + reserve > limit:
+            return text + f"…и еще {len(lines) - i}"
+        text += line + "\n"
+    return text or "—"
+
+def add_list_fields(embed: disnake.Embed, sections: List[Tuple[str, List[str]]]) -> None:
+    """Добавить поля-списки, не выходя за лимиты Discord на поле и на сообщение целиком"""
+    sections = sections[:EMBED_MAX_FIELDS - len(embed.fields)]
+    if not sections:
+        return
+    names = [name[:EMBED_FIELD_NAME_LIMIT] for name, _ in sections]
+    # Общий лимит делим между полями поровну
+    budget = EMBED_TOTAL_LIMIT - EMBED_RESERVED - len(embed) - sum(map(len, names))
+    limit = min(EMBED_FIELD_VALUE_LIMIT, budget // len(sections))
+    for name, (_, lines) in zip(names, sections):
+        embed.add_field(name=name, value=capped_lines(lines, limit), inline=False)
+
+class FriendListView(disnake.ui.View):
+    """Постраничный список друзей: загружаются только пользователи видимой страницы"""
+    
+    def __init__(self, friend_ids: List[int]):
+        super().__init__(timeout=300)
+        self.friend_ids = friend_ids
+        self.page = 0
+        self._prefetch_task: Optional[asyncio.Task] = None
+    
+    @property
+    def page_count(self) -> int:
+        return max((len(self.friend_ids) + FRIENDLIST_PAGE_SIZE - 1) // FRIENDLIST_PAGE_SIZE, 1)
+    
+    def page_ids(self, page: int) -> List[int]:
+        start = page * FRIENDLIST_PAGE_SIZE
+        return self.friend_ids[start:start + FRIENDLIST_PAGE_SIZE]
+    
+    async def _resolve(self, friend_id: int):
+        try:
+            return await user_resolver.resolve(friend_id)
+        except Exception:
+            return None
+    
+    async def render(self) -> disnake.Embed:
+        """Собрать встраиваемое сообщение для текущей страницы"""
+        ids = self.page_ids(self.page)
+        friends = await asyncio.gather(*(self._resolve(friend_id) for friend_id in ids))
+        
+        embed = disnake.Embed(
+            title="Ваш список друзей",
+            color=disnake.Color.green()
+        )
+        
+        # Добавление друзей во встраиваемое сообщение
+        first = self.page * FRIENDLIST_PAGE_SIZE + 1
+        for i, (friend_id, friend) in enumerate(zip(ids, friends), first):
+            if friend is not None:
+                embed.add_field(
+                    name=f"{i}. {friend.name}",
+                    value=f"ID: {friend.id}",
+                    inline=False
+                )
+            else:
+                embed.add_field(
+                    name=f"{i}. Неизвестный пользователь",
+                    value=f"ID: {friend_id} (Пользователь не найден)",
+                    inline=False
+                )
+        
+        embed.set_footer(text=f"Страница {self.page + 1} из {self.page_count} • Всего друзей: {len(self.friend_ids)}")
+        self.prev_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+        
+        # Заранее загружаем следующую страницу в фоне
+        if self.page + 1 < self.page_count:
+            self._prefetch_task = asyncio.create_task(user_resolver.prewarm(self.page_ids(self.page + 1)))
+        return embed
+    
+    @disnake.ui.button(label="Назад", emoji="◀️", style=disnake.ButtonStyle.secondary)
+    async def prev_page(self, button: disnake.ui.Button, inter: disnake.MessageInteraction):
+        self.page = max(self.page - 1, 0)
+        await inter.response.edit_message(embed=await self.render(), view=self)
+    
+    @disnake.ui.button(label="Вперед", emoji="▶️", style=disnake.ButtonStyle.secondary)
+    async def next_page(self, button: disnake.ui.Button, inter: disnake.MessageInteraction):
+        self.page = min(self.page + 1, self.page_count - 1)
+        await inter.response.edit_message(embed=await self.render(), view=self)
 
 # Группа команд для управления друзьями
 class FriendCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.friend_data = load_friend_data()
+        self.friend_graph = friend_graph
     
-    def get_user_friends(self, user_id: str) -> List[str]:
+    def get_user_friends(self, user_id: str) -> List[int]:
         """Получить список друзей пользователя"""
-        return self.friend_data.get(str(user_id), [])
+        return self.friend_graph.friends(user_id)
     
     @commands.slash_command(
         name="friendhelp",
@@ -146,12 +938,24 @@ class FriendCommands(commands.Cog):
             inline=False
         )
         
+        embed.add_field(
+            name="/addfriends [роль] [канал] [пользователи]",
+            value="Добавляет сразу всех участников роли, голосового канала или упомянутых пользователей",
+            inline=False
+        )
+        
         embed.add_field(
             name="/removefriend [пользователь]",
             value="Удаляет указанного пользователя из вашего списка друзей",
             inline=False
         )
         
+        embed.add_field(
+            name="/removefriends [роль] [канал] [пользователи]",
+            value="Удаляет сразу нескольких друзей по роли, голосовому каналу или упоминаниям",
+            inline=False
+        )
+        
         embed.add_field(
             name="/friendlist",
             value="Показывает ваш список друзей",
@@ -185,84 +989,156 @@ class FriendCommands(commands.Cog):
         user_id = str(inter.author.id)
         friend_id = str(user.id)
         
-        # Инициализация списка друзей пользователя, если он не существует
-        if user_id not in self.friend_data:
-            self.friend_data[user_id] = []
-        
-        # Проверка, есть ли пользователь уже в списке друзей
-        if friend_id in self.friend_data[user_id]:
+        # Добавление пользователя в список друзей (если его там еще нет)
+        if not self.friend_graph.add(user_id, friend_id):
             await inter.response.send_message(f"{user.mention} уже находится в вашем списке друзей.", ephemeral=True)
             return
         
-        # Добавление пользователя в список друзей
-        self.friend_data[user_id].append(friend_id)
-        save_friend_data(self.friend_data)
+        persistence.submit(storage.add_friend, user_id, friend_id)
         
         await inter.response.send_message(f"{user.mention} добавлен в ваш список друзей.", ephemeral=True)
     
+    def collect_targets(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        role: Optional[disnake.Role],
+        channel: Optional[disnake.abc.GuildChannel],
+        mentions: Optional[str]
+    ) -> Tuple[List[int], int]:
+        """Собрать ID пользователей из роли, голосового канала и списка упоминаний.
+        
+        Возвращает (ID без повторов в порядке появления, количество пропущенных:
+        сам автор и боты).
+        """
+        candidates = {}
+        if role is not None:
+            for member in role.members:
+                candidates[member.id] = member
+        if channel is not None:
+            for member in channel.members:
+                candidates[member.id] = member
+        if mentions:
+            for match in USER_MENTION_PATTERN.finditer(mentions):
+                user_id = int(match.group(1) or match.group(2))
+                candidates.setdefault(user_id, inter.guild.get_member(user_id) if inter.guild else None)
+        
+        target_ids = []
+        skipped = 0
+        for user_id, member in candidates.items():
+            if user_id == inter.author.id or (member is not None and member.bot):
+                skipped += 1
+                continue
+            target_ids.append(user_id)
+        return target_ids, skipped
+    
+    @commands.slash_command(
+        name="addfriends",
+        description="Добавить в друзья участников роли, голосового канала или список пользователей",
+        guild_ids=GUILD_IDS
+    )
+    async def addfriends(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        роль: disnake.Role = commands.Param(default=None, description="Добавить всех участников роли"),
+        канал: disnake.VoiceChannel = commands.Param(default=None, description="Добавить всех, кто сейчас в голосовом канале"),
+        пользователи: str = commands.Param(default=None, description="Упоминания пользователей через пробел")
+    ):
+        user_id = str(inter.author.id)
+        target_ids, skipped = self.collect_targets(inter, роль, канал, пользователи)
+        if not target_ids and not skipped:
+            await inter.response.send_message("Укажите роль, голосовой канал или пользователей.", ephemeral=True)
+            return
+        
+        # Все изменения применяются в памяти, а на диск уходят одной операцией
+        added = [friend_id for friend_id in target_ids if self.friend_graph.add(user_id, friend_id)]
+        if added:
+            persistence.submit(storage.add_friends, user_id, [str(friend_id) for friend_id in added])
+        
+        summary = f"Добавлено в список друзей: {len(added)}."
+        if len(target_ids) > len(added):
+            summary += f"\nУже были в списке: {len(target_ids) - len(added)}."
+        if skipped:
+            summary += f"\nПропущено (вы сами и боты): {skipped}."
+        await inter.response.send_message(summary, ephemeral=True)
+    
+    @commands.slash_command(
+        name="removefriends",
+        description="Удалить из друзей участников роли, голосового канала или список пользователей",
+        guild_ids=GUILD_IDS
+    )
+    async def removefriends(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        роль: disnake.Role = commands.Param(default=None, description="Удалить всех участников роли"),
+        канал: disnake.VoiceChannel = commands.Param(default=None, description="Удалить всех, кто сейчас в голосовом канале"),
+        пользователи: str = commands.Param(default=None, description="Упоминания пользователей через пробел")
+    ):
+        user_id = str(inter.author.id)
+        if not self.friend_graph.count(user_id):
+            await inter.response.send_message("Ваш список друзей пуст.", ephemeral=True)
+            return
+        
+        target_ids, _ = self.collect_targets(inter, роль, канал, пользователи)
+        if not target_ids:
+            await inter.response.send_message("Укажите роль, голосовой канал или пользователей.", ephemeral=True)
+            return
+        
+        removed = [friend_id for friend_id in target_ids if self.friend_graph.remove(user_id, friend_id)]
+        if removed:
+            persistence.submit(storage.remove_friends, user_id, [str(friend_id) for friend_id in removed])
+        
+        summary = f"Удалено из списка друзей: {len(removed)}."
+        if len(target_ids) > len(removed):
+            summary += f"\nНе было в списке: {len(target_ids) - len(removed)}."
+        await inter.response.send_message(summary, ephemeral=True)
+    
     @commands.slash_command(
         name="removefriend",
         description="Удалить пользователя из списка друзей",
         guild_ids=GUILD_IDS
     )
-    async def removefriend(self, inter: disnake.ApplicationCommandInteraction):
+    async def removefriend(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        user: str = commands.Param(description="Друг для удаления (начните вводить имя)")
+    ):
         user_id = str(inter.author.id)
         
         # Получение списка друзей пользователя
-        if user_id not in self.friend_data or not self.friend_data[user_id]:
+        if not self.friend_graph.count(user_id):
             await inter.response.send_message("Ваш список друзей пуст.", ephemeral=True)
             return
         
-        # Создание опций для выпадающего меню
-        options = []
-        for friend_id in self.friend_data[user_id]:
-            try:
-                friend = await bot.fetch_user(int(friend_id))
-                options.append(disnake.SelectOption(
-                    label=f"{friend.name}",
-                    value=friend_id,
-                    description=f"Удалить {friend.name} из вашего списка друзей"
-                ))
-            except:
-                # Пользователь не найден, удаляем из списка
-                self.friend_data[user_id].remove(friend_id)
-                save_friend_data(self.friend_data)
-                continue
-        
-        # Создание выпадающего меню
-        select = disnake.ui.Select(
-            placeholder="Выберите друга для удаления",
-            options=options,
-            custom_id="remove_friend_select"
-        )
-        
-        # Создание представления и добавление выпадающего меню
-        view = disnake.ui.View()
-        view.add_item(select)
+        friend_id = self.parse_friend(user_id, user)
+        if friend_id is None or not self.friend_graph.remove(user_id, friend_id):
+            await inter.response.send_message("Пользователь не найден в вашем списке друзей.", ephemeral=True)
+            return
         
-        await inter.response.send_message("Выберите друга для удаления:", view=view, ephemeral=True)
+        persistence.submit(storage.remove_friend, user_id, str(friend_id))
+        await inter.response.send_message(f"<@{friend_id}> удален из вашего списка друзей.", ephemeral=True)
+    
+    def parse_friend(self, user_id: str, value: str) -> Optional[int]:
+        """ID друга из значения автодополнения, упоминания или точного имени"""
+        value = value.strip()
+        digits = value
+        if digits.startswith("<@") and digits.endswith(">"):
+            # Упоминание <@ID> или <@!ID>
+            digits = digits[2:-1].lstrip("!")
+        if digits.isdigit():
+            return int(digits)
+        # Пользователь ввел имя, не выбрав вариант из списка
+        matches = [friend_id for name, friend_id in friend_names.search(user_id, value)
+                   if name.casefold() == value.casefold()]
+        return matches[0] if len(matches) == 1 else None
+    
+    @removefriend.autocomplete("user")
+    async def removefriend_autocomplete(self, inter: disnake.ApplicationCommandInteraction, user: str):
+        # Ответ только из индекса в памяти: Discord ждет автодополнение не дольше 3 секунд
+        return {
+            f"{name} ({friend_id})"[:100]: str(friend_id)
+            for name, friend_id in friend_names.search(inter.author.id, user)
+        }
     
-    # Корректная обработка взаимодействия с выпадающим меню для disnake
-    @commands.Cog.listener("on_dropdown")
-    async def on_friend_remove_dropdown(self, inter: disnake.MessageInteraction):
-        # Проверка, что это наше выпадающее меню
-        if inter.component.custom_id == "remove_friend_select":
-            user_id = str(inter.author.id)
-            friend_id = inter.values[0]
-            
-            # Удаление пользователя из списка друзей
-            if user_id in self.friend_data and friend_id in self.friend_data[user_id]:
-                self.friend_data[user_id].remove(friend_id)
-                save_friend_data(self.friend_data)
-                
-                try:
-                    friend = await bot.fetch_user(int(friend_id))
-                    await inter.response.send_message(f"{friend.mention} удален из вашего списка друзей.", ephemeral=True)
-                except:
-                    await inter.response.send_message("Пользователь удален из вашего списка друзей.", ephemeral=True)
-            else:
-                await inter.response.send_message("Пользователь не найден в вашем списке друзей.", ephemeral=True)
-
     # Общий обработчик взаимодействий с компонентами интерфейса
     @commands.Cog.listener("on_button_click")
     async def on_button_click(self, inter: disnake.MessageInteraction):
@@ -279,39 +1155,22 @@ class FriendCommands(commands.Cog):
         user_id = str(inter.author.id)
         
         # Получение списка друзей пользователя
-        if user_id not in self.friend_data or not self.friend_data[user_id]:
+        if not self.friend_graph.count(user_id):
             await inter.response.send_message("Ваш список друзей пуст.", ephemeral=True)
             return
         
-        # Создание встраиваемого сообщения
-        embed = disnake.Embed(
-            title="Ваш список друзей",
-            color=disnake.Color.green()
-        )
-        
-        # Добавление друзей во встраиваемое сообщение
-        for i, friend_id in enumerate(self.friend_data[user_id], 1):
-            try:
-                friend = await bot.fetch_user(int(friend_id))
-                embed.add_field(
-                    name=f"{i}. {friend.name}",
-                    value=f"ID: {friend.id}",
-                    inline=False
-                )
-            except:
-                embed.add_field(
-                    name=f"{i}. Неизвестный пользователь",
-                    value=f"ID: {friend_id} (Пользователь не найден)",
-                    inline=False
-                )
+        # Показываем первую страницу; остальные загружаются по кнопкам
+        view = FriendListView(self.friend_graph.friends(user_id))
+        embed = await view.render()
         
-        await inter.response.send_message(embed=embed, ephemeral=True)
+        await inter.response.send_message(embed=embed, view=view, ephemeral=True)
     
     @commands.slash_command(
         name="callvoice",
         description="Отправить уведомление о голосовом вызове всем друзьям",
         guild_ids=GUILD_IDS
     )
+    @commands.check(callvoice_rate_limit)
     async def callvoice(
         self, 
         inter: disnake.ApplicationCommandInteraction,
@@ -324,7 +1183,7 @@ class FriendCommands(commands.Cog):
         user_id = str(inter.author.id)
         
         # Получение списка друзей пользователя
-        if user_id not in self.friend_data or not self.friend_data[user_id]:
+        if not self.friend_graph.count(user_id):
             await inter.response.send_message("Ваш список друзей пуст.", ephemeral=True)
             return
         
@@ -346,92 +1205,116 @@ class FriendCommands(commands.Cog):
         if inter.author.voice:
             voice_channel = inter.author.voice.channel
         
-        # Отправка уведомлений друзьям в зависимости от выбранного режима
-        sent_count = 0
-        skipped_count = 0
-        
         await inter.response.defer(ephemeral=True)
         
-        # Предварительная проверка статусов всех пользователей для отладки
-        status_info = []
-        if режим == "Онлайн":
-            for guild in bot.guilds:
-                status_info.append(f"Сервер: {guild.name} (ID: {guild.id})")
-                for friend_id in self.friend_data[user_id]:
-                    try:
-                        member = guild.get_member(int(friend_id))
-                        if member:
-                            friend_name = member.name
-                            status_info.append(f"  - {friend_name} (ID: {friend_id}): {member.status}")
-                    except Exception as e:
-                        status_info.append(f"  - Ошибка получения информации о пользователе {friend_id}: {e}")
-        
-        for friend_id in self.friend_data[user_id]:
-            try:
-                friend = await bot.fetch_user(int(friend_id))
-                
-                # Проверка статуса пользователя, если выбран режим "Онлайн"
-                if режим == "Онлайн":
-                    # Получаем объект участника на общих серверах
-                    online_status = False
-                    status_debug = "не найден на общих серверах"
-                    
-                    # Проверяем все общие серверы с пользователем
-                    for guild in bot.guilds:
-                        member = guild.get_member(int(friend_id))
-                        if member:
-                            # Вывод отладочной информации
-                            print(f"Проверка статуса {friend.name} (ID: {friend_id}) на сервере {guild.name}: {member.status}")
-                            
-                            # Проверяем статус: в сети, неактивен, не беспокоить или стримит
-                            if member.status == disnake.Status.online or member.status == disnake.Status.idle or member.status == disnake.Status.dnd or member.status == disnake.Status.streaming:
-                                online_status = True
-                                status_debug = f"в сети на сервере {guild.name} со статусом {member.status}"
-                                break
-                    
-                    # Если пользователь не онлайн, пропускаем его
-                    if not online_status:
-                        print(f"Пропускаем {friend.name} (ID: {friend_id}): {status_debug}")
-                        skipped_count += 1
-                        continue
-                    else:
-                        print(f"Отправляем сообщение {friend.name} (ID: {friend_id}): {status_debug}")
-                
-                # Создание представления с кнопкой голосового канала, если пользователь находится в голосовом канале
-                view = None
-                if voice_channel:
-                    view = disnake.ui.View()
-                    voice_button = disnake.ui.Button(
-                        style=disnake.ButtonStyle.primary,
-                        label="Войс",
-                        emoji="🎤",
-                        url=f"https://discord.com/channels/{inter.guild.id}/{voice_channel.id}"
+        # Отбор получателей в зависимости от выбранного режима
+        # (статусы друзей пишутся в журнал на уровне DEBUG с ограничением частоты)
+        debug = callvoice_log.isEnabledFor(logging.DEBUG)
+        log_fields = {"command": "callvoice", "user_id": inter.author.id, "guild_id": inter.guild_id}
+        skipped_count = 0
+        recipients = []
+        for friend_id in self.friend_graph.friends(user_id):
+            if режим == "Онлайн":
+                entry = presence_index.get(friend_id)
+                online = entry is not None and entry.is_online
+                if debug:
+                    callvoice_log.debug(
+                        "Статус друга",
+                        extra={
+                            **log_fields,
+                            "friend_id": friend_id,
+                            "status": str(entry.status) if entry is not None else None,
+                            "shared_guilds": len(entry.members) if entry is not None else 0,
+                            "decision": "send" if online else "skip",
+                        }
                     )
-                    view.add_item(voice_button)
                 
-                # Отправка личного сообщения другу
-                await friend.send(embed=embed, view=view)
-                sent_count += 1
-            except Exception as e:
-                print(f"Не удалось отправить сообщение пользователю {friend_id}: {e}")
-                continue
+                # Если пользователь не онлайн, пропускаем его
+                if not online:
+                    skipped_count += 1
+                    metrics.inc("dm_deliveries_total", STATUS_SKIPPED)
+                    continue
+            recipients.append(friend_id)
+        callvoice_log.info(
+            "Рассылка о голосовом вызове",
+            extra={**log_fields, "mode": режим, "recipients": len(recipients), "skipped": skipped_count}
+        )
         
-        # Отправка результата
-        if режим == "Онлайн":
-            result_message = f"Уведомление о голосовом вызове отправлено {sent_count} друзьям, которые сейчас онлайн. {skipped_count} пользователей пропущено (не в сети)."
-            
-            # Добавляем отладочную информацию, если есть проблемы
-            if sent_count == 0 and skipped_count > 0:
-                # Ограничиваем количество строк в сообщении, чтобы не превысить лимит
-                debug_info = "\n\nОтладочная информация о статусах (до 15 строк):\n" + "\n".join(status_info[:15])
-                if len(status_info) > 15:
-                    debug_info += f"\n...и еще {len(status_info) - 15} строк"
-                
-                result_message += debug_info
-            
-            await inter.edit_original_message(content=result_message)
-        else:
-            await inter.edit_original_message(content=f"Уведомление о голосовом вызове отправлено {sent_count} друзьям (всем в списке).")
+        # Вызов тратится, только если есть кому отправлять
+        # (одновременный вызов мог забрать последний токен после проверки)
+        if recipients:
+            retry_after = call_throttle.acquire(inter.author.id)
+            if retry_after:
+                await inter.edit_original_message(
+                    content=f"Команда на перезарядке. Попробуйте снова через {retry_after:.1f} секунд."
+                )
+                return
+        
+        # Повторный вызов вскоре после рассылки обновляет уже отправленные сообщения
+        record = call_throttle.recent(inter.author.id)
+        sent_messages = record.messages if record is not None else {}
+        if record is not None:
+            embed.description += "\n\nЗовет снова!"
+            embed.timestamp = disnake.utils.utcnow()
+        edited_count = sum(1 for friend_id in recipients if friend_id in sent_messages)
+        
+        # Кнопка голосового канала, если пользователь находится в голосовом канале
+        payload = {
+            "embed": embed.to_dict(),
+            "voice_url": f"https://discord.com/channels/{inter.guild.id}/{voice_channel.id}" if voice_channel else None,
+        }
+        
+        def result_message(counts: Dict[str, int], queued: bool) -> str:
+            if queued:
+                message = f"Уведомление о голосовом вызове поставлено в очередь для {counts.get('pending', 0)} друзей"
+            else:
+                message = f"Уведомление о голосовом вызове отправлено {counts.get('sent', 0)} друзьям"
+            if режим == "Онлайн":
+                message += f", которые сейчас онлайн. {skipped_count} пользователей пропущено (не в сети)."
+            else:
+                message += " (всем в списке)."
+            if edited_count:
+                # Повторный вызов в окне объединения: часть сообщений обновлена, а не отправлена заново
+                message += f" Обновляются ранее отправленные: {edited_count}."
+            if counts.get("blocked"):
+                message += f" Закрыты личные сообщения: {counts['blocked']}."
+            if counts.get("failed"):
+                message += f" Не удалось доставить: {counts['failed']}."
+            return message
+        
+        def remember_message(friend_id: int, status: str, target):
+            if target is not None and record is not None:
+                record.messages[friend_id] = target
+        
+        async def report_progress(counts: Dict[str, int], total: int):
+            # Ход рассылки по мере отправки пачек
+            await inter.edit_original_message(
+                content=f"Отправка уведомлений: {counts.get('sent', 0)} из {total}..."
+            )
+        
+        async def report_done(counts: Dict[str, int]):
+            # Итог рассылки в отложенном ответе (токен взаимодействия живет 15 минут)
+            await inter.edit_original_message(content=result_message(counts, queued=False))
+        
+        # Рассылка уходит в постоянную очередь; отправляет ее фоновая задача
+        statuses = await notification_outbox.enqueue(
+            inter.author.id,
+            payload,
+            [(friend_id, sent_messages.get(friend_id)) for friend_id in recipients],
+            on_result=remember_message,
+            on_done=report_done,
+            on_progress=report_progress
+        )
+        
+        counts: Dict[str, int] = {}
+        for status in statuses.values():
+            counts[status] = counts.get(status, 0) + 1
+        if counts.get("pending"):
+            # Окно объединения открывается, только когда рассылка действительно ушла в очередь
+            # (до первого await, поэтому фоновая отправка уже видит запись)
+            if record is None:
+                record = call_throttle.start(inter.author.id)
+            await inter.edit_original_message(content=result_message(counts, queued=True))
 
     @commands.slash_command(
         name="whoisplaying",
@@ -442,7 +1325,7 @@ class FriendCommands(commands.Cog):
         user_id = str(inter.author.id)
         
         # Получение списка друзей пользователя
-        if user_id not in self.friend_data or not self.friend_data[user_id]:
+        if not self.friend_graph.count(user_id):
             await inter.response.send_message("Ваш список друзей пуст.", ephemeral=True)
             return
         
@@ -454,136 +1337,95 @@ class FriendCommands(commands.Cog):
         online_friends = []  # Друзья в сети, но не играющие
         offline_friends = []  # Друзья не в сети
         
-        # Проходим по всем друзьям из списка
-        for friend_id in self.friend_data[user_id]:
-            try:
-                friend_user = await bot.fetch_user(int(friend_id))
-                friend_name = friend_user.name
-                friend_avatar = friend_user.display_avatar.url
-                
-                # Флаг, чтобы отслеживать, найден ли пользователь хотя бы на одном сервере
-                found_on_server = False
-                playing_game = False
-                
-                # Проверяем статус друга на всех серверах, где есть бот
-                for guild in bot.guilds:
-                    member = guild.get_member(int(friend_id))
-                    if member:
-                        found_on_server = True
-                        
-                        # Проверяем, в сети ли пользователь
-                        if member.status != disnake.Status.offline:
-                            # Проверяем, играет ли пользователь в игру
-                            if member.activity and (member.activity.type == disnake.ActivityType.playing or member.activity.type == disnake.ActivityType.streaming):
-                                game_name = member.activity.name
-                                playing_game = True
-                                
-                                # Добавляем игру и друга в словарь
-                                if game_name not in games_dict:
-                                    games_dict[game_name] = []
-                                
-                                games_dict[game_name].append({
-                                    "name": friend_name,
-                                    "id": friend_id,
-                                    "avatar": friend_avatar,
-                                    "status": str(member.status),
-                                    "activity_details": member.activity.details if hasattr(member.activity, "details") and member.activity.details else None
-                                })
-                                
-                                # Останавливаем цикл после нахождения играющего друга
-                                break
-                            else:
-                                # Если друг в сети, но не играет, добавляем в список онлайн
-                                online_friends.append({
-                                    "name": friend_name,
-                                    "id": friend_id,
-                                    "avatar": friend_avatar,
-                                    "status": str(member.status)
-                                })
-                                # Останавливаем цикл после нахождения друга в сети
-                                break
-                
-                # Если пользователь найден на сервере, но не играет и не в онлайн-списке
-                if found_on_server and not playing_game and not any(f["id"] == friend_id for f in online_friends):
-                    # Добавляем в список оффлайн
-                    offline_friends.append({
-                        "name": friend_name,
-                        "id": friend_id,
-                        "avatar": friend_avatar
-                    })
-                
-                # Если пользователь не найден ни на одном сервере
-                if not found_on_server:
-                    offline_friends.append({
-                        "name": friend_name,
+        def friend_name(friend_id, entry):
+            # Имя берем из кэша участников или пользователей, без REST-запросов
+            member = entry.any_member() if entry is not None else None
+            if member is not None:
+                return member.name
+            cached = user_resolver.peek(friend_id)
+            return cached.name if cached else f"<@{friend_id}>"
+        
+        # Пересекаем индекс игр с друзьями пользователя
+        friend_ids = self.friend_graph.friend_set(user_id)
+        for game_name, player_ids in presence_index.games_of(friend_ids).items():
+            players = games_dict[game_name] = []
+            for friend_id in player_ids:
+                entry = presence_index.get(friend_id)
+                activity = entry.games[game_name]
+                players.append({
+                    "name": friend_name(friend_id, entry),
+                    "id": friend_id,
+                    "status": str(entry.status),
+                    "activity_details": getattr(activity, "details", None) or None
+                })
+        
+        for friend_id in friend_ids:
+            entry = presence_index.get(friend_id)
+            if entry is not None and entry.is_online:
+                if not entry.games:
+                    # Если друг в сети, но не играет, добавляем в список онлайн
+                    online_friends.append({
+                        "name": friend_name(friend_id, entry),
                         "id": friend_id,
-                        "avatar": friend_avatar
+                        "status": str(entry.status)
                     })
-                
-            except Exception as e:
-                print(f"Ошибка при получении информации о пользователе {friend_id}: {e}")
-                continue
+            else:
+                # Друг не в сети или не найден ни на одном общем сервере
+                offline_friends.append({
+                    "name": friend_name(friend_id, entry),
+                    "id": friend_id
+                })
         
         # Создаем эмбед с результатами
         embed = disnake.Embed(
             title="Во что играют ваши друзья",
             color=disnake.Color.blurple(),
-            description=f"Всего друзей: {len(self.friend_data[user_id])}" if self.friend_data[user_id] else "У вас нет друзей в списке."
-        )
-        
-        # Добавляем поля для каждой игры
-        if games_dict:
-            for game_name, players in games_dict.items():
-                # Формируем список игроков для данной игры
-                players_text = ""
-                for player in players:
-                    status_emoji = "🟢" if player["status"] == "online" else "🟡" if player["status"] == "idle" else "🔴" if player["status"] == "dnd" else "🟣" if player["status"] == "streaming" else "⚪"
-                    details = f" • {player['activity_details']}" if player["activity_details"] else ""
-                    players_text += f"{status_emoji} {player['name']}{details}\n"
-                
-                # Добавляем поле с названием игры и списком игроков
-                embed.add_field(
-                    name=f"🎮 {game_name} ({len(players)})",
-                    value=players_text,
-                    inline=False
-                )
-        else:
-            embed.add_field(
-                name="🎮 Никто не играет",
-                value="В данный момент никто из ваших друзей не играет.",
-                inline=False
-            )
+            description=f"Всего друзей: {len(friend_ids)}" if friend_ids else "У вас нет друзей в списке."
+        )
+        
+        def status_emoji(status):
+            return "🟢" if status == "online" else "🟡" if status == "idle" else "🔴" if status == "dnd" else "🟣" if status == "streaming" else "⚪"
+        
+        # Поля-списки: (заголовок, строки)
+        sections: List[Tuple[str, List[str]]] = []
+        for game_name, players in games_dict.items():
+            lines = []
+            for player in players:
+                details = f" • {player['activity_details']}" if player["activity_details"] else ""
+                lines.append(f"{status_emoji(player['status'])} {player['name']}{details}")
+            sections.append((f"🎮 {game_name} ({len(players)})", lines))
+        
+        # Discord принимает не больше 25 полей: два оставляем под "В сети" и "Не в сети",
+        # лишние игры сворачиваем в одно поле
+        max_games = EMBED_MAX_FIELDS - 2
+        if len(sections) > max_games:
+            hidden = sections[max_games - 1:]
+            sections = sections[:max_games - 1]
+            sections.append((f"🎮 И еще {len(hidden)} игр", [title for title, _ in hidden]))
         
-        # Добавляем поле с друзьями в сети, но не играющими
+        if not games_dict:
+            sections.append(("🎮 Никто не играет", ["В данный момент никто из ваших друзей не играет."]))
+        
+        # Друзья в сети, но не играющие
         if online_friends:
-            online_text = ""
-            for friend in online_friends:
-                status_emoji = "🟢" if friend["status"] == "online" else "🟡" if friend["status"] == "idle" else "🔴" if friend["status"] == "dnd" else "🟣" if friend["status"] == "streaming" else "⚪"
-                online_text += f"{status_emoji} {friend['name']}\n"
-            
-            embed.add_field(
-                name=f"💻 В сети ({len(online_friends)})",
-                value=online_text,
-                inline=False
-            )
+            sections.append((
+                f"💻 В сети ({len(online_friends)})",
+                [f"{status_emoji(friend['status'])} {friend['name']}" for friend in online_friends]
+            ))
         
-        # Добавляем поле с оффлайн друзьями (опциональное, можно ограничить)
-        if offline_friends and len(offline_friends) <= 10:  # Ограничиваем для компактности
-            offline_text = ""
-            for friend in offline_friends:
-                offline_text += f"⚫ {friend['name']}\n"
-            
-            embed.add_field(
-                name=f"💤 Не в сети ({len(offline_friends)})",
-                value=offline_text,
-                inline=False
-            )
+        # Друзья не в сети: поименно, только если их немного
+        if offline_friends and len(offline_friends) <= 10:
+            sections.append((
+                f"💤 Не в сети ({len(offline_friends)})",
+                [f"⚫ {friend['name']}" for friend in offline_friends]
+            ))
         elif offline_friends:
-            embed.add_field(
-                name=f"💤 Не в сети ({len(offline_friends)})",
-                value=f"Всего не в сети: {len(offline_friends)} друзей",
-                inline=False
-            )
+            sections.append((
+                f"💤 Не в сети ({len(offline_friends)})",
+                [f"Всего не в сети: {len(offline_friends)} друзей"]
+            ))
+        
+        add_list_fields(embed, sections)
         
         # Устанавливаем время обновления
         embed.set_footer(text=f"Обновлено: {disnake.utils.utcnow().strftime('%d.%m.%Y %H:%M:%S')} UTC")
@@ -595,27 +1437,29 @@ class FriendCommands(commands.Cog):
 class ScoreCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.score_data = load_score_data()
-        # Словарь для отслеживания покупок пользователей
-        self.purchases = {}
+        # Счета общие с начислением за войс, см. ScoreStore
+        self.score_data = score_store
+        # Покупки пользователей (общие для всех процессов, хранятся в базе)
+        self.shop = shop_engine
     
     def get_user_score(self, user_id: str) -> int:
         """Получить счет пользователя"""
-        return self.score_data.get(str(user_id), 0)
+        return self.score_data.get(user_id)
     
     def has_made_purchase(self, user_id: str, purchase_type: str) -> bool:
         """Проверить, совершил ли пользователь определенную покупку"""
-        if str(user_id) not in self.purchases:
-            return False
-        return purchase_type in self.purchases[str(user_id)]
+        return self.shop.has_purchased(user_id, purchase_type)
     
-    def add_purchase(self, user_id: str, purchase_type: str) -> None:
-        """Добавить запись о покупке пользователя"""
-        if str(user_id) not in self.purchases:
-            self.purchases[str(user_id)] = []
-        
-        if purchase_type not in self.purchases[str(user_id)]:
-            self.purchases[str(user_id)].append(purchase_type)
+    @staticmethod
+    def purchase_error(result: str, owned_message: str) -> str:
+        """Сообщение для покупки, которая не состоялась"""
+        if result == PURCHASE_OWNED:
+            return owned_message
+        if result == PURCHASE_INSUFFICIENT:
+            return "У вас недостаточно очков для этой покупки!"
+        if result == PURCHASE_DUPLICATE:
+            return "Эта покупка уже обработана. Повторить можно через несколько секунд."
+        return "Произошла ошибка при покупке, очки возвращены на ваш счет. Обратитесь к администратору."
     
     @commands.slash_command(
         name="score",
@@ -635,6 +1479,126 @@ class ScoreCommands(commands.Cog):
         
         await inter.response.send_message(embed=embed, ephemeral=True)
     
+    @commands.slash_command(
+        name="leaderboard",
+        description="Показать рейтинг пользователей по очкам",
+        guild_ids=GUILD_IDS
+    )
+    async def leaderboard(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        страница: int = commands.Param(description="Номер страницы рейтинга", default=1, ge=1)
+    ):
+        """Команда для просмотра рейтинга"""
+        page_count = leaderboard.page_count(LEADERBOARD_PAGE_SIZE)
+        page = min(страница, page_count)
+        rows = leaderboard.page(page, LEADERBOARD_PAGE_SIZE)
+        
+        embed = disnake.Embed(
+            title="Рейтинг по очкам",
+            color=disnake.Color.gold()
+        )
+        
+        if rows:
+            # Упоминания отображаются клиентом, запрашивать пользователей не нужно
+            embed.description = "\n".join(
+                f"**{position}.** <@{user_id}> — {score} очков" for position, user_id, score in rows
+            )
+        else:
+            embed.description = "В рейтинге пока никого нет."
+        
+        embed.set_footer(text=f"Страница {page} из {page_count} • Всего в рейтинге: {len(leaderboard)}")
+        
+        await inter.response.send_message(embed=embed, ephemeral=True)
+    
+    @commands.slash_command(
+        name="rank",
+        description="Показать место в рейтинге и процентиль",
+        guild_ids=GUILD_IDS
+    )
+    async def rank(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        участник: disnake.Member = commands.Param(description="Пользователь (по умолчанию - вы)", default=None)
+    ):
+        """Команда для просмотра места в рейтинге"""
+        target = участник or inter.author
+        position = leaderboard.rank(target.id)
+        
+        if position is None:
+            await inter.response.send_message(f"{target.mention} пока нет в рейтинге.", ephemeral=True)
+            return
+        
+        percentile = leaderboard.percentile(target.id)
+        embed = disnake.Embed(
+            title="Место в рейтинге",
+            description=(
+                f"{target.mention}: **{position}** место из {len(leaderboard)}\n"
+                f"Очков: {self.get_user_score(target.id)}\n"
+                f"Больше, чем у {percentile:.1f}% участников рейтинга"
+            ),
+            color=disnake.Color.gold()
+        )
+        
+        await inter.response.send_message(embed=embed, ephemeral=True)
+    
+    @staticmethod
+    def format_minutes(minutes: int) -> str:
+        if minutes < 60:
+            return f"{minutes} мин"
+        return f"{minutes // 60} ч {minutes % 60} мин"
+    
+    def format_voice_summary(self, summary: dict) -> str:
+        """Итоги ряда статистики войса и спарклайн за 30 дней"""
+        lines = [
+            f"Сегодня: **{self.format_minutes(summary['today'])}** • "
+            f"Неделя: **{self.format_minutes(summary['week'])}** • "
+            f"Месяц: **{self.format_minutes(summary['month'])}**",
+            f"За год: {self.format_minutes(summary['year'])} • Активных дней: {summary['active_days']}",
+        ]
+        if summary["best_day"]:
+            ago = summary["best_day_ago"]
+            when = "сегодня" if ago == 0 else f"{ago} дн. назад"
+            lines.append(f"Лучший день: {self.format_minutes(summary['best_day'])} ({when})")
+        lines.append(f"`{summary['spark']}`")
+        return "\n".join(lines)
+    
+    @commands.slash_command(
+        name="voicestats",
+        description="Показать время в голосовых каналах по дням",
+        guild_ids=GUILD_IDS
+    )
+    async def voicestats(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        участник: disnake.Member = commands.Param(description="Пользователь (по умолчанию - вы)", default=None)
+    ):
+        """Команда для просмотра статистики войса пользователя и сервера"""
+        target = участник or inter.author
+        now = time.time()
+        summary = voice_stats.summary(series_key(USER_SERIES, target.id), now)
+        
+        embed = disnake.Embed(
+            title="Время в голосовых каналах",
+            description=f"{target.mention}\n" + self.format_voice_summary(summary),
+            color=disnake.Color.blurple()
+        )
+        
+        if inter.guild is not None:
+            server = voice_stats.summary(series_key(GUILD_SERIES, inter.guild.id), now)
+            embed.add_field(
+                name=f"Сервер {inter.guild.name}",
+                value=(
+                    self.format_voice_summary(server) +
+                    f"\nВ среднем за день (месяц): {self.format_minutes(server['month'] // 30)}"
+                ),
+                inline=False
+            )
+        
+        embed.set_footer(text="Засчитанное время по правилам начисления очков • График за 30 дней")
+        
+        await inter.response.send_message(embed=embed, ephemeral=True)
+    
     @commands.slash_command(
         name="addscore",
         description="Добавить очки пользователю (только для администраторов)",
@@ -651,15 +1615,11 @@ class ScoreCommands(commands.Cog):
         user_id = str(участник.id)
         
         # Обновляем счет пользователя
-        if user_id not in self.score_data:
-            self.score_data[user_id] = 0
-        
-        self.score_data[user_id] += количество
-        save_score_data(self.score_data)
+        new_score = self.score_data.add(user_id, количество)
         
         embed = disnake.Embed(
             title="Очки добавлены",
-            description=f"Пользователю {участник.mention} добавлено {количество} очков.\nТекущий счет: {self.score_data[user_id]}",
+            description=f"Пользователю {участник.mention} добавлено {количество} очков.\nТекущий счет: {new_score}",
             color=disnake.Color.green()
         )
         
@@ -680,21 +1640,12 @@ class ScoreCommands(commands.Cog):
         """Команда для удаления очков у пользователя"""
         user_id = str(участник.id)
         
-        # Проверяем наличие пользователя в данных
-        if user_id not in self.score_data:
-            self.score_data[user_id] = 0
-        
-        # Проверяем, чтобы счет не стал отрицательным
-        if self.score_data[user_id] < количество:
-            self.score_data[user_id] = 0
-        else:
-            self.score_data[user_id] -= количество
-        
-        save_score_data(self.score_data)
+        # Списываем очки так, чтобы счет не стал отрицательным
+        new_score = self.score_data.subtract(user_id, количество)
         
         embed = disnake.Embed(
             title="Очки удалены",
-            description=f"У пользователя {участник.mention} удалено {количество} очков.\nТекущий счет: {self.score_data[user_id]}",
+            description=f"У пользователя {участник.mention} удалено {количество} очков.\nТекущий счет: {new_score}",
             color=disnake.Color.red()
         )
         
@@ -754,6 +1705,7 @@ class ScoreCommands(commands.Cog):
         await inter.response.send_message(embed=embed, view=view, ephemeral=True)
     
     @commands.Cog.listener("on_button_click")
+    @metrics.timed("on_shop_button_click")
     async def on_shop_button_click(self, inter: disnake.MessageInteraction):
         """Обработчик нажатия на кнопки магазина"""
         user_id = str(inter.author.id)
@@ -788,22 +1740,19 @@ class ScoreCommands(commands.Cog):
                 await inter.response.send_message("У вас нет роли, которую можно повысить!", ephemeral=True)
                 return
             
-            try:
+            async def change_roles():
                 # Удаляем старую роль и добавляем новую
                 await member.remove_roles(old_role)
                 await member.add_roles(new_role)
-                
-                # Списываем очки
-                self.score_data[user_id] -= 10000
-                save_score_data(self.score_data)
-                
-                # Записываем покупку
-                self.add_purchase(user_id, "promotion")
-                
-                await inter.response.send_message(f"Поздравляем! Вы успешно приобрели повышение роли. С вашего счета списано 10000 очков.", ephemeral=True)
-            except Exception as e:
-                print(f"Ошибка при изменении ролей: {e}")
-                await inter.response.send_message("Произошла ошибка при изменении ролей. Обратитесь к администратору.", ephemeral=True)
+            
+            # Очки списываются до изменения ролей и возвращаются при ошибке;
+            # повторные нажатия в течение нескольких секунд - одна покупка
+            await inter.response.defer(ephemeral=True)
+            result = await self.shop.purchase(user_id, "promotion", 10000, change_roles)
+            if result == PURCHASE_COMPLETED:
+                await inter.edit_original_message(content="Поздравляем! Вы успешно приобрели повышение роли. С вашего счета списано 10000 очков.")
+            else:
+                await inter.edit_original_message(content=self.purchase_error(result, "Вы уже приобрели это повышение!"))
         
         elif inter.component.custom_id == "buy_custom_role":
             # Покупка кастомной роли
@@ -841,6 +1790,7 @@ class ScoreCommands(commands.Cog):
             await inter.response.send_modal(modal)
     
     @commands.Cog.listener("on_modal_submit")
+    @metrics.timed("on_custom_role_modal_submit")
     async def on_custom_role_modal_submit(self, inter: disnake.ModalInteraction):
         """Обработчик отправки формы для создания кастомной роли"""
         if inter.custom_id == "custom_role_modal":
@@ -872,7 +1822,7 @@ class ScoreCommands(commands.Cog):
                 # Если цвет не указан, используем случайный
                 color = random.randint(0, 0xFFFFFF)
             
-            try:
+            async def create_custom_role():
                 # Создаем новую роль
                 new_role = await inter.guild.create_role(
                     name=role_name,
@@ -880,20 +1830,140 @@ class ScoreCommands(commands.Cog):
                     reason=f"Кастомная роль для {inter.author.name} (ID: {user_id})"
                 )
                 
-                # Добавляем роль пользователю
-                await inter.author.add_roles(new_role)
-                
-                # Списываем очки
-                self.score_data[user_id] -= 2500
-                save_score_data(self.score_data)
-                
-                # Записываем покупку
-                self.add_purchase(user_id, "custom_role")
-                
-                await inter.response.send_message(f"Поздравляем! Вы успешно создали кастомную роль **{role_name}**. С вашего счета списано 2500 очков.", ephemeral=True)
-            except Exception as e:
-                print(f"Ошибка при создании кастомной роли: {e}")
-                await inter.response.send_message("Произошла ошибка при создании кастомной роли. Обратитесь к администратору.", ephemeral=True)
+                # Добавляем роль пользователю; если не вышло - не оставляем роль-сироту
+                try:
+                    await inter.author.add_roles(new_role)
+                except Exception:
+                    try:
+                        await new_role.delete(reason="Покупка кастомной роли не удалась")
+                    except disnake.HTTPException:
+                        pass
+                    raise
+            
+            await inter.response.defer(ephemeral=True)
+            result = await self.shop.purchase(user_id, "custom_role", 2500, create_custom_role)
+            if result == PURCHASE_COMPLETED:
+                await inter.edit_original_message(content=f"Поздравляем! Вы успешно создали кастомную роль **{role_name}**. С вашего счета списано 2500 очков.")
+            else:
+                await inter.edit_original_message(content=self.purchase_error(result, "Вы уже приобрели кастомную роль!"))
+
+# Команды для просмотра метрик бота
+class StatsCommands(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+    
+    @staticmethod
+    def format_latencies(name: str, limit: int = 8) -> str:
+        """Строки вида 'команда: N вызовов, p50/p99' для гистограмм задержек"""
+        histograms = sorted(metrics.histograms[name].items(), key=lambda item: item[1].count, reverse=True)[:limit]
+        if not histograms:
+            return "Нет данных"
+        return "\n".join(
+            f"`{label}`: {h.count} • p50 {h.quantile(0.5) * 1000:.0f} мс • p99 {h.quantile(0.99) * 1000:.0f} мс"
+            for label, h in histograms
+        )
+    
+    @staticmethod
+    def format_counter(name: str, limit: int = 8) -> str:
+        rows = metrics.top(name, limit)
+        if not rows:
+            return "Нет данных"
+        return "\n".join(f"`{label or '-'}`: {value}" for label, value in rows)
+    
+    @staticmethod
+    def format_shards() -> str:
+        """Строки вида 'шард N: готов/отключен, задержка, серверов'"""
+        guild_counts = {}
+        for guild in bot.guilds:
+            guild_counts[guild.shard_id] = guild_counts.get(guild.shard_id, 0) + 1
+        lines = []
+        for shard_id, latency in sorted(shard_latencies()):
+            if shard_id in disconnected_shards:
+                state = "🔴 отключен"
+            elif shard_id in shard_ready_at:
+                state = "🟢 готов"
+            else:
+                state = "🟡 запускается"
+            latency_text = f"{latency * 1000:.0f} мс" if math.isfinite(latency) else "—"
+            lines.append(f"`{shard_id}`: {state} • {latency_text} • серверов: {guild_counts.get(shard_id, 0)}")
+        return "\n".join(lines[:20]) or "Нет данных"
+    
+    @commands.slash_command(
+        name="botstats",
+        description="Показать метрики работы бота (только для администраторов)",
+        guild_ids=GUILD_IDS
+    )
+    @commands.has_permissions(administrator=True)
+    async def botstats(self, inter: disnake.ApplicationCommandInteraction):
+        """Команда для просмотра метрик бота"""
+        uptime = int(time.time() - metrics.started_at)
+        embed = disnake.Embed(
+            title="Статистика бота",
+            description=f"Аптайм: {uptime // 3600} ч {uptime % 3600 // 60} мин • Задержка шлюза: {bot.latency * 1000:.0f} мс",
+            color=disnake.Color.dark_teal()
+        )
+        
+        embed.add_field(name="Команды", value=self.format_latencies("command_latency_seconds"), inline=False)
+        embed.add_field(name="Обработчики событий", value=self.format_latencies("handler_latency_seconds"), inline=False)
+        embed.add_field(name="REST-запросы", value=self.format_counter("rest_requests_total"), inline=False)
+        
+        ratelimited = sum(metrics.counters["rest_ratelimited_total"].values())
+        errors = sum(metrics.counters["rest_errors_total"].values())
+        embed.add_field(name="Ошибки REST", value=f"429: {ratelimited} • Прочие: {errors}", inline=False)
+        embed.add_field(name="События шлюза", value=self.format_counter("gateway_events_total", 6), inline=False)
+        if SHARDED:
+            embed.add_field(name="Шарды", value=self.format_shards(), inline=False)
+        
+        gauges = metrics.collect_gauges()
+        startup = gauges.get("startup", {})
+        startup_line = f"Готов за {startup.get('ready_seconds', 0):.1f} с"
+        if "members_loaded_seconds" in startup:
+            startup_line += f" • Друзья загружены за {startup['members_loaded_seconds']:.1f} с"
+        embed.add_field(
+            name=f"Запуск ({CHUNK_STRATEGY})",
+            value=(
+                f"{startup_line}\n"
+                f"Участников в кэше: {startup.get('cached_members', 0)} • RSS: {startup.get('rss_bytes', 0) / 2 ** 20:.0f} МиБ"
+            ),
+            inline=False
+        )
+        cache = gauges.get("user_cache", {})
+        scores = gauges.get("score_store", {})
+        writes = gauges.get("persistence", {})
+        embed.add_field(
+            name="Кэш пользователей",
+            value=f"Попаданий: {cache.get('hit_ratio', 0) * 100:.1f}% • Промахов: {cache.get('misses', 0)} • В кэше: {cache.get('cached', 0)}",
+            inline=False
+        )
+        embed.add_field(
+            name="Хранилище",
+            value=(
+                f"Очередь счетов: {scores.get('queue_depth', 0)} • Записей: {scores.get('flushes', 0)} • "
+                f"Последняя: {scores.get('last_flush_ms', 0):.1f} мс • Макс.: {scores.get('max_flush_ms', 0):.1f} мс\n"
+                f"Очередь записи: {writes.get('queue_depth', 0)} • Ошибок: {writes.get('failed', 0)}"
+            ),
+            inline=False
+        )
+        
+        await inter.response.send_message(embed=embed, ephemeral=True)
+
+    @commands.slash_command(
+        name="resynccommands",
+        description="Принудительно синхронизировать слэш-команды (только для администраторов)",
+        guild_ids=GUILD_IDS
+    )
+    @commands.has_permissions(administrator=True)
+    async def resynccommands(self, inter: disnake.ApplicationCommandInteraction):
+        """Перезаписать команды во всех областях, не глядя на сохраненный хэш"""
+        await inter.response.defer(ephemeral=True)
+        started = time.perf_counter()
+        synced = await sync_changed_commands(force=True)
+        await inter.edit_original_message(
+            content=(
+                f"Команды синхронизированы за {time.perf_counter() - started:.1f} с. "
+                f"Области: {', '.join(sorted(synced)) or 'нет'}"
+            )
+        )
 
 # Обработка ошибок
 @bot.event
@@ -909,8 +1979,17 @@ async def on_slash_command_error(inter: disnake.ApplicationCommandInteraction, e
             ephemeral=True
         )
     else:
+        metrics.inc("command_errors_total", inter.application_command.qualified_name)
         # Логирование других ошибок
-        print(f"Ошибка при выполнении команды: {error}")
+        commands_log.error(
+            "Ошибка при выполнении команды",
+            exc_info=(type(error), error, error.__traceback__),
+            extra={
+                "command": inter.application_command.qualified_name,
+                "user_id": inter.author.id,
+                "guild_id": inter.guild_id,
+            }
+        )
         await inter.response.send_message(
             "Произошла ошибка при выполнении команды. Попробуйте позже или обратитесь к администратору.",
             ephemeral=True
@@ -919,7 +1998,28 @@ async def on_slash_command_error(inter: disnake.ApplicationCommandInteraction, e
 # Регистрация когов
 bot.add_cog(FriendCommands(bot))
 bot.add_cog(ScoreCommands(bot))
+bot.add_cog(StatsCommands(bot))
 
 # Запуск бота
 if __name__ == "__main__":
-    bot.run(TOKEN)
+    try:
+        bot.run(TOKEN)
+    finally:
+        # Дожидаемся фоновых записей и сохраняем оставшиеся изменения счетов
+        persistence.close()
+        if voice_ledger_live:
+            # Досчитать время в войсе до остановки
+            guilds = {}
+            credit_voice_points(voice_ledger.tick(guilds=guilds), guilds)
+        score_store.flush()
+        pending = voice_stats.take_pending()
+        if pending:
+            storage.add_voice_minutes(pending)
+        if voice_ledger_restored:
+            if voice_ledger_live:
+                voice_ledger.mark_confirmed()
+            storage.save_voice_sessions(
+                voice_ledger.snapshot(), voice_ledger.confirmed_at or time.time(), voice_ledger.leftovers()
+            )
+        storage.close()
+        log_pipeline.stop()
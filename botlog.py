@@ -0,0 +1,135 @@
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
+
+# Корневой логгер бота; категории - дочерние логгеры ("bot.callvoice", "bot.voice", ...)
+ROOT_LOGGER = "bot"
+
+# Атрибуты, которые есть у любой записи; все остальное - поля из extra
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+def get_logger(category: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{category}")
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON: время, уровень, категория, сообщение и поля из extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "category": record.name[len(ROOT_LOGGER) + 1:] or record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Не больше ``limit`` отладочных записей за ``per`` секунд на категорию.
+
+    Лишние записи отбрасываются, а их число добавляется полем ``suppressed``
+    к следующей пропущенной записи той же категории. Записи уровня INFO и
+    выше проходят всегда.
+    """
+
+    def __init__(self, limit: int = 20, per: float = 1.0):
+        super().__init__()
+        self.limit = limit
+        self.per = per
+        # Категория -> (начало окна, записей в окне, отброшено)
+        self._windows: Dict[str, Tuple[float, int, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        now = record.created
+        started, count, suppressed = self._windows.get(record.name, (now, 0, 0))
+        if now - started >= self.per:
+            started, count = now, 0
+        if count >= self.limit:
+            self._windows[record.name] = (started, count, suppressed + 1)
+            return False
+        if suppressed:
+            record.suppressed = suppressed
+        self._windows[record.name] = (started, count + 1, 0)
+        return True
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Кладет запись в очередь как есть: форматирование - в потоке слушателя.
+
+    Если очередь переполнена, запись отбрасывается (и учитывается), а не
+    задерживает обработчик события.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """Очередь записей и фоновый поток, который пишет их в stdout или файл"""
+
+    def __init__(self, handler: _NonBlockingQueueHandler, listener: QueueListener):
+        self.handler = handler
+        self.listener = listener
+
+    def stop(self) -> None:
+        """Дописать оставшиеся записи и остановить поток"""
+        self.listener.stop()
+
+    def stats(self) -> Dict[str, float]:
+        return {"queue_depth": self.handler.queue.qsize(), "dropped": self.handler.dropped}
+
+
+def setup_logging(
+    level: str = "INFO",
+    levels: Optional[Dict[str, str]] = None,
+    sample_limit: int = 20,
+    sample_per: float = 1.0,
+    log_file: Optional[str] = None,
+    max_queue: int = 10000,
+) -> LogPipeline:
+    """Настроить логгер бота: JSON-строки через очередь и отдельный поток записи.
+
+    level - уровень по умолчанию, levels - уровни отдельных категорий,
+    например {"callvoice": "DEBUG"}.
+    """
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level.upper())
+    root.propagate = False
+    for category, category_level in (levels or {}).items():
+        get_logger(category).setLevel(category_level.upper())
+
+    output = logging.FileHandler(log_file, encoding="utf-8") if log_file else logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    log_queue: queue.Queue = queue.Queue(maxsize=max_queue)
+    handler = _NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(sample_limit, sample_per))
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return LogPipeline(handler, listener)
@@ -0,0 +1,73 @@
+import hashlib
+import json
+from typing import Dict, List, Tuple
+
+# Ключ области глобальных команд (остальные области - ID серверов)
+GLOBAL_SCOPE = "global"
+
+
+def _ordered_commands(bot) -> Dict[str, list]:
+    """Зарегистрированные команды по областям: "global" или ID сервера -> тела команд.
+
+    Берутся из публичного ``bot.application_commands``: команда с guild_ids
+    попадает в каждый из этих серверов, без них - в глобальные.
+    """
+    scopes: Dict[str, list] = {GLOBAL_SCOPE: []}
+    for command in bot.application_commands:
+        if command.guild_ids:
+            for guild_id in command.guild_ids:
+                scopes.setdefault(str(guild_id), []).append(command.body)
+        else:
+            scopes[GLOBAL_SCOPE].append(command.body)
+    return scopes
+
+
+def command_signatures(bot) -> Dict[str, str]:
+    """Хэш команд каждой области: названия, параметры, варианты выбора и права.
+
+    Тела команд сериализуются с сортировкой ключей и упорядочиваются по типу
+    и названию, поэтому хэш не зависит от порядка регистрации когов.
+    """
+    signatures = {}
+    for scope, cmds in _ordered_commands(bot).items():
+        bodies = sorted(
+            (json.dumps(cmd.to_dict(), sort_keys=True, ensure_ascii=False) for cmd in cmds)
+        )
+        signatures[scope] = hashlib.sha256("\n".join(bodies).encode()).hexdigest()
+    return signatures
+
+
+async def sync_commands(
+    bot,
+    stored: Dict[str, str],
+    force: bool = False,
+) -> Tuple[Dict[str, str], List[str]]:
+    """Перезаписать команды в областях, хэш которых изменился (или во всех при force).
+
+    Области, которых больше нет в коде (сервер убран из GUILD_IDS), очищаются.
+    Возвращает новые хэши (только успешно синхронизированных областей
+    и неизменных) и список синхронизированных областей.
+    """
+    scopes = _ordered_commands(bot)
+    current = command_signatures(bot)
+    result: Dict[str, str] = {}
+    synced: List[str] = []
+    for scope in set(current) | set(stored):
+        signature = current.get(scope)
+        if not force and signature is not None and stored.get(scope) == signature:
+            result[scope] = signature
+            continue
+        cmds = scopes.get(scope, [])
+        try:
+            if scope == GLOBAL_SCOPE:
+                await bot.bulk_overwrite_global_commands(cmds)
+            else:
+                await bot.bulk_overwrite_guild_commands(int(scope), cmds)
+        except Exception as e:
+            print(f"Не удалось синхронизировать команды ({scope}): {e}")
+            # Старый хэш не сохраняем - повторим при следующем запуске
+            continue
+        synced.append(scope)
+        if signature is not None:
+            result[scope] = signature
+    return result, synced
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+import aiohttp
+import disnake
+
+# Статусы доставки для отчета
+STATUS_SENT = "sent"
+STATUS_SKIPPED = "skipped"
+STATUS_FAILED = "failed"
+
+
+@dataclass
+class DeliveryResult:
+    """Результат доставки одному получателю"""
+    recipient_id: int
+    status: str
+    attempts: int = 0
+    error: Optional[str] = None
+    # Подробности последней ошибки: HTTP-статус, код ошибки Discord,
+    # retry_after для 429 и можно ли повторить отправку позже
+    http_status: Optional[int] = None
+    code: Optional[int] = None
+    retry_after: Optional[float] = None
+    retryable: bool = False
+
+
+@dataclass
+class DeliveryReport:
+    """Отчет о рассылке по всем получателям"""
+    results: Dict[int, DeliveryResult] = field(default_factory=dict)
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+
+    def add(self, result: DeliveryResult) -> None:
+        self.results[result.recipient_id] = result
+
+    def count(self, status: str) -> int:
+        return sum(1 for r in self.results.values() if r.status == status)
+
+    @property
+    def sent(self) -> int:
+        return self.count(STATUS_SENT)
+
+    @property
+    def skipped(self) -> int:
+        return self.count(STATUS_SKIPPED)
+
+    @property
+    def failed(self) -> int:
+        return self.count(STATUS_FAILED)
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+
+def get_retry_after(error: disnake.HTTPException) -> float:
+    """Достать retry_after из ответа 429 (заголовок или тело ответа)"""
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        headers = getattr(error.response, "headers", None) or {}
+        retry_after = headers.get("Retry-After") or headers.get("X-RateLimit-Reset-After")
+    try:
+        return max(float(retry_after), 0.0)
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class FanOutDispatcher:
+    """Параллельная рассылка с ограничением конкурентности и учетом лимитов Discord.
+
+    Одновременно выполняется не больше ``concurrency`` отправок, каждому
+    получателю - одна попытка. Повторы планирует вызывающий (очередь
+    уведомлений) по полям ``retryable`` и ``retry_after`` результата. Если
+    Discord отвечает 429, рассылка приостанавливается на ``retry_after``:
+    создание DM-канала идет через общий для всех получателей маршрут, поэтому
+    получатели, до которых дошла очередь во время лимита, сразу возвращаются
+    с оставшимся ``retry_after`` без попытки отправки.
+    """
+
+    def __init__(self, concurrency: int = 8, progress_interval: float = 1.0):
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        # До этого момента (time.monotonic) отправки приостановлены после 429
+        self._resume_at = 0.0
+
+    async def _deliver(self, recipient_id: int, send: Callable[[int], Awaitable[Any]]) -> DeliveryResult:
+        result = DeliveryResult(recipient_id=recipient_id, status=STATUS_FAILED)
+        wait = self._resume_at - time.monotonic()
+        if wait > 0:
+            # Лимит еще действует - отправку отложит вызывающий
+            result.error = "rate limited"
+            result.retryable = True
+            result.retry_after = wait
+            return result
+        result.attempts = 1
+        try:
+            await send(recipient_id)
+            result.status = STATUS_SENT
+        except disnake.HTTPException as e:
+            result.error = f"{e.status}: {e.text}" if e.text else str(e.status)
+            result.http_status = e.status
+            result.code = e.code
+            # 429 и 5xx - временные ошибки; 403 (закрытые ЛС), 404 и прочее повторять смысла нет
+            result.retryable = e.status == 429 or e.status >= 500
+            if e.status == 429:
+                result.retry_after = get_retry_after(e)
+                self._resume_at = max(self._resume_at, time.monotonic() + result.retry_after)
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            # Сетевые ошибки - временные
+            result.error = str(e) or type(e).__name__
+            result.retryable = True
+        except Exception as e:
+            result.error = str(e)
+        return result
+
+    async def dispatch(
+        self,
+        recipient_ids: Iterable[int],
+        send: Callable[[int], Awaitable[Any]],
+        report: Optional[DeliveryReport] = None,
+        on_progress: Optional[Callable[[DeliveryReport, int], Awaitable[Any]]] = None,
+    ) -> DeliveryReport:
+        """Разослать сообщения всем получателям.
+
+        ``send`` получает ID получателя и выполняет саму отправку.
+        ``on_progress`` вызывается не чаще раза в ``progress_interval`` секунд
+        и получает текущий отчет и общее количество получателей.
+        """
+        recipients: List[int] = list(recipient_ids)
+        if report is None:
+            report = DeliveryReport()
+        total = len(recipients) + len(report.results)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        last_progress = 0.0
+
+        async def worker(recipient_id: int) -> None:
+            nonlocal last_progress
+            async with semaphore:
+                report.add(await self._deliver(recipient_id, send))
+            if on_progress is not None:
+                now = time.monotonic()
+                if now - last_progress >= self.progress_interval:
+                    last_progress = now
+                    try:
+                        await on_progress(report, total)
+                    except Exception as e:
+                        print(f"Не удалось обновить прогресс рассылки: {e}")
+
+        await asyncio.gather(*(worker(recipient_id) for recipient_id in recipients))
+        report.finished_at = time.monotonic()
+        return report
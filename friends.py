@@ -0,0 +1,117 @@
+from typing import AbstractSet, Callable, Dict, List, Set
+
+
+class FriendGraph:
+    """Граф «пользователь -> его друзья» с обратным индексом «у кого я в друзьях».
+
+    ID хранятся как int. Список друзей - dict без значений: это множество
+    с проверкой за O(1), которое при этом сохраняет порядок добавления
+    (он виден пользователю в /friendlist).
+    """
+
+    def __init__(self):
+        self._friends: Dict[int, Dict[int, None]] = {}
+        self._followers: Dict[int, Set[int]] = {}
+        self._edges = 0
+        # Подписчики на изменения: listener(ID владельца, ID друга, добавлен ли)
+        self._listeners: List[Callable[[int, int, bool], None]] = []
+
+    def add_listener(self, listener: Callable[[int, int, bool], None]) -> None:
+        self._listeners.append(listener)
+
+    def _notify(self, user_id: int, friend_id: int, added: bool) -> None:
+        for listener in self._listeners:
+            listener(user_id, friend_id, added)
+
+    def __len__(self) -> int:
+        """Общее количество связей"""
+        return self._edges
+
+    def friend_ids(self) -> AbstractSet[int]:
+        """Все пользователи, которые есть хотя бы в одном списке друзей (только для чтения)"""
+        return self._followers.keys()
+
+    def friends(self, user_id) -> List[int]:
+        """Список друзей пользователя в порядке добавления"""
+        return list(self._friends.get(int(user_id), ()))
+
+    def friend_set(self, user_id) -> AbstractSet[int]:
+        """Друзья пользователя как множество без копирования (только для чтения)"""
+        return self._friends.get(int(user_id), {}).keys()
+
+    def count(self, user_id) -> int:
+        return len(self._friends.get(int(user_id), ()))
+
+    def has(self, user_id, friend_id) -> bool:
+        return int(friend_id) in self._friends.get(int(user_id), ())
+
+    def followers(self, user_id) -> Set[int]:
+        """Пользователи, у которых user_id в списке друзей"""
+        return set(self._followers.get(int(user_id), ()))
+
+    def add(self, user_id, friend_id) -> bool:
+        """Добавить друга. Возвращает False, если он уже в списке"""
+        user_id, friend_id = int(user_id), int(friend_id)
+        friends = self._friends.setdefault(user_id, {})
+        if friend_id in friends:
+            return False
+        friends[friend_id] = None
+        self._followers.setdefault(friend_id, set()).add(user_id)
+        self._edges += 1
+        self._notify(user_id, friend_id, True)
+        return True
+
+    def remove(self, user_id, friend_id) -> bool:
+        """Удалить друга. Возвращает False, если его не было в списке"""
+        user_id, friend_id = int(user_id), int(friend_id)
+        friends = self._friends.get(user_id)
+        if friends is None or friend_id not in friends:
+            return False
+        del friends[friend_id]
+        if not friends:
+            del self._friends[user_id]
+        followers = self._followers[friend_id]
+        followers.discard(user_id)
+        if not followers:
+            del self._followers[friend_id]
+        self._edges -= 1
+        self._notify(user_id, friend_id, False)
+        return True
+
+    def remove_user(self, user_id) -> int:
+        """Удалить пользователя из графа целиком. Возвращает число удаленных связей"""
+        user_id = int(user_id)
+        removed = 0
+        for friend_id in self.friends(user_id):
+            removed += self.remove(user_id, friend_id)
+        for owner_id in self.followers(user_id):
+            removed += self.remove(owner_id, user_id)
+        return removed
+
+    def sync(self, data: Dict[str, List[str]]) -> None:
+        """Привести граф к данным хранилища, меняя только отличающиеся связи"""
+        target = {int(user_id): {int(friend_id) for friend_id in friend_ids} for user_id, friend_ids in data.items()}
+        for user_id in list(self._friends):
+            wanted = target.get(user_id, ())
+            for friend_id in self.friends(user_id):
+                if friend_id not in wanted:
+                    self.remove(user_id, friend_id)
+        for user_id, friend_ids in data.items():
+            for friend_id in friend_ids:
+                self.add(user_id, friend_id)
+
+    @classmethod
+    def from_json(cls, data: Dict[str, List[str]]) -> "FriendGraph":
+        """Построить граф из формата friends_data.json"""
+        graph = cls()
+        for user_id, friend_ids in data.items():
+            for friend_id in friend_ids:
+                graph.add(user_id, friend_id)
+        return graph
+
+    def to_json(self) -> Dict[str, List[str]]:
+        """Формат friends_data.json: {"user_id": ["friend_id", ...]}"""
+        return {
+            str(user_id): [str(friend_id) for friend_id in friends]
+            for user_id, friends in self._friends.items()
+        }
@@ -0,0 +1,64 @@
+from typing import Dict, List, Optional, Tuple
+
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+    """Рейтинг пользователей по очкам с инкрементальным обновлением.
+
+    Пары (-очки, ID) лежат в отсортированном списке, поэтому место
+    пользователя находится за O(log n), а страница - за O(log n + размер).
+    Пользователи с нулевым счетом в рейтинг не попадают.
+    """
+
+    def __init__(self, scores: Optional[Dict[str, int]] = None):
+        self._scores: Dict[int, int] = {}
+        self._order = SortedList()
+        if scores:
+            for user_id, score in scores.items():
+                self.update(user_id, score)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def update(self, user_id, score: int) -> None:
+        """Обновить счет пользователя в рейтинге"""
+        user_id = int(user_id)
+        old = self._scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self._order.remove((-old, user_id))
+            del self._scores[user_id]
+        if score > 0:
+            self._scores[user_id] = score
+            self._order.add((-score, user_id))
+
+    def rank(self, user_id) -> Optional[int]:
+        """Место пользователя (с 1) или None, если его нет в рейтинге"""
+        user_id = int(user_id)
+        score = self._scores.get(user_id)
+        if score is None:
+            return None
+        # Место считается по очкам: при равенстве у всех одно и то же место
+        return self._order.bisect_left((-score, 0)) + 1
+
+    def percentile(self, user_id) -> Optional[float]:
+        """Доля пользователей в рейтинге с меньшим счетом, в процентах"""
+        user_id = int(user_id)
+        score = self._scores.get(user_id)
+        if score is None:
+            return None
+        below = len(self._order) - self._order.bisect_right((-score, float("inf")))
+        return below * 100.0 / len(self._order)
+
+    def page(self, page: int, page_size: int = 10) -> List[Tuple[int, int, int]]:
+        """Страница рейтинга (с 1): список (место, ID пользователя, очки)"""
+        start = (page - 1) * page_size
+        result = []
+        for neg_score, user_id in self._order.islice(start, start + page_size):
+            result.append((self._order.bisect_left((neg_score, 0)) + 1, user_id, -neg_score))
+        return result
+
+    def page_count(self, page_size: int = 10) -> int:
+        return max((len(self._order) + page_size - 1) // page_size, 1)
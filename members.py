@@ -0,0 +1,155 @@
+import asyncio
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import disnake
+
+# Стратегии загрузки участников при запуске
+CHUNK_EAGER = "eager"  # все участники всех серверов (как раньше)
+CHUNK_LAZY = "lazy"    # только пользователи из списков друзей
+
+CHUNK_STRATEGIES = (CHUNK_EAGER, CHUNK_LAZY)
+
+# Discord отдает не больше 100 участников на один запрос по ID
+QUERY_LIMIT = 100
+
+
+class MemberLoader:
+    """Ленивая загрузка участников серверов по графу друзей.
+
+    Вместо выгрузки всех участников всех серверов при запуске бот
+    запрашивает через шлюз (``guild.query_members`` с присутствием) только
+    тех, кто есть в чьем-нибудь списке друзей. Найденные участники попадают
+    в кэш disnake и индекс статусов, а отсутствующие на сервере запоминаются
+    на ``absent_ttl`` секунд, чтобы переподключение не повторяло запросы.
+    Новые друзья подгружаются пачкой после небольшой задержки.
+    """
+
+    def __init__(
+        self,
+        graph,
+        presence_index,
+        guilds: Callable[[], Iterable[disnake.Guild]],
+        concurrency: int = 4,
+        absent_ttl: float = 6 * 3600.0,
+        debounce: float = 1.0,
+    ):
+        self._graph = graph
+        self._presence = presence_index
+        self._guilds = guilds
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.absent_ttl = absent_ttl
+        self.debounce = debounce
+        # ID сервера -> (когда проверяли, ID пользователей, которых там нет)
+        self._absent: Dict[int, Tuple[float, Set[int]]] = {}
+        # Новые друзья, которых еще предстоит поискать на серверах
+        self._pending: Set[int] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.requests = 0
+        self.found = 0
+        self.timeouts = 0
+        self.last_load_seconds = 0.0
+        # Подписчики на загруженных участников (например, индекс имен друзей)
+        self._listeners: List[Callable[[disnake.Member], None]] = []
+        graph.add_listener(self.on_friend_change)
+
+    def add_listener(self, listener: Callable[[disnake.Member], None]) -> None:
+        self._listeners.append(listener)
+
+    def _known_absent(self, guild_id: int, now: float) -> Set[int]:
+        checked = self._absent.get(guild_id)
+        if checked is None or now - checked[0] > self.absent_ttl:
+            checked = self._absent[guild_id] = (now, set())
+        return checked[1]
+
+    async def load_guild(self, guild: disnake.Guild, user_ids: Optional[Iterable[int]] = None) -> int:
+        """Загрузить участников сервера из списков друзей. Возвращает число найденных"""
+        if user_ids is None:
+            user_ids = self._graph.friend_ids()
+        absent = self._known_absent(guild.id, time.time())
+        missing = [
+            user_id for user_id in user_ids
+            if user_id not in absent and guild.get_member(user_id) is None
+        ]
+        found = 0
+        for start in range(0, len(missing), QUERY_LIMIT):
+            chunk = missing[start:start + QUERY_LIMIT]
+            try:
+                async with self._semaphore:
+                    members = await guild.query_members(
+                        user_ids=chunk, limit=len(chunk), presences=True, cache=True
+                    )
+            except asyncio.TimeoutError:
+                # Шард мог переподключиться - попробуем при следующей загрузке
+                self.timeouts += 1
+                continue
+            self.requests += 1
+            returned = set()
+            for member in members:
+                returned.add(member.id)
+                self._presence.update_member(member)
+                for listener in self._listeners:
+                    listener(member)
+            absent.update(user_id for user_id in chunk if user_id not in returned)
+            found += len(members)
+        self.found += found
+        return found
+
+    async def load_all(self, guilds: Optional[Iterable[disnake.Guild]] = None) -> int:
+        """Загрузить друзей на всех серверах (параллельно, не больше concurrency запросов)"""
+        started = time.perf_counter()
+        guilds = list(self._guilds() if guilds is None else guilds)
+        results = await asyncio.gather(
+            *(self.load_guild(guild) for guild in guilds), return_exceptions=True
+        )
+        found = 0
+        for guild, result in zip(guilds, results):
+            if isinstance(result, Exception):
+                print(f"Не удалось загрузить участников сервера {guild.id}: {result}")
+            else:
+                found += result
+        self.last_load_seconds = time.perf_counter() - started
+        return found
+
+    def on_friend_change(self, owner_id: int, friend_id: int, added: bool) -> None:
+        """Подписчик графа друзей: новый друг без общих серверов в кэше - поискать его"""
+        if not added or self._presence.get(friend_id) is not None:
+            return
+        self._pending.add(friend_id)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне цикла событий (загрузка данных) - заберем при следующем изменении
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_pending())
+
+    async def _flush_pending(self) -> None:
+        # Небольшая задержка, чтобы /addfriends с ролью ушел одной пачкой
+        await asyncio.sleep(self.debounce)
+        while self._pending:
+            user_ids: List[int] = list(self._pending)
+            self._pending.clear()
+            for guild in list(self._guilds()):
+                try:
+                    await self.load_guild(guild, user_ids)
+                except Exception as e:
+                    print(f"Не удалось загрузить новых друзей на сервере {guild.id}: {e}")
+
+    def forget_guild(self, guild_id: int) -> None:
+        self._absent.pop(guild_id, None)
+
+    def forget_member(self, guild_id: int, user_id: int) -> None:
+        """Пользователь зашел на сервер - больше не считать его отсутствующим"""
+        checked = self._absent.get(guild_id)
+        if checked is not None:
+            checked[1].discard(user_id)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "requests": self.requests,
+            "found": self.found,
+            "timeouts": self.timeouts,
+            "pending": len(self._pending),
+            "last_load_seconds": self.last_load_seconds,
+        }
@@ -0,0 +1,221 @@
+import asyncio
+import contextvars
+import functools
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Границы корзин гистограммы задержек (сек)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Реестр и маршрут REST-запроса, который сейчас выполняется в этой задаче
+_current_route: contextvars.ContextVar = contextvars.ContextVar("current_route", default=None)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (в стиле Prometheus)"""
+    __slots__ = ("buckets", "counts", "count", "total")
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Последняя корзина - все, что больше верхней границы
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class Metrics:
+    """Реестр метрик бота: гистограммы задержек, счетчики и вычисляемые значения"""
+
+    def __init__(self):
+        self.histograms: Dict[str, Dict[str, Histogram]] = defaultdict(dict)
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.gauges: Dict[str, Callable[[], Dict[str, float]]] = {}
+        self.started_at = time.time()
+
+    def observe(self, name: str, label: str, value: float) -> None:
+        histogram = self.histograms[name].get(label)
+        if histogram is None:
+            histogram = self.histograms[name][label] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, label: str = "", amount: int = 1) -> None:
+        self.counters[name][label] += amount
+
+    def register_gauge(self, name: str, collect: Callable[[], Dict[str, float]]) -> None:
+        """Зарегистрировать источник значений, например stats() кэша"""
+        self.gauges[name] = collect
+
+    def collect_gauges(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for name, collect in self.gauges.items():
+            try:
+                result[name] = collect()
+            except Exception as e:
+                print(f"Не удалось собрать метрику {name}: {e}")
+        return result
+
+    def top(self, name: str, limit: int = 5) -> List[Tuple[str, int]]:
+        """Самые частые значения счетчика"""
+        return sorted(self.counters[name].items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def timed(self, label: str, name: str = "handler_latency_seconds"):
+        """Декоратор для корутин-обработчиков: записывает время выполнения"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(name, label, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def instrument_http(self, http) -> None:
+        """Считать REST-запросы по маршрутам (шаблон пути, без ID).
+
+        429 считаются по каждому ответу, включая те, что disnake повторил сам.
+        """
+        _count_ratelimits()
+        original = http.request
+
+        async def request(route, **kwargs):
+            label = f"{route.method} {route.path}"
+            self.inc("rest_requests_total", label)
+            token = _current_route.set((self, label))
+            started = time.perf_counter()
+            try:
+                return await original(route, **kwargs)
+            except Exception as e:
+                status = getattr(e, "status", None)
+                self.inc("rest_errors_total", f"{label} {status or type(e).__name__}")
+                raise
+            finally:
+                self.observe("rest_latency_seconds", label, time.perf_counter() - started)
+                _current_route.reset(token)
+
+        http.request = request
+
+
+    def render_prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        lines = []
+        for name, histograms in self.histograms.items():
+            metric = f"kisel_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for label, histogram in histograms.items():
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric}_bucket{{name="{_escape(label)}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{name="{_escape(label)}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum{{name="{_escape(label)}"}} {histogram.total}')
+                lines.append(f'{metric}_count{{name="{_escape(label)}"}} {histogram.count}')
+        for name, counter in self.counters.items():
+            metric = f"kisel_{name}"
+            lines.append(f"# TYPE {metric} counter")
+            for label, value in counter.items():
+                lines.append(f'{metric}{{name="{_escape(label)}"}} {value}')
+        for name, values in self.collect_gauges().items():
+            for key, value in values.items():
+                metric = f"kisel_{name}_{key}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def serve_prometheus(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Запустить локальный HTTP-сервер, отдающий метрики на любой GET-запрос"""
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                # Читаем заголовки запроса до пустой строки
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), timeout=5)
+                    if not line or line in (b"\r\n", b"\n"):
+                        break
+                body = self.render_prometheus().encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    + f"Content-Length: {len(body)}\r\n".encode("ascii")
+                    + b"Connection: close\r\n\r\n"
+                    + body
+                )
+                await writer.drain()
+            except Exception:
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+def resident_memory() -> int:
+    """Резидентная память процесса (RSS) в байтах или 0, если узнать не удалось"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # Без /proc остается только пиковое значение (на Linux в КиБ, на macOS в байтах)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def _count_ratelimits() -> None:
+    """Перехватить чтение ответов в disnake.http, чтобы видеть каждый 429.
+
+    HTTPClient.request повторяет 429 внутри себя, но тело каждого ответа
+    читает через json_or_text - там статус еще доступен.
+    """
+    import disnake.http
+
+    original = disnake.http.json_or_text
+    if getattr(original, "counts_ratelimits", False):
+        return
+
+    async def json_or_text(response):
+        current = _current_route.get()
+        if response.status == 429 and current is not None:
+            registry, label = current
+            registry.inc("rest_ratelimited_total", label)
+        return await original(response)
+
+    json_or_text.counts_ratelimits = True
+    disnake.http.json_or_text = json_or_text
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Общий реестр метрик
+metrics = Metrics()
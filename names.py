@@ -0,0 +1,123 @@
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from sortedcontainers import SortedList
+
+# Discord показывает в автодополнении не больше 25 вариантов
+AUTOCOMPLETE_LIMIT = 25
+
+
+def normalize(name: str) -> str:
+    """Ключ для поиска по префиксу без учета регистра"""
+    return name.casefold()
+
+
+class FriendNameIndex:
+    """Префиксный индекс имен друзей для автодополнения.
+
+    Для каждого владельца списка друзей хранится отсортированный список пар
+    (имя в нижнем регистре, ID друга), поэтому поиск по префиксу занимает
+    O(log n + k) при любом размере списка. Списки строятся лениво при первом
+    запросе и дальше поддерживаются событиями графа друзей и сменой имен.
+    Имена берутся только из кэшей (участники серверов, кэш пользователей),
+    REST-запросов индекс не делает. Друзья, которых еще нет в кэшах, стоят в
+    списке под своим ID, пока имя не появится (rename() или повторная
+    попытка при поиске).
+    """
+
+    def __init__(self, graph, lookup: Callable[[int], Optional[str]]):
+        self._graph = graph
+        self._lookup = lookup
+        # ID пользователя -> имя, под которым он стоит в списках (ID, если имя неизвестно)
+        self._names: Dict[int, str] = {}
+        # Пользователи, чье имя пока неизвестно
+        self._unresolved: Set[int] = set()
+        # ID владельца -> отсортированные пары (ключ, ID друга)
+        self._by_owner: Dict[int, SortedList] = {}
+        graph.add_listener(self.on_friend_change)
+
+    def __len__(self) -> int:
+        return len(self._by_owner)
+
+    def name(self, user_id: int) -> str:
+        """Отображаемое имя пользователя из кэша (или ID, если имя пока неизвестно)"""
+        name = self._names.get(user_id)
+        if name is None:
+            name = self._lookup(user_id)
+            if name is None:
+                name = str(user_id)
+                self._unresolved.add(user_id)
+            self._names[user_id] = name
+        return name
+
+    def _owner_index(self, owner_id: int) -> SortedList:
+        index = self._by_owner.get(owner_id)
+        if index is None:
+            index = SortedList(
+                (normalize(self.name(friend_id)), friend_id)
+                for friend_id in self._graph.friend_set(owner_id)
+            )
+            self._by_owner[owner_id] = index
+        return index
+
+    def on_friend_change(self, owner_id: int, friend_id: int, added: bool) -> None:
+        """Подписчик графа друзей: поддерживать уже построенные списки"""
+        index = self._by_owner.get(owner_id)
+        if index is None:
+            return
+        key = (normalize(self.name(friend_id)), friend_id)
+        if added:
+            index.add(key)
+        else:
+            index.discard(key)
+            if not index:
+                del self._by_owner[owner_id]
+
+    def rename(self, user_id: int, name: Optional[str] = None) -> None:
+        """Обновить имя пользователя во всех списках, где он есть"""
+        user_id = int(user_id)
+        old = self._names.get(user_id)
+        if old is None:
+            # Имя еще не нужно ни одному списку - возьмем его при построении
+            return
+        if name is None:
+            name = self._lookup(user_id)
+            if name is None:
+                # Все еще неизвестно - остается под ID до следующей попытки
+                return
+        self._unresolved.discard(user_id)
+        if old == name:
+            return
+        self._names[user_id] = name
+        old_key, new_key = (normalize(old), user_id), (normalize(name), user_id)
+        for owner_id in self._graph.followers(user_id):
+            index = self._by_owner.get(owner_id)
+            if index is not None:
+                index.discard(old_key)
+                index.add(new_key)
+
+    def _resolve_pending(self, owner_id: int) -> None:
+        """Повторить поиск имен друзей владельца, которые были неизвестны"""
+        if not self._unresolved:
+            return
+        friends = self._graph.friend_set(owner_id)
+        if len(self._unresolved) < len(friends):
+            pending = [user_id for user_id in self._unresolved if user_id in friends]
+        else:
+            pending = [user_id for user_id in friends if user_id in self._unresolved]
+        for user_id in pending:
+            self.rename(user_id)
+
+    def search(self, owner_id, prefix: str, limit: int = AUTOCOMPLETE_LIMIT) -> List[Tuple[str, int]]:
+        """Друзья владельца, имя которых начинается с prefix: [(имя, ID), ...]"""
+        owner_id = int(owner_id)
+        index = self._owner_index(owner_id)
+        self._resolve_pending(owner_id)
+        prefix = normalize(prefix.strip())
+        result = []
+        for key, friend_id in index.irange((prefix,), None):
+            if not key.startswith(prefix):
+                break
+            result.append((self._names.get(friend_id, str(friend_id)), friend_id))
+            if len(result) >= limit:
+                break
+        return result
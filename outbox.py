@@ -0,0 +1,292 @@
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dispatch import DeliveryReport, FanOutDispatcher, STATUS_SENT
+from metrics import metrics
+
+# Статусы уведомления в очереди
+OUTBOX_PENDING = "pending"
+OUTBOX_SENDING = "sending"
+OUTBOX_SENT = "sent"
+OUTBOX_FAILED = "failed"
+OUTBOX_BLOCKED = "blocked"  # получатель закрыл ЛС, не пишем ему какое-то время
+
+FINAL_STATUSES = (OUTBOX_SENT, OUTBOX_FAILED, OUTBOX_BLOCKED)
+
+# Коды ошибок Discord, после которых писать пользователю бессмысленно
+CANNOT_MESSAGE_USER = 50007
+
+
+class BatchState:
+    """Ход одной рассылки в этом процессе (для отчета вызвавшему команду)"""
+    __slots__ = ("total", "remaining", "counts", "on_result", "on_done", "on_progress")
+
+    def __init__(self, statuses: Dict[int, str], on_result, on_done, on_progress=None):
+        self.total = len(statuses)
+        self.remaining = sum(1 for status in statuses.values() if status not in FINAL_STATUSES)
+        self.counts: Dict[str, int] = {}
+        for status in statuses.values():
+            if status in FINAL_STATUSES:
+                self.counts[status] = self.counts.get(status, 0) + 1
+        self.on_result = on_result
+        self.on_done = on_done
+        self.on_progress = on_progress
+
+
+class NotificationOutbox:
+    """Постоянная очередь личных сообщений с фоновой отправкой.
+
+    Команда только записывает рассылку в хранилище и сразу отвечает.
+    Фоновая задача забирает готовые уведомления, отправляет их параллельно
+    через FanOutDispatcher (общая пауза на 429) и записывает результат
+    каждого получателя. Временные ошибки (429, 5xx, сеть) повторяются с
+    экспоненциальной задержкой, закрытые ЛС (403/50007) блокируют
+    получателя на ``block_for`` секунд. Очередь переживает перезапуск бота.
+    """
+
+    def __init__(
+        self,
+        storage,
+        persistence,
+        send: Callable[[int, dict, Optional[Tuple[int, int]]], Awaitable[Tuple[int, int]]],
+        concurrency: int = 8,
+        max_attempts: int = 8,
+        base_delay: float = 2.0,
+        max_delay: float = 900.0,
+        block_for: float = 86400.0,
+        lease: float = 300.0,
+        batch_size: int = 200,
+        poll_interval: float = 5.0,
+        retention: float = 7 * 86400.0,
+        progress_interval: float = 1.5,
+    ):
+        self.storage = storage
+        self.persistence = persistence
+        # send(ID получателя, данные рассылки, (ID канала, ID сообщения) для редактирования или None)
+        # -> (ID канала, ID сообщения)
+        self.send = send
+        # Повторы и паузы на 429 планирует очередь, диспетчер только отправляет
+        self.dispatcher = FanOutDispatcher(concurrency=concurrency, progress_interval=progress_interval)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.block_for = block_for
+        self.lease = lease
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._batches: Dict[str, BatchState] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._last_prune = 0.0
+        # Количество уведомлений по статусам (обновляется фоновой задачей)
+        self._queue_stats: Dict[str, int] = {}
+
+    async def enqueue(
+        self,
+        caller_id: int,
+        payload: dict,
+        recipients: List[Tuple[int, Optional[Tuple[int, int]]]],
+        on_result: Optional[Callable[[int, str, Optional[Tuple[int, int]]], None]] = None,
+        on_done: Optional[Callable[[Dict[str, int]], Awaitable[None]]] = None,
+        on_progress: Optional[Callable[[Dict[str, int], int], Awaitable[None]]] = None,
+    ) -> Dict[int, str]:
+        """Записать рассылку в очередь. Возвращает ID получателя -> начальный статус.
+
+        on_result(ID получателя, статус, (канал, сообщение)) вызывается после
+        каждой окончательной доставки, on_done(счетчики по статусам) - когда
+        все получатели рассылки обработаны, on_progress(счетчики, всего) - во
+        время отправки, не чаще раза в ``progress_interval`` секунд.
+        """
+        batch_id = uuid.uuid4().hex
+        rows = [
+            (recipient_id, *(target if target is not None else (None, None)))
+            for recipient_id, target in recipients
+        ]
+        statuses = await self.persistence.submit(
+            self.storage.enqueue_notifications, batch_id, caller_id, json.dumps(payload), rows, time.time()
+        )
+        state = BatchState(statuses, on_result, on_done, on_progress)
+        for status, count in state.counts.items():
+            metrics.inc("dm_deliveries_total", status, count)
+        if state.remaining:
+            self._batches[batch_id] = state
+            self._wakeup.set()
+        elif on_done is not None:
+            await self._finish_batch(state)
+        return statuses
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                processed = await self.process_due()
+                if processed:
+                    continue
+                await self._maybe_prune()
+                self._queue_stats = await self.persistence.submit(self.storage.outbox_stats)
+                next_at = await self.persistence.submit(self.storage.next_notification_at)
+            except Exception as e:
+                print(f"Ошибка в очереди уведомлений: {e}")
+                next_at = None
+            delay = self.poll_interval
+            if next_at is not None:
+                delay = min(max(next_at - time.time(), 0.05), self.poll_interval)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self, retries: bool = False) -> None:
+        """Отправить все, что уже можно отправить; с retries - дождаться и отложенных повторов"""
+        while True:
+            if await self.process_due():
+                continue
+            if not retries:
+                return
+            next_at = await self.persistence.submit(self.storage.next_notification_at)
+            if next_at is None:
+                return
+            await asyncio.sleep(max(next_at - time.time(), 0.01))
+
+    async def process_due(self) -> int:
+        """Забрать и отправить одну пачку готовых уведомлений. Возвращает их количество"""
+        rows = await self.persistence.submit(
+            self.storage.claim_notifications, time.time(), self.batch_size, self.lease
+        )
+        if not rows:
+            return 0
+        by_recipient: Dict[int, dict] = {}
+        duplicates = []
+        for row in rows:
+            # Один получатель может оказаться в пачке дважды (две рассылки) - второе отправим позже
+            if row["recipient_id"] in by_recipient:
+                duplicates.append(row)
+            else:
+                by_recipient[row["recipient_id"]] = row
+        payloads: Dict[str, dict] = {}
+        delivered: Dict[int, Tuple[int, int]] = {}
+
+        async def send(recipient_id: int) -> None:
+            row = by_recipient[recipient_id]
+            payload = payloads.get(row["batch_id"])
+            if payload is None:
+                payload = payloads[row["batch_id"]] = json.loads(row["payload"])
+            target = (row["channel_id"], row["message_id"]) if row["message_id"] else None
+            delivered[recipient_id] = await self.send(recipient_id, payload, target)
+
+        async def progress(report: DeliveryReport, total: int) -> None:
+            await self._report_progress(report, by_recipient)
+
+        report = await self.dispatcher.dispatch(list(by_recipient), send, on_progress=progress)
+
+        now = time.time()
+        updates = []
+        blocked = []
+        for recipient_id, result in report.results.items():
+            row = by_recipient[recipient_id]
+            attempts = row["attempts"] + result.attempts
+            update = {"id": row["id"], "attempts": attempts, "error": result.error}
+            if result.status == STATUS_SENT:
+                update["status"] = OUTBOX_SENT
+                update["channel_id"], update["message_id"] = delivered[recipient_id]
+            elif result.http_status == 403 and result.code == CANNOT_MESSAGE_USER:
+                update["status"] = OUTBOX_BLOCKED
+                blocked.append(recipient_id)
+            elif result.retryable and attempts < self.max_attempts:
+                update["status"] = OUTBOX_PENDING
+                update["next_attempt_at"] = now + self.retry_delay(attempts, result.retry_after)
+            else:
+                update["status"] = OUTBOX_FAILED
+            updates.append(update)
+        # Отложенные повторы получателя возвращаются в очередь без попытки - это не повтор отправки
+        requeued = [
+            {"id": row["id"], "status": OUTBOX_PENDING, "attempts": row["attempts"], "next_attempt_at": now}
+            for row in duplicates
+        ]
+
+        if blocked:
+            await self.persistence.submit(
+                self.storage.block_recipients, blocked, now + self.block_for, "closed DMs"
+            )
+        await self.persistence.submit(self.storage.finish_notifications, updates + requeued, now)
+
+        rows_by_id = {row["id"]: row for row in rows}
+        for update in updates:
+            await self._record(rows_by_id[update["id"]], update)
+        return len(rows)
+
+    async def _report_progress(self, report: DeliveryReport, by_recipient: Dict[int, dict]) -> None:
+        """Промежуточные счетчики рассылок этой пачки: итоги прошлых пачек и отправленные сейчас"""
+        sent_now: Dict[str, int] = {}
+        for recipient_id, result in list(report.results.items()):
+            if result.status == STATUS_SENT:
+                batch_id = by_recipient[recipient_id]["batch_id"]
+                sent_now[batch_id] = sent_now.get(batch_id, 0) + 1
+        for batch_id, sent in sent_now.items():
+            state = self._batches.get(batch_id)
+            if state is None or state.on_progress is None:
+                continue
+            counts = dict(state.counts)
+            counts[OUTBOX_SENT] = counts.get(OUTBOX_SENT, 0) + sent
+            await state.on_progress(counts, state.total)
+
+    def retry_delay(self, attempts: int, retry_after: Optional[float] = None) -> float:
+        """Задержка перед повтором: retry_after от Discord (429), иначе экспоненциальная.
+
+        К обеим добавляется разброс, чтобы повторы не приходили одновременно;
+        retry_after не сокращается.
+        """
+        if retry_after is not None:
+            return retry_after * random.uniform(1.0, 1.1)
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _record(self, row: dict, update: dict) -> None:
+        status = update["status"]
+        if status == OUTBOX_PENDING:
+            metrics.inc("dm_retries_total")
+            return
+        metrics.inc("dm_deliveries_total", status)
+        state = self._batches.get(row["batch_id"])
+        if state is None:
+            # Рассылка из другого процесса или до перезапуска - отчитываться некому
+            return
+        state.counts[status] = state.counts.get(status, 0) + 1
+        state.remaining -= 1
+        if state.on_result is not None:
+            target = (update["channel_id"], update["message_id"]) if status == OUTBOX_SENT else None
+            state.on_result(row["recipient_id"], status, target)
+        if state.remaining <= 0:
+            del self._batches[row["batch_id"]]
+            await self._finish_batch(state)
+
+    @staticmethod
+    async def _finish_batch(state: BatchState) -> None:
+        if state.on_done is None:
+            return
+        try:
+            await state.on_done(state.counts)
+        except Exception as e:
+            print(f"Не удалось сообщить о завершении рассылки: {e}")
+
+    async def _maybe_prune(self) -> None:
+        """Раз в час удалять старые завершенные уведомления"""
+        now = time.time()
+        if now - self._last_prune < 3600:
+            return
+        self._last_prune = now
+        await self.persistence.submit(self.storage.prune_outbox, now - self.retention)
+
+    def stats(self) -> Dict[str, float]:
+        stats = {f"queued_{status}": count for status, count in self._queue_stats.items()}
+        stats["open_batches"] = len(self._batches)
+        return stats
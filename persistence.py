@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class _Job:
+    """Задача записи; пока не начата, ее функцию можно заменить более свежей"""
+    __slots__ = ("fn", "args", "started", "future")
+
+    def __init__(self, fn: Callable, args: tuple, future: asyncio.Future):
+        self.fn = fn
+        self.args = args
+        self.started = False
+        self.future = future
+
+
+class PersistenceWorker:
+    """Асинхронный фасад над хранилищем: вся работа с диском в отдельном потоке.
+
+    Задачи выполняются по очереди в одном рабочем потоке, поэтому порядок
+    записей сохраняется. Задачи с одинаковым ключом, которые еще ждут в
+    очереди, объединяются: выполнится только последняя из них.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self._queued: Dict[Hashable, _Job] = {}
+        # Защищает замену функции в ожидающей задаче от одновременного старта
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # Метрики
+        self.completed = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.last_latency = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._in_flight
+
+    def _run_job(self, key: Optional[Hashable], job: _Job) -> Any:
+        with self._lock:
+            job.started = True
+            fn, args = job.fn, job.args
+            if key is not None and self._queued.get(key) is job:
+                del self._queued[key]
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.last_latency = time.perf_counter() - started
+
+    def _on_done(self, key: Optional[Hashable], job: _Job, result: asyncio.Future) -> None:
+        self._in_flight -= 1
+        if result.cancelled():
+            job.future.cancel()
+            return
+        error = result.exception()
+        if error is not None:
+            self.failed += 1
+            # Результат фоновой записи может никто не ждать - выводим ошибку сами
+            print(f"Ошибка записи в хранилище: {error!r}")
+            if not job.future.done():
+                job.future.set_exception(error)
+                job.future.exception()
+        else:
+            self.completed += 1
+            if not job.future.done():
+                job.future.set_result(result.result())
+
+    def submit(self, fn: Callable, *args, key: Optional[Hashable] = None) -> asyncio.Future:
+        """Поставить запись в очередь. Результат можно ждать, а можно и не ждать.
+
+        Если указан ``key`` и задача с тем же ключом еще не начата,
+        она заменяется новой и возвращается ее future.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if key is not None:
+                job = self._queued.get(key)
+                if job is not None and not job.started:
+                    job.fn = fn
+                    job.args = args
+                    self.coalesced += 1
+                    return job.future
+            job = _Job(fn, args, loop.create_future())
+            if key is not None:
+                self._queued[key] = job
+        self._in_flight += 1
+        inner = loop.run_in_executor(self._executor, self._run_job, key, job)
+        inner.add_done_callback(lambda result: self._on_done(key, job, result))
+        return job.future
+
+    async def barrier(self) -> None:
+        """Дождаться, пока все поставленные ранее записи окажутся на диске"""
+        await self.submit(_noop)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+            "last_latency_ms": self.last_latency * 1000,
+        }
+
+    def close(self) -> None:
+        """Дождаться завершения всех записей и остановить поток"""
+        self._executor.shutdown(wait=True)
+
+
+def _noop() -> None:
+    return None
@@ -0,0 +1,164 @@
+from typing import AbstractSet, Dict, Iterable, List, Optional, Set
+
+import disnake
+
+# Статусы, при которых пользователь считается в сети
+ONLINE_STATUSES = (
+    disnake.Status.online,
+    disnake.Status.idle,
+    disnake.Status.dnd,
+    disnake.Status.streaming,
+)
+
+# Приоритет статусов при агрегации по нескольким серверам
+_STATUS_PRIORITY = {
+    disnake.Status.streaming: 4,
+    disnake.Status.online: 3,
+    disnake.Status.dnd: 2,
+    disnake.Status.idle: 1,
+}
+
+# Типы активности, которые считаются игрой
+GAME_ACTIVITY_TYPES = (disnake.ActivityType.playing, disnake.ActivityType.streaming)
+
+
+class PresenceEntry:
+    """Сведения о пользователе, собранные со всех общих серверов"""
+    __slots__ = ("members", "status", "activity", "games")
+
+    def __init__(self):
+        # Ключ - ID сервера, значение - объект участника на этом сервере
+        self.members: Dict[int, disnake.Member] = {}
+        self.status: disnake.Status = disnake.Status.offline
+        self.activity: Optional[disnake.BaseActivity] = None
+        # Ключ - название игры, значение - активность (для деталей)
+        self.games: Dict[str, disnake.BaseActivity] = {}
+
+    @property
+    def is_online(self) -> bool:
+        return self.status in ONLINE_STATUSES
+
+    def any_member(self) -> Optional[disnake.Member]:
+        """Любой объект участника пользователя (для имени, аватара и т.п.)"""
+        for member in self.members.values():
+            return member
+        return None
+
+    def recompute(self) -> None:
+        """Пересчитать агрегированный статус, текущую активность и игры"""
+        status = disnake.Status.offline
+        games = {}
+        for member in self.members.values():
+            if _STATUS_PRIORITY.get(member.status, 0) > _STATUS_PRIORITY.get(status, 0):
+                status = member.status
+            # У пользователя может быть несколько активностей (игра, стрим и т.д.)
+            for candidate in member.activities:
+                if candidate.type in GAME_ACTIVITY_TYPES and candidate.name and candidate.name not in games:
+                    games[candidate.name] = candidate
+        if status == disnake.Status.offline:
+            games = {}
+        self.status = status
+        self.games = games
+        self.activity = next(iter(games.values()), None)
+
+
+class PresenceIndex:
+    """Индекс ID пользователя -> участники, статус и активность.
+
+    Строится в on_ready и поддерживается событиями шлюза, поэтому поиск
+    статуса друга не требует обхода всех серверов бота.
+    """
+
+    def __init__(self):
+        self._entries: Dict[int, PresenceEntry] = {}
+        # Индекс игр: название игры -> ID играющих в нее пользователей
+        self._players: Dict[str, Set[int]] = {}
+
+    def _refresh(self, user_id: int, entry: PresenceEntry) -> None:
+        """Пересчитать запись и обновить индекс игр по разнице"""
+        old_games = set(entry.games)
+        entry.recompute()
+        new_games = set(entry.games)
+        for game in old_games - new_games:
+            players = self._players.get(game)
+            if players is not None:
+                players.discard(user_id)
+                if not players:
+                    del self._players[game]
+        for game in new_games - old_games:
+            self._players.setdefault(game, set()).add(user_id)
+
+    def games_of(self, user_ids) -> Dict[str, List[int]]:
+        """Кто из указанных пользователей во что играет: игра -> список ID.
+
+        Идет с меньшей стороны: по пользователям, если их меньше, чем
+        активных игр, иначе по индексу игр с пересечением.
+        """
+        user_ids = user_ids if isinstance(user_ids, (AbstractSet, dict)) else set(user_ids)
+        result: Dict[str, List[int]] = {}
+        if len(user_ids) <= len(self._players):
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is not None:
+                    for game in entry.games:
+                        result.setdefault(game, []).append(user_id)
+        else:
+            for game, players in self._players.items():
+                common = [user_id for user_id in players if user_id in user_ids]
+                if common:
+                    result[game] = common
+        return result
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id) -> bool:
+        return int(user_id) in self._entries
+
+    def get(self, user_id) -> Optional[PresenceEntry]:
+        """Получить запись о пользователе или None, если общих серверов нет"""
+        return self._entries.get(int(user_id))
+
+    def is_online(self, user_id) -> bool:
+        entry = self._entries.get(int(user_id))
+        return entry is not None and entry.is_online
+
+    def get_member(self, user_id) -> Optional[disnake.Member]:
+        entry = self._entries.get(int(user_id))
+        return entry.any_member() if entry is not None else None
+
+    def build(self, guilds: Iterable[disnake.Guild]) -> None:
+        """Полностью перестроить индекс по кэшу участников"""
+        self._entries.clear()
+        self._players.clear()
+        for guild in guilds:
+            self.add_guild(guild)
+
+    def add_guild(self, guild: disnake.Guild) -> None:
+        for member in guild.members:
+            entry = self._entries.get(member.id)
+            if entry is None:
+                entry = self._entries[member.id] = PresenceEntry()
+            entry.members[guild.id] = member
+            self._refresh(member.id, entry)
+
+    def remove_guild(self, guild: disnake.Guild) -> None:
+        for member in guild.members:
+            self.remove_member(guild.id, member.id)
+
+    def update_member(self, member: disnake.Member) -> None:
+        """Добавить или обновить объект участника"""
+        entry = self._entries.get(member.id)
+        if entry is None:
+            entry = self._entries[member.id] = PresenceEntry()
+        entry.members[member.guild.id] = member
+        self._refresh(member.id, entry)
+
+    def remove_member(self, guild_id: int, user_id: int) -> None:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        entry.members.pop(guild_id, None)
+        self._refresh(user_id, entry)
+        if not entry.members:
+            del self._entries[user_id]
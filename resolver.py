@@ -0,0 +1,156 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Union
+
+import disnake
+
+from presence import PresenceIndex
+
+UserLike = Union[disnake.User, disnake.Member]
+
+# Значение-заглушка для пользователей, которых Discord не нашел
+_NOT_FOUND = object()
+
+
+class UserResolver:
+    """Получение пользователей по ID с приоритетом кэша.
+
+    Порядок поиска: кэш клиента (``bot.get_user``), индекс участников,
+    собственный LRU-кэш с TTL и только потом REST-запрос ``fetch_user``.
+    Одновременные запросы одного и того же ID объединяются в один.
+    Если Discord отвечает, что пользователя нет, вызывается ``on_not_found``.
+    """
+
+    def __init__(
+        self,
+        bot,
+        presence_index: PresenceIndex,
+        maxsize: int = 5000,
+        ttl: float = 3600.0,
+        on_not_found: Optional[Callable[[int], None]] = None
+    ):
+        self.bot = bot
+        self.on_not_found = on_not_found
+        self.presence_index = presence_index
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Ключ - ID пользователя, значение - (время истечения, пользователь)
+        self._cache: "OrderedDict[int, tuple]" = OrderedDict()
+        self._inflight: Dict[int, asyncio.Future] = {}
+        # Счетчики попаданий и промахов
+        self.hits = 0
+        self.member_hits = 0
+        self.lru_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.fetch_errors = 0
+
+    def stats(self) -> Dict[str, float]:
+        """Статистика работы кэша"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "member_hits": self.member_hits,
+            "lru_hits": self.lru_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "fetch_errors": self.fetch_errors,
+            "cached": len(self._cache),
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+    def _lru_get(self, user_id: int):
+        item = self._cache.get(user_id)
+        if item is None:
+            return None
+        expires_at, user = item
+        if expires_at < time.monotonic():
+            del self._cache[user_id]
+            return None
+        self._cache.move_to_end(user_id)
+        return user
+
+    def _lru_put(self, user_id: int, user) -> None:
+        self._cache[user_id] = (time.monotonic() + self.ttl, user)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def peek(self, user_id) -> Optional[UserLike]:
+        """Найти пользователя только в кэшах, без REST-запросов"""
+        user_id = int(user_id)
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            return user
+        member = self.presence_index.get_member(user_id)
+        if member is not None:
+            return member
+        user = self._lru_get(user_id)
+        return None if user is None or user is _NOT_FOUND else user
+
+    async def resolve(self, user_id) -> Optional[UserLike]:
+        """Получить пользователя по ID. Возвращает None, если пользователь не существует"""
+        user_id = int(user_id)
+
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            self.hits += 1
+            return user
+
+        member = self.presence_index.get_member(user_id)
+        if member is not None:
+            self.hits += 1
+            self.member_hits += 1
+            return member
+
+        user = self._lru_get(user_id)
+        if user is not None:
+            self.hits += 1
+            self.lru_hits += 1
+            return None if user is _NOT_FOUND else user
+
+        # Если этот пользователь уже запрашивается, ждем тот же запрос
+        future = self._inflight.get(user_id)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = future
+        try:
+            try:
+                user = await self.bot.fetch_user(user_id)
+            except disnake.NotFound:
+                user = None
+                if self.on_not_found is not None:
+                    self.on_not_found(user_id)
+            self._lru_put(user_id, _NOT_FOUND if user is None else user)
+            future.set_result(user)
+            return user
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.fetch_errors += 1
+            future.set_exception(e)
+            # Исключение получат ожидающие, помечаем его как обработанное
+            future.exception()
+            raise
+        finally:
+            del self._inflight[user_id]
+
+    async def prewarm(self, user_ids: Iterable, concurrency: int = 8) -> None:
+        """Заранее загрузить пользователей в кэш (ошибки игнорируются)"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def load(user_id) -> None:
+            async with semaphore:
+                try:
+                    await self.resolve(user_id)
+                except Exception:
+                    pass
+
+        pending = [user_id for user_id in user_ids if self.peek(user_id) is None]
+        await asyncio.gather(*(load(user_id) for user_id in pending))
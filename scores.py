@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class ScoreStore:
+    """Общий кэш счетов в памяти с отложенной записью в хранилище.
+
+    Все изменения (начисление за войс, команды администраторов, магазин)
+    идут через этот объект и сразу видны всем командам. В хранилище пишутся
+    не итоговые значения, а накопленные приращения, пачкой, по таймеру и при
+    остановке бота: так начисления нескольких процессов с общей базой не
+    затирают друг друга. Изменения других процессов приходят через refresh().
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._scores: Dict[str, int] = storage.load_scores()
+        # Еще не записанные приращения: ID -> сумма изменений
+        self._pending: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        # Подписчики на изменения счетов (например, рейтинг)
+        self._listeners: List[Callable[[str, int], None]] = []
+        # Цикл событий, в котором должны вызываться подписчики (см. bind_loop)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        # Метрики записи
+        self.flush_count = 0
+        self.flushed_rows = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def add_listener(self, listener: Callable[[str, int], None]) -> None:
+        """Подписаться на изменения: listener(user_id, новый счет)"""
+        self._listeners.append(listener)
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Вызывать подписчиков только в потоке цикла событий.
+
+        refresh() выполняется в потоке записи; изменения из него передаются
+        в цикл событий, а подписчик получает актуальный на тот момент счет.
+        """
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+
+    def _notify(self, user_id: str, score: int) -> None:
+        if self._loop is not None and threading.get_ident() != self._loop_thread:
+            try:
+                self._loop.call_soon_threadsafe(self._notify_current, user_id)
+                return
+            except RuntimeError:
+                # Цикл событий уже закрыт (остановка бота) - вызываем напрямую
+                pass
+        for listener in self._listeners:
+            listener(user_id, score)
+
+    def _notify_current(self, user_id: str) -> None:
+        score = self.get(user_id)
+        for listener in self._listeners:
+            listener(user_id, score)
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self._scores
+
+    def get(self, user_id) -> int:
+        return self._scores.get(str(user_id), 0)
+
+    def items(self):
+        return self._scores.items()
+
+    def _apply(self, user_id: str, score: int) -> int:
+        """Записать новое значение в кэш и запомнить приращение (под блокировкой)"""
+        delta = score - self._scores.get(user_id, 0)
+        self._scores[user_id] = score
+        if delta:
+            self._pending[user_id] = self._pending.get(user_id, 0) + delta
+        self._notify(user_id, score)
+        return score
+
+    def set(self, user_id, score: int) -> int:
+        user_id = str(user_id)
+        with self._lock:
+            return self._apply(user_id, score)
+
+    def add(self, user_id, delta: int) -> int:
+        """Изменить счет на delta, вернуть новое значение"""
+        user_id = str(user_id)
+        with self._lock:
+            return self._apply(user_id, self._scores.get(user_id, 0) + delta)
+
+    def add_many(self, deltas: Dict[str, int]) -> None:
+        """Изменить несколько счетов за одно обращение (например, начисление за войс)"""
+        with self._lock:
+            for user_id, delta in deltas.items():
+                user_id = str(user_id)
+                self._apply(user_id, self._scores.get(user_id, 0) + delta)
+
+    def subtract(self, user_id, amount: int) -> int:
+        """Списать очки, не уходя в минус"""
+        user_id = str(user_id)
+        with self._lock:
+            return self._apply(user_id, max(self._scores.get(user_id, 0) - amount, 0))
+
+    def refresh(self, scores: Dict[str, int]) -> None:
+        """Принять значения из хранилища (например, записанные другим процессом).
+
+        Незаписанные локальные приращения сохраняются поверх них.
+        """
+        with self._lock:
+            for user_id, stored in scores.items():
+                user_id = str(user_id)
+                score = stored + self._pending.get(user_id, 0)
+                if self._scores.get(user_id) != score:
+                    self._scores[user_id] = score
+                    self._notify(user_id, score)
+
+    @property
+    def queue_depth(self) -> int:
+        """Количество измененных, но еще не записанных счетов"""
+        return len(self._pending)
+
+    def flush(self) -> int:
+        """Записать все накопленные приращения одной пачкой. Возвращает число строк"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch = self._pending
+            self._pending = {}
+        started = time.perf_counter()
+        try:
+            stored = self.storage.add_scores(batch)
+        except BaseException:
+            # Возвращаем приращения в очередь, чтобы не потерять их
+            with self._lock:
+                for user_id, delta in batch.items():
+                    self._pending[user_id] = self._pending.get(user_id, 0) + delta
+            raise
+        # В хранилище могли быть начисления других процессов - подтягиваем итог
+        self.refresh(stored)
+        latency = time.perf_counter() - started
+        self.flush_count += 1
+        self.flushed_rows += len(batch)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        return len(batch)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "flushes": self.flush_count,
+            "flushed_rows": self.flushed_rows,
+            "last_flush_ms": self.last_flush_latency * 1000,
+            "max_flush_ms": self.max_flush_latency * 1000,
+        }
@@ -0,0 +1,147 @@
+import asyncio
+import time
+import weakref
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from botlog import get_logger
+from storage import PURCHASE_INSUFFICIENT, PURCHASE_OWNED, PURCHASE_RESERVED
+
+# Итоги покупки (кроме статусов резервирования из storage)
+PURCHASE_COMPLETED = "completed"
+PURCHASE_FAILED = "failed"  # ошибка Discord, очки возвращены
+
+# Окно (с), в котором повторная покупка того же товара тем же пользователем
+# считается повтором нажатия и получает тот же ключ идемпотентности
+PURCHASE_KEY_WINDOW = 10.0
+
+shop_log = get_logger("shop")
+
+
+class PurchaseEngine:
+    """Покупки в магазине без гонок между нажатиями.
+
+    Покупки одного пользователя выполняются строго по очереди (своя
+    блокировка на пользователя, покупатели друг друга не ждут). Очки
+    списываются в хранилище до обращений к Discord одной транзакцией с
+    проверкой счета, ключа идемпотентности и прошлых покупок, а при ошибке
+    возвращаются. Все шаги записываются в журнал покупок, который только
+    дописывается. Перед apply() в журнал пишется ``applying``: резервы,
+    оставшиеся без итога после падения процесса, recover() возмещает, если
+    до Discord дело не дошло, и подтверждает, если роли уже могли измениться.
+    """
+
+    def __init__(self, storage, score_store, persistence, purchases: Dict[str, List[str]]):
+        self.storage = storage
+        self.score_store = score_store
+        self.persistence = persistence
+        # Кэш совершенных покупок: ID пользователя -> товары (для кнопок магазина)
+        self.purchases = purchases
+        # Блокировка живет, пока ее кто-то держит или ждет
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def lock_for(self, user_id) -> asyncio.Lock:
+        user_id = str(user_id)
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    def has_purchased(self, user_id, item: str) -> bool:
+        return item in self.purchases.get(str(user_id), ())
+
+    def _reserve(self, key: str, user_id: str, item: str, price: int):
+        """Резерв в потоке записи: сначала накопленные приращения, затем списание"""
+        self.score_store.flush()
+        status, score = self.storage.reserve_purchase(key, user_id, item, price, time.time())
+        if score is not None:
+            self.score_store.refresh({user_id: score})
+        return status
+
+    @staticmethod
+    def purchase_key(user_id, item: str, now: Optional[float] = None) -> str:
+        """Ключ идемпотентности: пользователь, товар и окно PURCHASE_KEY_WINDOW"""
+        now = time.time() if now is None else now
+        return f"{user_id}:{item}:{int(now // PURCHASE_KEY_WINDOW)}"
+
+    def _refund(self, key: str) -> None:
+        refunded = self.storage.refund_purchase(key, time.time())
+        if refunded is not None:
+            user_id, score = refunded
+            self.score_store.refresh({user_id: score})
+
+    async def purchase(
+        self,
+        user_id,
+        item: str,
+        price: int,
+        apply: Callable[[], Awaitable[None]],
+        key: Optional[str] = None,
+    ) -> str:
+        """Купить товар: резерв очков, apply() (вызовы Discord), подтверждение или возврат.
+
+        key - ключ идемпотентности (по умолчанию purchase_key()): повтор с тем
+        же ключом ничего не списывает. Возвращает итог покупки.
+        """
+        user_id = str(user_id)
+        if key is None:
+            key = self.purchase_key(user_id, item)
+        async with self.lock_for(user_id):
+            if self.has_purchased(user_id, item):
+                return PURCHASE_OWNED
+            if self.score_store.get(user_id) < price:
+                return PURCHASE_INSUFFICIENT
+            status = await self.persistence.submit(self._reserve, key, user_id, item, price)
+            if status != PURCHASE_RESERVED:
+                return status
+            # Отметка до изменения ролей: после падения покупка не будет возмещена
+            await self.persistence.submit(self.storage.mark_applying, key, time.time())
+            try:
+                await apply()
+            except Exception:
+                shop_log.exception(
+                    "Покупка не удалась, очки возвращены", extra={"user_id": int(user_id), "item": item, "key": key}
+                )
+                await self.persistence.submit(self._refund, key)
+                return PURCHASE_FAILED
+            try:
+                await self.persistence.submit(self.storage.complete_purchase, key, time.time())
+            except Exception:
+                # Роли уже изменены: очки не возвращаем, recover() подтвердит покупку позже
+                shop_log.exception(
+                    "Не удалось подтвердить покупку", extra={"user_id": int(user_id), "item": item, "key": key}
+                )
+            # Ответ пользователю - только после того, как все записи до покупки на диске
+            await self.persistence.barrier()
+            items = self.purchases.setdefault(user_id, [])
+            if item not in items:
+                items.append(item)
+            shop_log.info("Покупка совершена", extra={"user_id": int(user_id), "item": item, "price": price, "key": key})
+            return PURCHASE_COMPLETED
+
+    async def _complete(self, key: str) -> None:
+        now = time.time()
+        if await self.persistence.submit(self.storage.complete_purchase, key, now):
+            purchases = await self.persistence.submit(self.storage.load_purchases)
+            self.purchases.clear()
+            self.purchases.update(purchases)
+
+    async def recover(self, stale_after: float = 600.0) -> int:
+        """Довести до итога резервы старше stale_after секунд. Возвращает их число.
+
+        Если изменения в Discord не начинались, очки возвращаются, иначе
+        покупка подтверждается (роль у пользователя могла остаться).
+        """
+        stale = await self.persistence.submit(self.storage.stale_purchases, time.time() - stale_after)
+        refunded = completed = 0
+        for key, applying in stale:
+            if applying:
+                await self._complete(key)
+                completed += 1
+            else:
+                await self.persistence.submit(self._refund, key)
+                refunded += 1
+        if stale:
+            shop_log.warning(
+                "Незавершенные покупки доведены до итога", extra={"refunded": refunded, "completed": completed}
+            )
+        return len(stale)
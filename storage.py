@@ -0,0 +1,1007 @@
+import base64
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from voicestats import BlockKey, merge_block
+
+
+def atomic_write_json(path: str, data) -> None:
+    """Записать JSON атомарно: во временный файл рядом, затем os.replace"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_json(path: str) -> dict:
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+# Результат резервирования очков под покупку
+PURCHASE_RESERVED = "reserved"
+PURCHASE_DUPLICATE = "duplicate"        # покупка с этим ключом идемпотентности уже была
+PURCHASE_OWNED = "owned"                # товар уже куплен
+PURCHASE_INSUFFICIENT = "insufficient"  # недостаточно очков
+
+# Изменение, сделанное другим процессом: (вид, ID пользователя, второй ID, значение)
+Change = Tuple[str, int, Optional[int], Optional[str]]
+
+
+class JsonStorage:
+    """Хранилище в JSON-файлах (как раньше), но с атомарной записью.
+
+    Рассчитано на один процесс: изменения других процессов не отслеживаются.
+    """
+
+    def __init__(self, data_file: str, score_file: str, voice_file: str = "voice_sessions.json",
+                 purchase_file: str = "purchases.json", outbox_file: str = "outbox.json",
+                 meta_file: str = "bot_meta.json", ledger_file: str = "purchase_ledger.jsonl",
+                 voice_stats_file: str = "voice_stats.json"):
+        self.data_file = data_file
+        self.score_file = score_file
+        self.voice_file = voice_file
+        self.purchase_file = purchase_file
+        self.outbox_file = outbox_file
+        self.meta_file = meta_file
+        self.ledger_file = ledger_file
+        self.voice_stats_file = voice_stats_file
+        self._lock = threading.Lock()
+        self._friends = read_json(data_file)
+        self._scores = read_json(score_file)
+        self._purchases = read_json(purchase_file)
+        outbox = read_json(outbox_file)
+        self._outbox: List[dict] = outbox.get("items", [])
+        self._payloads: Dict[str, dict] = outbox.get("payloads", {})
+        self._blocked: Dict[str, float] = outbox.get("blocked", {})
+        self._outbox_seq = max((item["id"] for item in self._outbox), default=0)
+        # Журнал покупок - файл JSON Lines, только дописывается; в памяти - индекс по ключу
+        self._ledger: Dict[str, Dict[str, dict]] = {}
+        if os.path.exists(ledger_file):
+            with open(ledger_file, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._ledger.setdefault(entry["key"], {})[entry["event"]] = entry
+        # Блоки статистики войса хранятся в base64: "ряд/номер блока" -> данные
+        self._voice_stats: Dict[BlockKey, bytes] = {}
+        for key, data in read_json(voice_stats_file).get("blocks", {}).items():
+            series, block = key.rsplit("/", 1)
+            self._voice_stats[(series, int(block))] = base64.b64decode(data)
+
+    def _save_outbox(self) -> None:
+        atomic_write_json(self.outbox_file, {"items": self._outbox, "payloads": self._payloads, "blocked": self._blocked})
+
+    def load_friends(self) -> Dict[str, List[str]]:
+        with self._lock:
+            return {user_id: list(friends) for user_id, friends in self._friends.items()}
+
+    def add_friend(self, user_id: str, friend_id: str) -> None:
+        with self._lock:
+            friends = self._friends.setdefault(str(user_id), [])
+            if str(friend_id) not in friends:
+                friends.append(str(friend_id))
+            atomic_write_json(self.data_file, self._friends)
+
+    def remove_friend(self, user_id: str, friend_id: str) -> None:
+        with self._lock:
+            friends = self._friends.get(str(user_id), [])
+            if str(friend_id) in friends:
+                friends.remove(str(friend_id))
+            atomic_write_json(self.data_file, self._friends)
+
+    def add_friends(self, user_id: str, friend_ids: List[str]) -> None:
+        """Добавить несколько друзей с одной записью файла"""
+        with self._lock:
+            friends = self._friends.setdefault(str(user_id), [])
+            existing = set(friends)
+            for friend_id in map(str, friend_ids):
+                if friend_id not in existing:
+                    existing.add(friend_id)
+                    friends.append(friend_id)
+            atomic_write_json(self.data_file, self._friends)
+
+    def remove_friends(self, user_id: str, friend_ids: List[str]) -> None:
+        """Удалить несколько друзей с одной записью файла"""
+        with self._lock:
+            removed = set(map(str, friend_ids))
+            friends = self._friends.get(str(user_id), [])
+            friends[:] = [friend_id for friend_id in friends if friend_id not in removed]
+            atomic_write_json(self.data_file, self._friends)
+
+    def remove_user(self, user_id: str) -> None:
+        """Удалить список друзей пользователя и его самого из чужих списков"""
+        with self._lock:
+            self._friends.pop(str(user_id), None)
+            for friends in self._friends.values():
+                if str(user_id) in friends:
+                    friends.remove(str(user_id))
+            atomic_write_json(self.data_file, self._friends)
+
+    def load_scores(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._scores)
+
+    def add_scores(self, deltas: Dict[str, int]) -> Dict[str, int]:
+        """Прибавить изменения к счетам (не ниже нуля), вернуть новые значения"""
+        with self._lock:
+            result = {}
+            for user_id, delta in deltas.items():
+                score = max(self._scores.get(str(user_id), 0) + delta, 0)
+                self._scores[str(user_id)] = result[str(user_id)] = score
+            atomic_write_json(self.score_file, self._scores)
+            return result
+
+    def load_purchases(self) -> Dict[str, List[str]]:
+        with self._lock:
+            return {user_id: list(items) for user_id, items in self._purchases.items()}
+
+    def _append_ledger(self, entry: dict) -> None:
+        with open(self.ledger_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._ledger.setdefault(entry["key"], {})[entry["event"]] = entry
+
+    def reserve_purchase(self, key: str, user_id: str, item: str, price: int, now: float) -> Tuple[str, Optional[int]]:
+        user_id = str(user_id)
+        with self._lock:
+            if key in self._ledger:
+                return PURCHASE_DUPLICATE, None
+            if item in self._purchases.get(user_id, ()):
+                return PURCHASE_OWNED, None
+            score = self._scores.get(user_id, 0)
+            if score < price:
+                return PURCHASE_INSUFFICIENT, None
+            self._append_ledger({"key": key, "event": "reserve", "user_id": user_id, "item": item, "amount": -price, "at": now})
+            self._scores[user_id] = score - price
+            atomic_write_json(self.score_file, self._scores)
+            return PURCHASE_RESERVED, score - price
+
+    def _reservation(self, key: str) -> Optional[dict]:
+        events = self._ledger.get(key, {})
+        if "reserve" not in events or "complete" in events or "refund" in events:
+            return None
+        return events["reserve"]
+
+    def mark_applying(self, key: str, now: float) -> bool:
+        with self._lock:
+            reservation = self._reservation(key)
+            if reservation is None:
+                return False
+            if "applying" not in self._ledger[key]:
+                self._append_ledger({**reservation, "event": "applying", "amount": 0, "at": now})
+            return True
+
+    def complete_purchase(self, key: str, now: float) -> bool:
+        with self._lock:
+            reservation = self._reservation(key)
+            if reservation is None:
+                return False
+            self._append_ledger({**reservation, "event": "complete", "amount": 0, "at": now})
+            items = self._purchases.setdefault(reservation["user_id"], [])
+            if reservation["item"] not in items:
+                items.append(reservation["item"])
+            atomic_write_json(self.purchase_file, self._purchases)
+            return True
+
+    def refund_purchase(self, key: str, now: float) -> Optional[Tuple[str, int]]:
+        with self._lock:
+            reservation = self._reservation(key)
+            if reservation is None:
+                return None
+            self._append_ledger({**reservation, "event": "refund", "amount": -reservation["amount"], "at": now})
+            user_id = reservation["user_id"]
+            self._scores[user_id] = self._scores.get(user_id, 0) - reservation["amount"]
+            atomic_write_json(self.score_file, self._scores)
+            return user_id, self._scores[user_id]
+
+    def stale_purchases(self, before: float) -> List[Tuple[str, bool]]:
+        with self._lock:
+            return [
+                (key, "applying" in self._ledger[key]) for key in self._ledger
+                if (reservation := self._reservation(key)) is not None and reservation["at"] < before
+            ]
+
+    def changes_since(self, seq: int) -> Tuple[int, Optional[List[Change]]]:
+        return seq, []
+
+    def enqueue_notifications(self, batch_id: str, caller_id: int, payload: str,
+                              recipients: List[Tuple[int, Optional[int], Optional[int]]], now: float) -> Dict[int, str]:
+        with self._lock:
+            self._payloads[batch_id] = {"caller_id": int(caller_id), "payload": payload, "created_at": now}
+            statuses = {}
+            for recipient_id, channel_id, message_id in recipients:
+                status = "blocked" if self._blocked.get(str(recipient_id), 0) > now else "pending"
+                statuses[int(recipient_id)] = status
+                self._outbox_seq += 1
+                self._outbox.append({
+                    "id": self._outbox_seq, "batch_id": batch_id, "recipient_id": int(recipient_id),
+                    "status": status, "attempts": 0, "next_attempt_at": now, "lease_until": None,
+                    "updated_at": now, "error": None, "channel_id": channel_id, "message_id": message_id,
+                })
+            self._save_outbox()
+            return statuses
+
+    def claim_notifications(self, now: float, limit: int, lease: float) -> List[dict]:
+        with self._lock:
+            due = [
+                item for item in self._outbox
+                if (item["status"] == "pending" and item["next_attempt_at"] <= now)
+                or (item["status"] == "sending" and item["lease_until"] < now)
+            ]
+            due.sort(key=lambda item: item["next_attempt_at"])
+            claimed = []
+            for item in due[:limit]:
+                item["status"] = "sending"
+                item["lease_until"] = now + lease
+                payload = self._payloads[item["batch_id"]]
+                claimed.append({
+                    "id": item["id"], "batch_id": item["batch_id"], "caller_id": payload["caller_id"],
+                    "payload": payload["payload"], "recipient_id": item["recipient_id"], "attempts": item["attempts"],
+                    "channel_id": item["channel_id"], "message_id": item["message_id"],
+                })
+            if claimed:
+                self._save_outbox()
+            return claimed
+
+    def finish_notifications(self, updates: List[dict], now: float) -> None:
+        with self._lock:
+            by_id = {update["id"]: update for update in updates}
+            for item in self._outbox:
+                update = by_id.get(item["id"])
+                if update is None:
+                    continue
+                item.update(
+                    status=update["status"], attempts=update["attempts"], lease_until=None, updated_at=now,
+                    next_attempt_at=update.get("next_attempt_at", now), error=update.get("error"),
+                )
+                if update.get("message_id") is not None:
+                    item["channel_id"], item["message_id"] = update["channel_id"], update["message_id"]
+            self._save_outbox()
+
+    def block_recipients(self, recipient_ids: List[int], until: float, reason: str) -> None:
+        with self._lock:
+            for recipient_id in recipient_ids:
+                self._blocked[str(recipient_id)] = until
+            self._save_outbox()
+
+    def next_notification_at(self) -> Optional[float]:
+        with self._lock:
+            times = [
+                item["next_attempt_at"] if item["status"] == "pending" else item["lease_until"]
+                for item in self._outbox if item["status"] in ("pending", "sending")
+            ]
+        return min(times, default=None)
+
+    def outbox_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats: Dict[str, int] = {}
+            for item in self._outbox:
+                stats[item["status"]] = stats.get(item["status"], 0) + 1
+            return stats
+
+    def prune_outbox(self, before: float) -> int:
+        with self._lock:
+            kept = [
+                item for item in self._outbox
+                if item["status"] in ("pending", "sending") or item["updated_at"] >= before
+            ]
+            deleted = len(self._outbox) - len(kept)
+            self._outbox = kept
+            used = {item["batch_id"] for item in kept}
+            self._payloads = {
+                batch_id: payload for batch_id, payload in self._payloads.items()
+                if batch_id in used or payload["created_at"] >= before
+            }
+            self._blocked = {recipient_id: until for recipient_id, until in self._blocked.items() if until >= before}
+            self._save_outbox()
+            return deleted
+
+    def load_voice_sessions(self) -> Tuple[Dict[str, dict], Optional[float], Dict[str, list]]:
+        data = read_json(self.voice_file)
+        return data.get("sessions", {}), data.get("checkpoint_at"), data.get("leftovers", {})
+
+    def save_voice_sessions(self, sessions: Dict[str, dict], checkpoint_at: float,
+                            leftovers: Optional[Dict[str, list]] = None) -> None:
+        atomic_write_json(self.voice_file, {
+            "checkpoint_at": checkpoint_at, "sessions": sessions, "leftovers": leftovers or {}
+        })
+
+    def load_voice_stats(self) -> List[Tuple[str, int, bytes]]:
+        return [(series, block, data) for (series, block), data in self._voice_stats.items()]
+
+    def add_voice_minutes(self, deltas: Dict[BlockKey, Dict[int, int]]) -> Dict[BlockKey, bytes]:
+        with self._lock:
+            merged = {}
+            for key, block_deltas in deltas.items():
+                merged[key] = self._voice_stats[key] = merge_block(key[0], self._voice_stats.get(key), block_deltas)
+            atomic_write_json(self.voice_stats_file, {"blocks": {
+                f"{series}/{block}": base64.b64encode(data).decode()
+                for (series, block), data in self._voice_stats.items()
+            }})
+            return merged
+
+    def get_meta(self, key: str) -> Optional[str]:
+        return read_json(self.meta_file).get(key)
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._lock:
+            meta = read_json(self.meta_file)
+            meta[key] = value
+            atomic_write_json(self.meta_file, meta)
+
+    def last_change(self) -> int:
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteStorage:
+    """Хранилище в SQLite (режим WAL) с построчными изменениями.
+
+    При первом открытии переносит данные из старых JSON-файлов.
+    Одну базу могут использовать несколько процессов бота (например, по
+    процессу на группу шардов): записи идут транзакциями BEGIN IMMEDIATE,
+    счета меняются приращениями, а каждое изменение дописывается в журнал
+    changes, по которому остальные процессы обновляют свои кэши.
+    """
+
+    # Сколько последних записей журнала изменений хранить
+    CHANGES_KEEP = 10000
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS friends (
+            user_id INTEGER NOT NULL,
+            friend_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (user_id, friend_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS friends_by_friend ON friends (friend_id);
+        CREATE TABLE IF NOT EXISTS scores (
+            user_id INTEGER PRIMARY KEY,
+            score INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS voice_sessions (
+            scope TEXT NOT NULL DEFAULT '',
+            user_id INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            started_at REAL NOT NULL,
+            state TEXT NOT NULL DEFAULT '{}',
+            PRIMARY KEY (scope, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS voice_stats (
+            series TEXT NOT NULL,
+            block INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (series, block)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS purchases (
+            user_id INTEGER NOT NULL,
+            item TEXT NOT NULL,
+            purchased_at REAL NOT NULL,
+            PRIMARY KEY (user_id, item)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS purchase_ledger (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            purchase_key TEXT NOT NULL,
+            event TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            item TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            UNIQUE (purchase_key, event)
+        );
+        CREATE INDEX IF NOT EXISTS purchase_ledger_by_user ON purchase_ledger (user_id, item);
+        CREATE TABLE IF NOT EXISTS outbox_payloads (
+            batch_id TEXT PRIMARY KEY,
+            caller_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT NOT NULL,
+            recipient_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            lease_until REAL,
+            updated_at REAL NOT NULL,
+            error TEXT,
+            channel_id INTEGER,
+            message_id INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+        CREATE INDEX IF NOT EXISTS outbox_by_batch ON outbox (batch_id);
+        CREATE TABLE IF NOT EXISTS dm_blocked (
+            recipient_id INTEGER PRIMARY KEY,
+            until REAL NOT NULL,
+            reason TEXT
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            other_id INTEGER,
+            value TEXT
+        );
+    """
+
+    def __init__(self, db_file: str, data_file: str = None, score_file: str = None,
+                 busy_timeout: float = 10.0, scope: str = ""):
+        self.db_file = db_file
+        # Часть контрольной точки голосовых сессий, принадлежащая этому процессу
+        self.scope = scope
+        # Метка процесса в журнале изменений, чтобы не применять свои же записи
+        self.origin = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self._lock = threading.RLock()
+        # Соединение используется из разных потоков, доступ защищен блокировкой.
+        # busy_timeout: сколько ждать, пока другой процесс держит блокировку записи
+        self._conn = sqlite3.connect(db_file, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # FULL: подтвержденная транзакция (списание за покупку, счета) переживает отключение питания
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(self.SCHEMA)
+        self._upgrade_schema()
+        self._migrate_json(data_file, score_file)
+        # PRAGMA data_version меняется только после записи другим соединением
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _upgrade_schema(self) -> None:
+        """Привести базы, созданные старыми версиями, к текущей схеме"""
+        with self._transaction() as conn:
+            columns = {row[1]: row for row in conn.execute("PRAGMA table_info(voice_sessions)")}
+            if "scope" not in columns:
+                conn.execute("ALTER TABLE voice_sessions ADD COLUMN scope TEXT NOT NULL DEFAULT ''")
+            if "state" not in columns:
+                conn.execute("ALTER TABLE voice_sessions ADD COLUMN state TEXT NOT NULL DEFAULT '{}'")
+            # Раньше ключом был только user_id, и сессии разных процессов затирали друг друга
+            if columns["user_id"][5] and "scope" in columns and columns["scope"][5]:
+                return
+            conn.execute("ALTER TABLE voice_sessions RENAME TO voice_sessions_old")
+            conn.execute(
+                "CREATE TABLE voice_sessions ("
+                "scope TEXT NOT NULL DEFAULT '', user_id INTEGER NOT NULL, guild_id INTEGER NOT NULL, "
+                "channel_id INTEGER NOT NULL, started_at REAL NOT NULL, state TEXT NOT NULL DEFAULT '{}', "
+                "PRIMARY KEY (scope, user_id)) WITHOUT ROWID"
+            )
+            conn.execute(
+                "INSERT INTO voice_sessions (scope, user_id, guild_id, channel_id, started_at, state) "
+                "SELECT scope, user_id, guild_id, channel_id, started_at, state FROM voice_sessions_old"
+            )
+            conn.execute("DROP TABLE voice_sessions_old")
+
+    def _log(self, conn: sqlite3.Connection, rows: List[tuple]) -> None:
+        """Дописать изменения в журнал (внутри уже открытой транзакции)"""
+        conn.executemany(
+            "INSERT INTO changes (origin, kind, user_id, other_id, value) VALUES (?, ?, ?, ?, ?)",
+            [(self.origin, *row) for row in rows]
+        )
+
+    def _transaction(self):
+        return _Transaction(self._conn, self._lock)
+
+    def _migrate_json(self, data_file: str, score_file: str) -> None:
+        """Одноразовый перенос данных из friends_data.json и user_scores.json"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+            if row is not None:
+                return
+            friends = read_json(data_file) if data_file else {}
+            scores = read_json(score_file) if score_file else {}
+            for user_id, friend_ids in friends.items():
+                conn.executemany(
+                    "INSERT OR IGNORE INTO friends (user_id, friend_id, position) VALUES (?, ?, ?)",
+                    [(int(user_id), int(friend_id), position) for position, friend_id in enumerate(friend_ids)]
+                )
+            conn.executemany(
+                "INSERT INTO scores (user_id, score) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET score = excluded.score",
+                [(int(user_id), int(score)) for user_id, score in scores.items()]
+            )
+            conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', '1')")
+        if friends or scores:
+            print(f"Данные перенесены из JSON в {self.db_file}: {len(friends)} списков друзей, {len(scores)} счетов")
+
+    def load_friends(self) -> Dict[str, List[str]]:
+        data: Dict[str, List[str]] = {}
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, friend_id FROM friends ORDER BY user_id, position").fetchall()
+        for user_id, friend_id in rows:
+            data.setdefault(str(user_id), []).append(str(friend_id))
+        return data
+
+    def add_friend(self, user_id: str, friend_id: str) -> None:
+        self.add_friends(user_id, [friend_id])
+
+    def remove_friend(self, user_id: str, friend_id: str) -> None:
+        self.remove_friends(user_id, [friend_id])
+
+    def add_friends(self, user_id: str, friend_ids: List[str]) -> None:
+        """Добавить несколько друзей одной транзакцией"""
+        user_id = int(user_id)
+        with self._transaction() as conn:
+            (start,) = conn.execute(
+                "SELECT COALESCE(MAX(position) + 1, 0) FROM friends WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            conn.executemany(
+                "INSERT OR IGNORE INTO friends (user_id, friend_id, position) VALUES (?, ?, ?)",
+                [(user_id, int(friend_id), start + offset) for offset, friend_id in enumerate(friend_ids)]
+            )
+            self._log(conn, [("friend_add", user_id, int(friend_id), None) for friend_id in friend_ids])
+
+    def remove_friends(self, user_id: str, friend_ids: List[str]) -> None:
+        """Удалить несколько друзей одной транзакцией"""
+        user_id = int(user_id)
+        with self._transaction() as conn:
+            conn.executemany(
+                "DELETE FROM friends WHERE user_id = ? AND friend_id = ?",
+                [(user_id, int(friend_id)) for friend_id in friend_ids]
+            )
+            self._log(conn, [("friend_remove", user_id, int(friend_id), None) for friend_id in friend_ids])
+
+    def remove_user(self, user_id: str) -> None:
+        """Удалить список друзей пользователя и его самого из чужих списков"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM friends WHERE user_id = ? OR friend_id = ?", (int(user_id), int(user_id)))
+            self._log(conn, [("user_remove", int(user_id), None, None)])
+
+    def load_scores(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, score FROM scores").fetchall()
+        return {str(user_id): score for user_id, score in rows}
+
+    def add_scores(self, deltas: Dict[str, int]) -> Dict[str, int]:
+        """Прибавить изменения к счетам (не ниже нуля) одной транзакцией.
+
+        Не затирает начисления других процессов.
+        Возвращает новые значения счетов.
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO scores (user_id, score) VALUES (?, 0)",
+                [(int(user_id),) for user_id in deltas]
+            )
+            conn.executemany(
+                "UPDATE scores SET score = MAX(score + ?, 0) WHERE user_id = ?",
+                [(int(delta), int(user_id)) for user_id, delta in deltas.items()]
+            )
+            self._log(conn, [("score", int(user_id), None, None) for user_id in deltas])
+            return self._read_scores(conn, deltas)
+
+    @staticmethod
+    def _read_scores(conn: sqlite3.Connection, user_ids) -> Dict[str, int]:
+        result = {}
+        ids = [int(user_id) for user_id in user_ids]
+        # Не больше 500 параметров в одном запросе
+        for offset in range(0, len(ids), 500):
+            chunk = ids[offset:offset + 500]
+            rows = conn.execute(
+                f"SELECT user_id, score FROM scores WHERE user_id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            result.update({str(user_id): score for user_id, score in rows})
+        return result
+
+    def load_purchases(self) -> Dict[str, List[str]]:
+        data: Dict[str, List[str]] = {}
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, item FROM purchases ORDER BY purchased_at").fetchall()
+        for user_id, item in rows:
+            data.setdefault(str(user_id), []).append(item)
+        return data
+
+    def reserve_purchase(self, key: str, user_id: str, item: str, price: int, now: float) -> Tuple[str, Optional[int]]:
+        """Списать очки под покупку до обращений к Discord.
+
+        Одна транзакция: проверка ключа идемпотентности и прошлых покупок,
+        списание только при достаточном счете и запись ``reserve`` в журнал
+        покупок. Возвращает (статус, новый счет или None).
+        """
+        user_id = int(user_id)
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM purchase_ledger WHERE purchase_key = ?", (key,)).fetchone():
+                return PURCHASE_DUPLICATE, None
+            if conn.execute("SELECT 1 FROM purchases WHERE user_id = ? AND item = ?", (user_id, item)).fetchone():
+                return PURCHASE_OWNED, None
+            row = conn.execute(
+                "UPDATE scores SET score = score - ? WHERE user_id = ? AND score >= ? RETURNING score",
+                (price, user_id, price)
+            ).fetchone()
+            if row is None:
+                return PURCHASE_INSUFFICIENT, None
+            conn.execute(
+                "INSERT INTO purchase_ledger (purchase_key, event, user_id, item, amount, created_at) "
+                "VALUES (?, 'reserve', ?, ?, ?, ?)",
+                (key, user_id, item, -price, now)
+            )
+            self._log(conn, [("score", user_id, None, None)])
+            return PURCHASE_RESERVED, row[0]
+
+    def _reservation(self, conn: sqlite3.Connection, key: str) -> Optional[tuple]:
+        """Резерв без итога (complete/refund) по ключу: (ID пользователя, товар, сумма) или None"""
+        return conn.execute(
+            "SELECT user_id, item, amount FROM purchase_ledger AS r WHERE purchase_key = ? AND event = 'reserve' "
+            "AND NOT EXISTS (SELECT 1 FROM purchase_ledger WHERE purchase_key = r.purchase_key "
+            "AND event IN ('complete', 'refund'))",
+            (key,)
+        ).fetchone()
+
+    def mark_applying(self, key: str, now: float) -> bool:
+        """Отметить, что по резерву начались изменения в Discord (запись ``applying``).
+
+        Резерв с такой отметкой, оставшийся без итога, recover() подтверждает,
+        а не возмещает: роли могли быть уже выданы.
+        """
+        with self._transaction() as conn:
+            reservation = self._reservation(conn, key)
+            if reservation is None:
+                return False
+            user_id, item, _ = reservation
+            conn.execute(
+                "INSERT OR IGNORE INTO purchase_ledger (purchase_key, event, user_id, item, amount, created_at) "
+                "VALUES (?, 'applying', ?, ?, 0, ?)",
+                (key, user_id, item, now)
+            )
+            return True
+
+    def complete_purchase(self, key: str, now: float) -> bool:
+        """Подтвердить покупку: запись ``complete`` и отметка «уже куплено»"""
+        with self._transaction() as conn:
+            reservation = self._reservation(conn, key)
+            if reservation is None:
+                return False
+            user_id, item, _ = reservation
+            conn.execute(
+                "INSERT INTO purchase_ledger (purchase_key, event, user_id, item, amount, created_at) "
+                "VALUES (?, 'complete', ?, ?, 0, ?)",
+                (key, user_id, item, now)
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO purchases (user_id, item, purchased_at) VALUES (?, ?, ?)",
+                (user_id, item, now)
+            )
+            self._log(conn, [("purchase", user_id, None, item)])
+            return True
+
+    def refund_purchase(self, key: str, now: float) -> Optional[Tuple[str, int]]:
+        """Вернуть очки за несостоявшуюся покупку. Возвращает (ID пользователя, новый счет) или None"""
+        with self._transaction() as conn:
+            reservation = self._reservation(conn, key)
+            if reservation is None:
+                return None
+            user_id, item, amount = reservation
+            conn.execute(
+                "INSERT INTO purchase_ledger (purchase_key, event, user_id, item, amount, created_at) "
+                "VALUES (?, 'refund', ?, ?, ?, ?)",
+                (key, user_id, item, -amount, now)
+            )
+            score = conn.execute(
+                "UPDATE scores SET score = score + ? WHERE user_id = ? RETURNING score", (-amount, user_id)
+            ).fetchone()[0]
+            self._log(conn, [("score", user_id, None, None)])
+            return str(user_id), score
+
+    def stale_purchases(self, before: float) -> List[Tuple[str, bool]]:
+        """Резервы без итога, сделанные раньше before (процесс упал посреди покупки).
+
+        Возвращает [(ключ, были ли начаты изменения в Discord), ...].
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT purchase_key, EXISTS (SELECT 1 FROM purchase_ledger WHERE purchase_key = r.purchase_key "
+                "AND event = 'applying') FROM purchase_ledger AS r WHERE event = 'reserve' AND created_at < ? "
+                "AND NOT EXISTS (SELECT 1 FROM purchase_ledger WHERE purchase_key = r.purchase_key "
+                "AND event IN ('complete', 'refund'))",
+                (before,)
+            ).fetchall()
+        return [(key, bool(applying)) for key, applying in rows]
+
+    def get_meta(self, key: str) -> Optional[str]:
+        """Служебное значение из таблицы meta (None, если не задано)"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+
+    def last_change(self) -> int:
+        """Номер последней записи журнала изменений"""
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def changes_since(self, seq: int) -> Tuple[int, Optional[List[Change]]]:
+        """Изменения других процессов после записи seq журнала.
+
+        Возвращает (новый seq, список изменений). Для изменений счета в
+        значении лежит текущий счет. Если нужные записи журнала уже удалены,
+        вместо списка возвращается None - кэши надо перечитать целиком.
+        """
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                # Другие соединения ничего не записывали - запрос к журналу не нужен
+                return seq, []
+            with self._transaction() as conn:
+                self._data_version = data_version
+                (first,) = conn.execute("SELECT COALESCE(MIN(seq), 0) FROM changes").fetchone()
+                rows = conn.execute(
+                    "SELECT seq, origin, kind, user_id, other_id, value FROM changes WHERE seq > ? ORDER BY seq",
+                    (seq,)
+                ).fetchall()
+                last = rows[-1][0] if rows else seq
+                if first > seq + 1:
+                    return last, None
+                changes = [
+                    (kind, user_id, other_id, value)
+                    for _, origin, kind, user_id, other_id, value in rows if origin != self.origin
+                ]
+                scores = self._read_scores(conn, {user_id for kind, user_id, _, _ in changes if kind == "score"})
+                changes = [
+                    (kind, user_id, other_id, str(scores.get(str(user_id), 0)) if kind == "score" else value)
+                    for kind, user_id, other_id, value in changes
+                ]
+                # Журнал не растет бесконечно: оставляем последние CHANGES_KEEP записей
+                conn.execute("DELETE FROM changes WHERE seq <= ?", (last - self.CHANGES_KEEP,))
+            return last, changes
+
+    def enqueue_notifications(self, batch_id: str, caller_id: int, payload: str,
+                              recipients: List[Tuple[int, Optional[int], Optional[int]]], now: float) -> Dict[int, str]:
+        """Поставить рассылку в очередь одной транзакцией.
+
+        recipients - (ID получателя, ID канала и ID сообщения для редактирования
+        или None). Получатели с закрытыми ЛС сразу получают статус blocked.
+        Возвращает ID получателя -> начальный статус.
+        """
+        with self._transaction() as conn:
+            blocked = {
+                recipient_id for (recipient_id,) in conn.execute(
+                    "SELECT recipient_id FROM dm_blocked WHERE until > ?", (now,)
+                )
+            }
+            conn.execute(
+                "INSERT INTO outbox_payloads (batch_id, caller_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                (batch_id, int(caller_id), payload, now)
+            )
+            statuses = {
+                int(recipient_id): "blocked" if int(recipient_id) in blocked else "pending"
+                for recipient_id, _, _ in recipients
+            }
+            conn.executemany(
+                "INSERT INTO outbox (batch_id, recipient_id, status, next_attempt_at, updated_at, channel_id, message_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (batch_id, int(recipient_id), statuses[int(recipient_id)], now, now, channel_id, message_id)
+                    for recipient_id, channel_id, message_id in recipients
+                ]
+            )
+        return statuses
+
+    def claim_notifications(self, now: float, limit: int, lease: float) -> List[dict]:
+        """Забрать готовые к отправке уведомления (с арендой на lease секунд).
+
+        Аренда не дает другому процессу взять те же строки, а если процесс
+        упал посреди отправки, после ее окончания строки снова станут доступны.
+        """
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "UPDATE outbox SET status = 'sending', lease_until = ? WHERE id IN ("
+                "  SELECT id FROM outbox WHERE (status = 'pending' AND next_attempt_at <= ?)"
+                "  OR (status = 'sending' AND lease_until < ?) ORDER BY next_attempt_at LIMIT ?"
+                ") RETURNING id, batch_id, recipient_id, attempts, channel_id, message_id",
+                (now + lease, now, now, limit)
+            ).fetchall()
+            batch_ids = {row[1] for row in rows}
+            payloads = {
+                batch_id: (caller_id, payload)
+                for batch_id, caller_id, payload in conn.execute(
+                    f"SELECT batch_id, caller_id, payload FROM outbox_payloads "
+                    f"WHERE batch_id IN ({','.join('?' * len(batch_ids))})", list(batch_ids)
+                )
+            } if batch_ids else {}
+        return [
+            {
+                "id": id_, "batch_id": batch_id, "caller_id": payloads[batch_id][0], "payload": payloads[batch_id][1],
+                "recipient_id": recipient_id, "attempts": attempts, "channel_id": channel_id, "message_id": message_id,
+            }
+            for id_, batch_id, recipient_id, attempts, channel_id, message_id in rows
+        ]
+
+    def finish_notifications(self, updates: List[dict], now: float) -> None:
+        """Записать результаты попыток: статус, число попыток, время следующей, ошибку, ID сообщения"""
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, lease_until = NULL, "
+                "updated_at = ?, error = ?, channel_id = COALESCE(?, channel_id), message_id = COALESCE(?, message_id) "
+                "WHERE id = ?",
+                [
+                    (u["status"], u["attempts"], u.get("next_attempt_at", now), now, u.get("error"),
+                     u.get("channel_id"), u.get("message_id"), u["id"])
+                    for u in updates
+                ]
+            )
+
+    def block_recipients(self, recipient_ids: List[int], until: float, reason: str) -> None:
+        """Не отправлять получателям уведомления до until (например, закрыты ЛС)"""
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO dm_blocked (recipient_id, until, reason) VALUES (?, ?, ?) "
+                "ON CONFLICT(recipient_id) DO UPDATE SET until = excluded.until, reason = excluded.reason",
+                [(int(recipient_id), until, reason) for recipient_id in recipient_ids]
+            )
+
+    def next_notification_at(self) -> Optional[float]:
+        """Время ближайшей запланированной попытки или None, если очередь пуста"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(CASE status WHEN 'pending' THEN next_attempt_at ELSE lease_until END) "
+                "FROM outbox WHERE status IN ('pending', 'sending')"
+            ).fetchone()
+        return row[0]
+
+    def outbox_stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return dict(rows)
+
+    def prune_outbox(self, before: float) -> int:
+        """Удалить завершенные уведомления старше before и их общие данные"""
+        with self._transaction() as conn:
+            deleted = conn.execute(
+                "DELETE FROM outbox WHERE status IN ('sent', 'failed', 'blocked') AND updated_at < ?", (before,)
+            ).rowcount
+            conn.execute(
+                "DELETE FROM outbox_payloads WHERE created_at < ? "
+                "AND NOT EXISTS (SELECT 1 FROM outbox WHERE outbox.batch_id = outbox_payloads.batch_id)",
+                (before,)
+            )
+            conn.execute("DELETE FROM dm_blocked WHERE until < ?", (before,))
+        return deleted
+
+    def load_voice_sessions(self) -> Tuple[Dict[str, dict], Optional[float], Dict[str, list]]:
+        """Контрольная точка: сессии, ее время и остатки неполных минут после выхода"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, guild_id, channel_id, started_at, state FROM voice_sessions WHERE scope = ?",
+                (self.scope,)
+            ).fetchall()
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (self._checkpoint_key,)).fetchone()
+            leftovers = self._conn.execute("SELECT value FROM meta WHERE key = ?", (self._leftover_key,)).fetchone()
+        sessions = {
+            str(user_id): {**json.loads(state), "guild_id": guild_id, "channel_id": channel_id, "started_at": started_at}
+            for user_id, guild_id, channel_id, started_at, state in rows
+        }
+        return (
+            sessions,
+            float(row[0]) if row is not None else None,
+            json.loads(leftovers[0]) if leftovers is not None else {},
+        )
+
+    @property
+    def _checkpoint_key(self) -> str:
+        return f"voice_checkpoint_at:{self.scope}" if self.scope else "voice_checkpoint_at"
+
+    @property
+    def _leftover_key(self) -> str:
+        return f"voice_leftovers:{self.scope}" if self.scope else "voice_leftovers"
+
+    def save_voice_sessions(self, sessions: Dict[str, dict], checkpoint_at: float,
+                            leftovers: Optional[Dict[str, list]] = None) -> None:
+        """Контрольная точка открытых голосовых сессий (только своей части шардов).
+
+        Кроме канала и начала неучтенного времени сохраняются остаток неполной
+        минуты и состояние (бот, AFK, микрофон, звук), а также остатки
+        пользователей, недавно вышедших из войса.
+        """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM voice_sessions WHERE scope = ?", (self.scope,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO voice_sessions (user_id, guild_id, channel_id, started_at, scope, state) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        int(user_id), data["guild_id"], data["channel_id"], data["started_at"], self.scope,
+                        json.dumps({key: value for key, value in data.items()
+                                    if key not in ("guild_id", "channel_id", "started_at")})
+                    )
+                    for user_id, data in sessions.items()
+                ]
+            )
+            conn.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                [(self._checkpoint_key, repr(checkpoint_at)), (self._leftover_key, json.dumps(leftovers or {}))]
+            )
+
+    def load_voice_stats(self) -> List[Tuple[str, int, bytes]]:
+        """Блоки статистики войса: (ряд, номер блока, минуты по дням)"""
+        with self._lock:
+            return self._conn.execute("SELECT series, block, data FROM voice_stats").fetchall()
+
+    def add_voice_minutes(self, deltas: Dict[BlockKey, Dict[int, int]]) -> Dict[BlockKey, bytes]:
+        """Прибавить минуты к блокам статистики войса. Возвращает новые блоки целиком"""
+        merged = {}
+        with self._transaction() as conn:
+            for (series, block), block_deltas in deltas.items():
+                row = conn.execute(
+                    "SELECT data FROM voice_stats WHERE series = ? AND block = ?", (series, block)
+                ).fetchone()
+                data = merge_block(series, row[0] if row is not None else None, block_deltas)
+                conn.execute(
+                    "INSERT INTO voice_stats (series, block, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT(series, block) DO UPDATE SET data = excluded.data",
+                    (series, block, data)
+                )
+                merged[(series, block)] = data
+        return merged
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class _Transaction:
+    """Контекстный менеджер транзакции: BEGIN IMMEDIATE ... COMMIT/ROLLBACK"""
+
+    def __init__(self, conn: sqlite3.Connection, lock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.lock.acquire()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.lock.release()
+            raise
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is None:
+                self.conn.execute("COMMIT")
+            else:
+                self.conn.execute("ROLLBACK")
+        finally:
+            self.lock.release()
+
+
+def create_storage(backend: str, db_file: str, data_file: str, score_file: str, voice_file: str = "voice_sessions.json",
+                   purchase_file: str = "purchases.json", outbox_file: str = "outbox.json", scope: str = "",
+                   meta_file: str = "bot_meta.json", ledger_file: str = "purchase_ledger.jsonl",
+                   voice_stats_file: str = "voice_stats.json"):
+    """Создать хранилище по названию бэкенда из config.py"""
+    if backend == "sqlite":
+        return SqliteStorage(db_file, data_file, score_file, scope=scope)
+    if backend == "json":
+        return JsonStorage(data_file, score_file, voice_file, purchase_file, outbox_file, meta_file, ledger_file,
+                           voice_stats_file)
+    raise ValueError(f"Неизвестный бэкенд хранилища: {backend}")
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from persistence import PersistenceWorker  # noqa: E402
+from storage import create_storage  # noqa: E402
+
+
+def make_storage(backend: str, directory, scope: str = ""):
+    """Хранилище с файлами во временном каталоге"""
+    path = str(directory)
+    return create_storage(
+        backend,
+        os.path.join(path, "bot_data.db"),
+        os.path.join(path, "friends_data.json"),
+        os.path.join(path, "user_scores.json"),
+        voice_file=os.path.join(path, "voice_sessions.json"),
+        purchase_file=os.path.join(path, "purchases.json"),
+        outbox_file=os.path.join(path, "outbox.json"),
+        scope=scope,
+        meta_file=os.path.join(path, "bot_meta.json"),
+        ledger_file=os.path.join(path, "purchase_ledger.jsonl"),
+        voice_stats_file=os.path.join(path, "voice_stats.json"),
+    )
+
+
+@pytest.fixture(params=["sqlite", "json"])
+def storage(request, tmp_path):
+    store = make_storage(request.param, tmp_path)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    store = make_storage("sqlite", tmp_path)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def persistence():
+    worker = PersistenceWorker()
+    yield worker
+    worker.close()
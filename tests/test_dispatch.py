@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+import disnake
+
+from dispatch import STATUS_FAILED, STATUS_SENT, FanOutDispatcher
+
+
+class FakeResponse:
+    def __init__(self, status: int, headers=None):
+        self.status = status
+        self.reason = ""
+        self.headers = headers or {}
+
+
+def http_error(status: int, code: int = 0, retry_after=None) -> disnake.HTTPException:
+    headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+    return disnake.HTTPException(FakeResponse(status, headers), {"message": "error", "code": code})
+
+
+def test_concurrency_is_bounded():
+    dispatcher = FanOutDispatcher(concurrency=3)
+    active = peak = 0
+
+    async def send(recipient_id):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+
+    report = asyncio.run(dispatcher.dispatch(range(20), send))
+    assert peak == 3
+    assert report.sent == 20
+
+
+def test_429_pauses_the_whole_dispatch():
+    dispatcher = FanOutDispatcher(concurrency=1)
+    attempted = []
+
+    async def send(recipient_id):
+        attempted.append(recipient_id)
+        if recipient_id == 1:
+            raise http_error(429, retry_after=30)
+
+    started = time.monotonic()
+    report = asyncio.run(dispatcher.dispatch([1, 2, 3], send))
+    # Рассылка не спит на 429, а сразу возвращает остальных с retry_after
+    assert time.monotonic() - started < 5
+    assert attempted == [1]
+    first = report.results[1]
+    assert first.http_status == 429 and first.retryable and first.retry_after == 30
+    for recipient_id in (2, 3):
+        result = report.results[recipient_id]
+        assert result.attempts == 0
+        assert result.retryable
+        assert 25 < result.retry_after <= 30
+
+
+def test_pause_carries_over_to_next_dispatch():
+    dispatcher = FanOutDispatcher()
+
+    async def limited(recipient_id):
+        raise http_error(429, retry_after=30)
+
+    async def ok(recipient_id):
+        pass
+
+    async def run():
+        await dispatcher.dispatch([1], limited)
+        return await dispatcher.dispatch([2], ok)
+
+    report = asyncio.run(run())
+    assert report.results[2].status == STATUS_FAILED
+    assert report.results[2].attempts == 0
+
+
+def test_5xx_and_network_errors_are_retryable():
+    dispatcher = FanOutDispatcher()
+
+    async def send(recipient_id):
+        if recipient_id == 1:
+            raise http_error(502)
+        if recipient_id == 2:
+            raise OSError("connection reset")
+        if recipient_id == 3:
+            raise http_error(403, code=50007)
+
+    report = asyncio.run(dispatcher.dispatch([1, 2, 3, 4], send))
+    assert report.results[1].retryable and report.results[1].http_status == 502
+    assert report.results[2].retryable
+    assert not report.results[3].retryable and report.results[3].code == 50007
+    assert report.results[4].status == STATUS_SENT
+    assert report.failed == 3
+
+
+def test_progress_is_reported():
+    dispatcher = FanOutDispatcher(progress_interval=0)
+    seen = []
+
+    async def send(recipient_id):
+        pass
+
+    async def on_progress(report, total):
+        seen.append((len(report.results), total))
+
+    asyncio.run(dispatcher.dispatch([1, 2, 3], send, on_progress=on_progress))
+    assert seen[-1] == (3, 3)
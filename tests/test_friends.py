@@ -0,0 +1,52 @@
+from friends import FriendGraph
+
+
+def test_add_remove_and_followers():
+    graph = FriendGraph()
+    assert graph.add(1, 2)
+    assert not graph.add("1", "2")
+    graph.add(3, 2)
+    assert graph.followers(2) == {1, 3}
+    assert graph.remove(1, 2)
+    assert graph.followers(2) == {3}
+    assert len(graph) == 1
+
+
+def test_order_of_friends_is_kept():
+    graph = FriendGraph()
+    for friend_id in (5, 3, 4):
+        graph.add(1, friend_id)
+    assert graph.friends(1) == [5, 3, 4]
+
+
+def test_remove_user_drops_both_directions():
+    graph = FriendGraph()
+    graph.add(1, 2)
+    graph.add(2, 3)
+    assert graph.remove_user(2) == 2
+    assert graph.friends(1) == [] and graph.followers(3) == set()
+
+
+def test_listeners_see_changes():
+    graph = FriendGraph()
+    seen = []
+    graph.add_listener(lambda owner, friend, added: seen.append((owner, friend, added)))
+    graph.add(1, 2)
+    graph.remove(1, 2)
+    assert seen == [(1, 2, True), (1, 2, False)]
+
+
+def test_json_round_trip():
+    data = {"1": ["3", "2"], "2": ["1"]}
+    graph = FriendGraph.from_json(data)
+    assert graph.to_json() == data
+    assert FriendGraph.from_json(graph.to_json()).friends(1) == [3, 2]
+
+
+def test_sync_changes_only_differences():
+    graph = FriendGraph.from_json({"1": ["2", "3"]})
+    seen = []
+    graph.add_listener(lambda owner, friend, added: seen.append((owner, friend, added)))
+    graph.sync({"1": ["3", "4"]})
+    assert sorted(seen) == [(1, 2, False), (1, 4, True)]
+    assert graph.friends(1) == [3, 4]
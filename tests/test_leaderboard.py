@@ -0,0 +1,27 @@
+from leaderboard import Leaderboard
+
+
+def test_rank_and_ties():
+    board = Leaderboard({"1": 50, "2": 100, "3": 50, "4": 0})
+    assert len(board) == 3
+    assert board.rank("2") == 1
+    assert board.rank("1") == board.rank("3") == 2
+    assert board.rank("4") is None
+
+
+def test_update_moves_user():
+    board = Leaderboard({"1": 50, "2": 100})
+    board.update("1", 150)
+    assert board.rank("1") == 1
+    board.update("1", 0)
+    assert board.rank("1") is None
+    assert len(board) == 1
+
+
+def test_pages_and_percentile():
+    board = Leaderboard({str(user_id): user_id for user_id in range(1, 26)})
+    assert board.page_count(10) == 3
+    assert board.page(1, 10)[0] == (1, 25, 25)
+    assert [user_id for _, user_id, _ in board.page(3, 10)] == [5, 4, 3, 2, 1]
+    assert board.percentile("25") == 96.0
+    assert board.percentile("1") == 0.0
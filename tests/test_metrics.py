@@ -0,0 +1,54 @@
+import asyncio
+
+import disnake.http
+
+from metrics import Metrics
+
+
+class FakeResponse:
+    def __init__(self, status: int):
+        self.status = status
+        self.headers = {"Content-Type": "text/plain"}
+
+    async def text(self, encoding=None):
+        return ""
+
+
+class FakeRoute:
+    method = "POST"
+    path = "/channels/{channel_id}/messages"
+
+
+class FakeHTTP:
+    """Как HTTPClient.request: повторяет 429 сам и читает каждый ответ"""
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+
+    async def request(self, route, **kwargs):
+        while True:
+            response = FakeResponse(self.statuses.pop(0))
+            await disnake.http.json_or_text(response)
+            if response.status != 429:
+                return response.status
+
+
+def test_retried_429_are_counted():
+    metrics = Metrics()
+    http = FakeHTTP([429, 429, 200])
+    metrics.instrument_http(http)
+    assert asyncio.run(http.request(FakeRoute())) == 200
+    label = "POST /channels/{channel_id}/messages"
+    assert metrics.counters["rest_ratelimited_total"][label] == 2
+    assert metrics.counters["rest_requests_total"][label] == 1
+    assert not metrics.counters["rest_errors_total"]
+
+
+def test_instrumenting_twice_does_not_double_count():
+    first, second = Metrics(), Metrics()
+    http = FakeHTTP([429, 200])
+    first.instrument_http(FakeHTTP([]))
+    second.instrument_http(http)
+    asyncio.run(http.request(FakeRoute()))
+    assert sum(second.counters["rest_ratelimited_total"].values()) == 1
+    assert not first.counters["rest_ratelimited_total"]
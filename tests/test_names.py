@@ -0,0 +1,46 @@
+from friends import FriendGraph
+from names import FriendNameIndex
+
+
+def make_index(names):
+    graph = FriendGraph()
+    index = FriendNameIndex(graph, names.get)
+    return graph, index
+
+
+def test_search_by_prefix_case_insensitive():
+    graph, index = make_index({2: "Alice", 3: "albert", 4: "Bob"})
+    for friend_id in (2, 3, 4):
+        graph.add(1, friend_id)
+    assert index.search(1, "al") == [("albert", 3), ("Alice", 2)]
+    assert index.search(1, "B") == [("Bob", 4)]
+    assert index.search(5, "a") == []
+
+
+def test_removed_friend_disappears():
+    graph, index = make_index({2: "Alice"})
+    graph.add(1, 2)
+    graph.remove(1, 2)
+    assert index.search(1, "") == []
+
+
+def test_unknown_friend_is_renamed_once_cached():
+    names = {}
+    graph, index = make_index(names)
+    graph.add(1, 2)
+    assert index.search(1, "") == [("2", 2)]
+    # Имя появилось в кэше (например, участник подгружен лениво)
+    names[2] = "Alice"
+    assert index.search(1, "ali") == [("Alice", 2)]
+
+
+def test_rename_updates_all_owners():
+    names = {3: "Carol"}
+    graph, index = make_index(names)
+    graph.add(1, 3)
+    graph.add(2, 3)
+    index.search(1, "")
+    index.search(2, "")
+    index.rename(3, "Caroline")
+    assert index.search(1, "caroline") == [("Caroline", 3)]
+    assert index.search(2, "caroline") == [("Caroline", 3)]
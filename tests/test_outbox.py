@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import disnake
+import pytest
+
+import outbox as outbox_module
+from metrics import Metrics
+from outbox import (CANNOT_MESSAGE_USER, OUTBOX_BLOCKED, OUTBOX_FAILED, OUTBOX_PENDING, OUTBOX_SENT,
+                    NotificationOutbox)
+
+
+class FakeResponse:
+    def __init__(self, status: int, headers=None):
+        self.status = status
+        self.reason = ""
+        self.headers = headers or {}
+
+
+def http_error(status: int, code: int = 0, retry_after=None) -> disnake.HTTPException:
+    headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+    return disnake.HTTPException(FakeResponse(status, headers), {"message": "error", "code": code})
+
+
+class Sender:
+    """Отправка с заранее заданными ошибками по получателям"""
+
+    def __init__(self, errors=None):
+        self.errors = {recipient_id: list(errors) for recipient_id, errors in (errors or {}).items()}
+        self.sent = []
+
+    async def __call__(self, recipient_id, payload, target):
+        errors = self.errors.get(recipient_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append(recipient_id)
+        return 1000 + recipient_id, 2000 + recipient_id
+
+
+def make_outbox(storage, persistence, sender, **kwargs):
+    kwargs.setdefault("base_delay", 0.01)
+    kwargs.setdefault("max_delay", 0.05)
+    return NotificationOutbox(storage, persistence, sender, **kwargs)
+
+
+def run_batch(outbox, recipients, retries=True):
+    done = {}
+
+    async def on_done(counts):
+        done.update(counts)
+
+    async def run():
+        statuses = await outbox.enqueue(1, {"embed": {}}, [(r, None) for r in recipients], on_done=on_done)
+        await outbox.drain(retries=retries)
+        return statuses
+
+    statuses = asyncio.run(run())
+    return statuses, done
+
+
+def test_delivers_and_reports(storage, persistence):
+    sender = Sender()
+    statuses, done = run_batch(make_outbox(storage, persistence, sender), [1, 2, 3])
+    assert statuses == {1: OUTBOX_PENDING, 2: OUTBOX_PENDING, 3: OUTBOX_PENDING}
+    assert sorted(sender.sent) == [1, 2, 3]
+    assert done == {OUTBOX_SENT: 3}
+
+
+def test_retries_after_429_and_5xx(storage, persistence):
+    sender = Sender({1: [http_error(429, retry_after=0.01)], 2: [http_error(502), http_error(500)]})
+    _, done = run_batch(make_outbox(storage, persistence, sender), [1, 2])
+    assert sorted(sender.sent) == [1, 2]
+    assert done == {OUTBOX_SENT: 2}
+
+
+def test_429_is_deferred_not_slept(storage, persistence):
+    sender = Sender({1: [http_error(429, retry_after=30)]})
+    outbox = make_outbox(storage, persistence, sender)
+    started = time.monotonic()
+    _, done = run_batch(outbox, [1, 2], retries=False)
+    assert time.monotonic() - started < 5
+    # Получатель 1 ждет повтора через retry_after, в итог рассылки пока не попал
+    assert done == {}
+    next_at = storage.next_notification_at()
+    assert next_at is not None and next_at - time.time() > 25
+
+
+def test_same_recipient_in_two_batches_is_not_a_retry(storage, persistence, monkeypatch):
+    monkeypatch.setattr(outbox_module, "metrics", Metrics())
+    sender = Sender()
+    outbox = make_outbox(storage, persistence, sender)
+
+    async def run():
+        await outbox.enqueue(1, {"embed": {}}, [(5, None)])
+        await outbox.enqueue(2, {"embed": {}}, [(5, None)])
+        await outbox.drain()
+
+    asyncio.run(run())
+    # Вторая рассылка отложена до следующей пачки, но попыткой не считается
+    assert sender.sent == [5, 5]
+    assert not outbox_module.metrics.counters["dm_retries_total"]
+    assert outbox_module.metrics.counters["dm_deliveries_total"][OUTBOX_SENT] == 2
+
+
+def test_gives_up_after_max_attempts(storage, persistence):
+    sender = Sender({1: [http_error(500)] * 10})
+    _, done = run_batch(make_outbox(storage, persistence, sender, max_attempts=3), [1])
+    assert sender.sent == []
+    assert done == {OUTBOX_FAILED: 1}
+
+
+def test_closed_dms_block_recipient(storage, persistence):
+    sender = Sender({1: [http_error(403, code=CANNOT_MESSAGE_USER)]})
+    outbox = make_outbox(storage, persistence, sender)
+    _, done = run_batch(outbox, [1])
+    assert done == {OUTBOX_BLOCKED: 1}
+    # Повторная рассылка заблокированному не ставится в очередь
+    statuses, done = run_batch(outbox, [1])
+    assert statuses == {1: OUTBOX_BLOCKED}
+    assert done == {OUTBOX_BLOCKED: 1}
+
+
+def test_retry_delay_honours_retry_after(storage, persistence):
+    outbox = make_outbox(storage, persistence, Sender(), base_delay=2.0, max_delay=900.0)
+    for _ in range(100):
+        assert 30.0 <= outbox.retry_delay(1, retry_after=30.0) <= 33.0
+
+
+@pytest.mark.parametrize("attempts, low, high", [(1, 1.6, 2.4), (2, 3.2, 4.8), (4, 12.8, 19.2), (20, 720, 1080)])
+def test_retry_delay_is_exponential_and_capped(storage, persistence, attempts, low, high):
+    outbox = make_outbox(storage, persistence, Sender(), base_delay=2.0, max_delay=900.0)
+    for _ in range(100):
+        assert low <= outbox.retry_delay(attempts) <= high
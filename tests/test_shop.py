@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import pytest
+
+from scores import ScoreStore
+from shop import PURCHASE_COMPLETED, PURCHASE_FAILED, PurchaseEngine
+from storage import PURCHASE_DUPLICATE, PURCHASE_INSUFFICIENT, PURCHASE_OWNED
+
+
+@pytest.fixture
+def engine(storage, persistence):
+    storage.add_scores({"1": 1000})
+    return PurchaseEngine(storage, ScoreStore(storage), persistence, storage.load_purchases())
+
+
+async def _ok():
+    pass
+
+
+async def _fail():
+    raise RuntimeError("discord is down")
+
+
+def test_purchase_charges_once_and_records_item(engine, storage):
+    async def run():
+        return [
+            await engine.purchase("1", "role", 300, _ok),
+            await engine.purchase("1", "role", 300, _ok),
+        ]
+
+    assert asyncio.run(run()) == [PURCHASE_COMPLETED, PURCHASE_OWNED]
+    assert storage.load_scores()["1"] == 700
+    assert storage.load_purchases() == {"1": ["role"]}
+
+
+def test_concurrent_clicks_charge_once(engine, storage):
+    async def run():
+        return await asyncio.gather(*(engine.purchase("1", "role", 300, _ok) for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert results.count(PURCHASE_COMPLETED) == 1
+    assert storage.load_scores()["1"] == 700
+
+
+def test_same_key_is_not_charged_twice(engine, storage):
+    async def run():
+        return [
+            await engine.purchase("1", "a", 100, _ok, key="k"),
+            await engine.purchase("1", "b", 100, _ok, key="k"),
+        ]
+
+    assert asyncio.run(run()) == [PURCHASE_COMPLETED, PURCHASE_DUPLICATE]
+    assert storage.load_scores()["1"] == 900
+
+
+def test_failed_apply_refunds(engine, storage):
+    assert asyncio.run(engine.purchase("1", "role", 300, _fail)) == PURCHASE_FAILED
+    assert storage.load_scores()["1"] == 1000
+    assert storage.load_purchases() == {}
+
+
+def test_insufficient_score(engine, storage):
+    assert asyncio.run(engine.purchase("1", "role", 5000, _ok)) == PURCHASE_INSUFFICIENT
+    assert storage.load_scores()["1"] == 1000
+
+
+def test_recover_refunds_reservations_that_never_reached_discord(engine, storage, persistence):
+    storage.reserve_purchase("crashed", "1", "role", 300, time.time() - 3600)
+    assert storage.load_scores()["1"] == 700
+
+    assert asyncio.run(engine.recover(stale_after=600)) == 1
+    assert storage.load_scores()["1"] == 1000
+    assert storage.stale_purchases(time.time()) == []
+
+
+def test_recover_completes_reservations_interrupted_while_applying(engine, storage):
+    storage.reserve_purchase("crashed", "1", "role", 300, time.time() - 3600)
+    storage.mark_applying("crashed", time.time() - 3600)
+
+    assert asyncio.run(engine.recover(stale_after=600)) == 1
+    # Роль могла быть выдана - очки не возвращаются, покупка засчитана
+    assert storage.load_scores()["1"] == 700
+    assert storage.load_purchases() == {"1": ["role"]}
+    assert engine.has_purchased("1", "role")
+
+
+def test_recover_leaves_fresh_reservations(engine, storage):
+    storage.reserve_purchase("in-flight", "1", "role", 300, time.time())
+    assert asyncio.run(engine.recover(stale_after=600)) == 0
+    assert storage.load_scores()["1"] == 700
+
+
+def test_purchase_key_window():
+    assert PurchaseEngine.purchase_key(1, "role", 100.0) == PurchaseEngine.purchase_key(1, "role", 101.0)
+    assert PurchaseEngine.purchase_key(1, "role", 100.0) != PurchaseEngine.purchase_key(2, "role", 100.0)
@@ -0,0 +1,109 @@
+import sqlite3
+
+from conftest import make_storage
+from voicestats import unpack_block
+
+
+def test_changes_since_returns_other_processes_changes(tmp_path):
+    first = make_storage("sqlite", tmp_path)
+    second = make_storage("sqlite", tmp_path)
+    seq = second.last_change()
+
+    first.add_friends("1", ["2", "3"])
+    first.add_scores({"1": 50})
+    seq, changes = second.changes_since(seq)
+    kinds = sorted(kind for kind, _, _, _ in changes)
+    assert kinds == ["friend_add", "friend_add", "score"]
+    assert ("score", 1, None, "50") in changes
+
+    # Свои изменения не возвращаются
+    second.add_scores({"1": 1})
+    seq, changes = second.changes_since(seq)
+    assert changes == []
+    first.close()
+    second.close()
+
+
+def test_changes_since_without_writes_is_cheap(tmp_path):
+    store = make_storage("sqlite", tmp_path)
+    seq = store.last_change()
+    assert store.changes_since(seq) == (seq, [])
+    store.close()
+
+
+def test_changes_since_reports_gap(tmp_path):
+    first = make_storage("sqlite", tmp_path)
+    second = make_storage("sqlite", tmp_path)
+    seq = second.last_change()
+    first.add_scores({"1": 1})
+    first.add_scores({"2": 1})
+    first.add_scores({"3": 1})
+    # Журнал обрезан дальше, чем прочитал второй процесс - нужно перечитать все
+    with sqlite3.connect(str(tmp_path / "bot_data.db")) as conn:
+        conn.execute("DELETE FROM changes WHERE seq <= ?", (seq + 1,))
+    new_seq, changes = second.changes_since(seq)
+    assert changes is None
+    assert new_seq == first.last_change()
+    first.close()
+    second.close()
+
+
+def test_friend_lists_keep_order(storage):
+    storage.add_friends("1", ["3", "2"])
+    storage.add_friend("1", "4")
+    storage.remove_friend("1", "2")
+    assert storage.load_friends() == {"1": ["3", "4"]}
+    storage.remove_user("3")
+    assert storage.load_friends()["1"] == ["4"]
+
+
+def test_scores_do_not_go_negative(storage):
+    assert storage.add_scores({"1": 10}) == {"1": 10}
+    assert storage.add_scores({"1": -50}) == {"1": 0}
+
+
+def test_voice_checkpoint_keeps_carry_and_leftovers(storage):
+    session = {"guild_id": 10, "channel_id": 100, "started_at": 5.0, "carry": 30.0}
+    storage.save_voice_sessions({"1": session}, 6.0, {"2": [10.0, 6.0, 10]})
+    sessions, checkpoint_at, leftovers = storage.load_voice_sessions()
+    assert sessions == {"1": session}
+    assert checkpoint_at == 6.0
+    assert leftovers == {"2": [10.0, 6.0, 10]}
+
+
+def test_voice_checkpoint_is_per_scope(tmp_path):
+    first = make_storage("sqlite", tmp_path, scope="0,1")
+    second = make_storage("sqlite", tmp_path, scope="2,3")
+    session = {"guild_id": 10, "channel_id": 100, "started_at": 5.0, "carry": 30.0}
+    first.save_voice_sessions({"1": session}, 6.0, {"2": [10.0, 6.0, 10]})
+    second.save_voice_sessions({"1": {**session, "channel_id": 200}}, 7.0)
+
+    sessions, checkpoint_at, leftovers = first.load_voice_sessions()
+    assert sessions["1"]["channel_id"] == 100
+    assert sessions["1"]["carry"] == 30.0
+    assert checkpoint_at == 6.0
+    assert leftovers == {"2": [10.0, 6.0, 10]}
+    assert second.load_voice_sessions()[0]["1"]["channel_id"] == 200
+    first.close()
+    second.close()
+
+
+def test_old_voice_sessions_table_is_upgraded(tmp_path):
+    with sqlite3.connect(str(tmp_path / "bot_data.db")) as conn:
+        conn.execute(
+            "CREATE TABLE voice_sessions (user_id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL, "
+            "channel_id INTEGER NOT NULL, started_at REAL NOT NULL)"
+        )
+        conn.execute("INSERT INTO voice_sessions VALUES (1, 10, 100, 5.0)")
+    store = make_storage("sqlite", tmp_path)
+    sessions, _, _ = store.load_voice_sessions()
+    assert sessions == {"1": {"guild_id": 10, "channel_id": 100, "started_at": 5.0}}
+    store.close()
+
+
+def test_voice_stats_merge_increments(storage):
+    storage.add_voice_minutes({("u:1", 0): {5: 10}})
+    storage.add_voice_minutes({("u:1", 0): {5: 7, 6: 1}})
+    rows = {(series, block): data for series, block, data in storage.load_voice_stats()}
+    values = unpack_block("u:1", rows[("u:1", 0)])
+    assert values[5] == 17 and values[6] == 1
@@ -0,0 +1,48 @@
+from throttle import CallThrottle, TokenBucket
+
+
+def test_bucket_allows_burst_then_waits():
+    bucket = TokenBucket(3, 600, now=0)
+    assert [bucket.consume(0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.consume(0) == 200
+
+
+def test_bucket_refills_over_time_up_to_capacity():
+    bucket = TokenBucket(3, 600, now=0)
+    for _ in range(3):
+        bucket.consume(0)
+    assert bucket.consume(200) == 0
+    assert bucket.consume(200) == 200
+    assert bucket.is_full(10_000)
+    assert bucket.tokens == 3
+
+
+def test_check_does_not_spend_token():
+    throttle = CallThrottle(capacity=1, per=60)
+    assert throttle.check(1, now=0) == 0
+    assert throttle.check(1, now=0) == 0
+    assert throttle.acquire(1, now=0) == 0
+    assert throttle.check(1, now=0) == 60
+    assert throttle.acquire(1, now=30) == 30
+    assert throttle.check(1, now=60) == 0
+
+
+def test_buckets_are_per_user():
+    throttle = CallThrottle(capacity=1, per=60)
+    assert throttle.acquire(1, now=0) == 0
+    assert throttle.acquire(2, now=0) == 0
+
+
+def test_recent_call_within_window():
+    throttle = CallThrottle(window=120)
+    record = throttle.start(1, now=0)
+    assert throttle.recent(1, now=100) is record
+    assert throttle.recent(1, now=121) is None
+
+
+def test_prune_drops_full_buckets_and_closed_windows():
+    throttle = CallThrottle(capacity=2, per=60, window=10)
+    throttle.acquire(1, now=0)
+    throttle.start(1, now=0)
+    throttle.prune(now=1000)
+    assert throttle.stats() == {"limited_users": 0, "open_windows": 0}
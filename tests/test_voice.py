@@ -0,0 +1,110 @@
+import pytest
+
+from voice import CARRY_TTL, SECONDS_PER_POINT, VoiceLedger
+
+
+def test_tick_credits_whole_minutes_and_carries_the_rest():
+    ledger = VoiceLedger()
+    ledger.start("1", 10, 100, now=0)
+    assert ledger.tick(now=90) == {"1": 1}
+    # 30 секунд остались в переносе и дополняются следующим тактом
+    assert ledger.tick(now=120) == {"1": 1}
+    assert ledger.tick(now=150) == {}
+
+
+def test_tick_reports_guild_of_credited_session():
+    ledger = VoiceLedger()
+    ledger.start("1", 10, 100, now=0)
+    guilds = {}
+    ledger.tick(now=SECONDS_PER_POINT, guilds=guilds)
+    assert guilds == {"1": 10}
+
+
+def test_carry_survives_leaving_and_rejoining():
+    ledger = VoiceLedger()
+    ledger.start("1", 10, 100, now=0)
+    assert ledger.stop("1", now=40) == 40
+    assert ledger.tick(now=41) == {}
+    ledger.start("1", 10, 100, now=100)
+    assert ledger.tick(now=120) == {"1": 1}
+
+
+def test_leftover_expires_after_ttl():
+    ledger = VoiceLedger()
+    ledger.start("1", 10, 100, now=0)
+    ledger.stop("1", now=40)
+    ledger.tick(now=40 + CARRY_TTL + 1)
+    ledger.start("1", 10, 100, now=CARRY_TTL + 100)
+    assert ledger.tick(now=CARRY_TTL + 130) == {}
+
+
+def test_move_keeps_session_and_accrual():
+    ledger = VoiceLedger()
+    ledger.start("1", 10, 100, now=0)
+    ledger.move("1", 10, 200, now=30)
+    assert ledger.tick(now=60) == {"1": 1}
+    assert ledger.sessions["1"].channel_id == 200
+
+
+@pytest.mark.parametrize("rule, state", [("afk", {"afk": True}), ("self_mute", {"self_mute": True}),
+                                         ("self_deaf", {"self_deaf": True}), ("bots", {"bot": True})])
+def test_excluded_state_does_not_accrue(rule, state):
+    ledger = VoiceLedger(exclude=[rule])
+    ledger.start("1", 10, 100, now=0, **state)
+    assert ledger.tick(now=600) == {}
+
+
+def test_no_rules_by_default():
+    ledger = VoiceLedger()
+    ledger.start("1", 10, 100, now=0, afk=True, self_mute=True, self_deaf=True)
+    assert ledger.tick(now=60) == {"1": 1}
+
+
+def test_solo_rule_counts_only_while_someone_else_is_in_channel():
+    ledger = VoiceLedger(exclude=["solo"])
+    ledger.start("1", 10, 100, now=0)
+    ledger.start("2", 10, 100, now=60)
+    ledger.stop("2", now=120)
+    # Засчитана только общая минута с 60 до 120
+    assert ledger.tick(now=300) == {"1": 1, "2": 1}
+    assert ledger.tick(now=600) == {}
+
+
+def test_update_flags_settles_previous_state():
+    ledger = VoiceLedger(exclude=["self_mute"])
+    assert not ledger.update_flags("1", True, False, now=0)
+    ledger.start("1", 10, 100, now=0)
+    assert ledger.update_flags("1", True, False, now=60)
+    assert ledger.tick(now=600) == {"1": 1}
+
+
+def test_unknown_rule_is_rejected():
+    with pytest.raises(ValueError):
+        VoiceLedger(exclude=["nope"])
+
+
+def test_checkpoint_round_trip_keeps_carry_and_flags():
+    ledger = VoiceLedger(exclude=["self_mute"])
+    ledger.start("1", 10, 100, now=0, self_mute=False)
+    ledger.start("2", 10, 100, now=0)
+    ledger.tick(now=30)
+    ledger.update_flags("2", True, False, now=30)
+    ledger.mark_confirmed(30)
+
+    restored = VoiceLedger(exclude=["self_mute"])
+    restored.restore(ledger.snapshot(), ledger.confirmed_at, ledger.leftovers())
+    assert restored.sessions["1"].carry == 30
+    assert restored.sessions["2"].self_mute
+    assert restored.tick(now=60) == {"1": 1}
+
+
+def test_reconcile_does_not_credit_downtime():
+    ledger = VoiceLedger()
+    ledger.start("1", 10, 100, now=0)
+    ledger.start("2", 10, 100, now=0)
+    ledger.mark_confirmed(60)
+    # Бот лежал с 60 до 600: пользователь 1 все еще в войсе, 2 вышел
+    closed = ledger.reconcile([("1", 10, 100, {})], now=600)
+    assert closed == ["2"]
+    assert ledger.tick(now=600) == {"1": 1, "2": 1}
+    assert ledger.tick(now=660) == {"1": 1}
@@ -0,0 +1,57 @@
+from voicestats import BLOCK_DAYS, GUILD_SERIES, USER_SERIES, VoiceStats, merge_block, series_key, unpack_block
+
+DAY = 86400
+
+
+def test_record_sums_user_and_guild_series():
+    stats = VoiceStats()
+    stats.record({"1": 5, "2": 3}, {"1": 10, "2": 10}, now=100 * DAY)
+    stats.record({"1": 2}, {"1": 10}, now=100 * DAY + 60)
+    assert stats.days(series_key(USER_SERIES, "1"), 100, 1) == [7]
+    assert stats.total(series_key(GUILD_SERIES, 10), 100, 1) == 10
+
+
+def test_total_spans_block_boundary():
+    stats = VoiceStats()
+    user = series_key(USER_SERIES, "1")
+    stats.record({"1": 4}, {}, now=(BLOCK_DAYS - 1) * DAY)
+    stats.record({"1": 6}, {}, now=BLOCK_DAYS * DAY)
+    assert stats.total(user, BLOCK_DAYS - 1, 2) == 10
+    assert stats.days(user, BLOCK_DAYS - 2, 4) == [0, 4, 6, 0]
+
+
+def test_utc_offset_moves_day_boundary():
+    stats = VoiceStats(utc_offset=3)
+    assert stats.day(DAY - 3 * 3600) == 1
+    assert VoiceStats().day(DAY - 3 * 3600) == 0
+
+
+def test_summary():
+    stats = VoiceStats()
+    user = series_key(USER_SERIES, "1")
+    now = 1000 * DAY
+    stats.record({"1": 30}, {}, now=now - 10 * DAY)
+    stats.record({"1": 60}, {}, now=now)
+    summary = stats.summary(user, now=now)
+    assert summary["today"] == 60
+    assert summary["week"] == 60
+    assert summary["month"] == 90
+    assert summary["active_days"] == 2
+    assert summary["best_day_ago"] == 0
+
+
+def test_pending_increments_and_refresh():
+    stats = VoiceStats()
+    user = series_key(USER_SERIES, "1")
+    stats.record({"1": 5}, {}, now=0)
+    pending = stats.take_pending()
+    assert pending == {(user, 0): {0: 5}}
+    # Другой процесс уже записал в этот блок 10 минут
+    merged = {(user, 0): merge_block(user, merge_block(user, None, {0: 10}), pending[(user, 0)])}
+    stats.refresh(merged)
+    assert stats.days(user, 0, 1) == [15]
+
+
+def test_user_counter_saturates():
+    values = unpack_block("u:1", merge_block("u:1", None, {0: 70000}))
+    assert values[0] == 0xFFFF
@@ -0,0 +1,107 @@
+import time
+from typing import Dict, Optional, Tuple
+
+
+class TokenBucket:
+    """Корзина токенов: до ``capacity`` вызовов подряд, дальше по одному за ``per / capacity`` секунд"""
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: int, per: float, now: float):
+        self.capacity = capacity
+        self.rate = capacity / per  # токенов в секунду
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now: float) -> float:
+        """Сколько секунд ждать токена (0 - есть), ничего не забирая"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> float:
+        """Забрать токен. Возвращает 0 или сколько секунд ждать следующего токена"""
+        wait = self.wait(now)
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class CallRecord:
+    """Последняя рассылка пользователя: когда и какие сообщения отправлены"""
+    __slots__ = ("sent_at", "messages")
+
+    def __init__(self, sent_at: float):
+        self.sent_at = sent_at
+        # ID получателя -> (ID канала личных сообщений, ID сообщения)
+        self.messages: Dict[int, Tuple[int, int]] = {}
+
+
+class CallThrottle:
+    """Ограничение частоты /callvoice и объединение повторных вызовов.
+
+    У каждого пользователя своя корзина токенов: check() только проверяет
+    ее, а токен забирает acquire(), когда рассылка действительно поставлена в
+    очередь (пустой список друзей не тратит вызов). Повторный вызов в течение
+    ``window`` секунд после рассылки не отправляет новые сообщения, а
+    обновляет уже отправленные (их ID запоминаются по получателям).
+    """
+
+    # Сколько пользователей хранить, прежде чем чистить устаревшие записи
+    PRUNE_THRESHOLD = 1000
+
+    def __init__(self, capacity: int = 3, per: float = 600.0, window: float = 120.0):
+        self.capacity = capacity
+        self.per = per
+        self.window = window
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._calls: Dict[int, CallRecord] = {}
+
+    def check(self, user_id: int, now: Optional[float] = None) -> float:
+        """Можно ли вызвать сейчас: 0 или время до следующей попытки (сек), без списания"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(user_id)
+        return 0.0 if bucket is None else bucket.wait(now)
+
+    def acquire(self, user_id: int, now: Optional[float] = None) -> float:
+        """Списать вызов. Возвращает 0 или время до следующей попытки (сек)"""
+        now = time.monotonic() if now is None else now
+        if len(self._buckets) > self.PRUNE_THRESHOLD:
+            self.prune(now)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.capacity, self.per, now)
+        return bucket.consume(now)
+
+    def recent(self, user_id: int, now: Optional[float] = None) -> Optional[CallRecord]:
+        """Рассылка пользователя, которую еще можно обновить вместо новой"""
+        now = time.monotonic() if now is None else now
+        record = self._calls.get(user_id)
+        if record is None or now - record.sent_at > self.window:
+            return None
+        return record
+
+    def start(self, user_id: int, now: Optional[float] = None) -> CallRecord:
+        """Начать учет новой рассылки (окно объединения отсчитывается от нее)"""
+        now = time.monotonic() if now is None else now
+        record = self._calls[user_id] = CallRecord(now)
+        return record
+
+    def prune(self, now: Optional[float] = None) -> None:
+        """Убрать полные корзины и рассылки за пределами окна"""
+        now = time.monotonic() if now is None else now
+        self._buckets = {user_id: b for user_id, b in self._buckets.items() if not b.is_full(now)}
+        self._calls = {user_id: r for user_id, r in self._calls.items() if now - r.sent_at <= self.window}
+
+    def reset(self) -> None:
+        self._buckets.clear()
+        self._calls.clear()
+
+    def stats(self) -> Dict[str, float]:
+        return {"limited_users": len(self._buckets), "open_windows": len(self._calls)}
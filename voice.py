@@ -0,0 +1,326 @@
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Секунд голосового времени на одно очко
+SECONDS_PER_POINT = 60
+
+# Правила, по которым время в войсе не засчитывается.
+# По умолчанию не включено ни одно: засчитывается все время, как и раньше
+VOICE_RULES = ("afk", "solo", "self_deaf", "self_mute", "bots")
+DEFAULT_VOICE_EXCLUDE = ()
+
+# Сколько хранить остаток неполной минуты после выхода из войса (сек)
+CARRY_TTL = 86400.0
+
+
+class VoiceSession:
+    """Открытая сессия пользователя в голосовом канале"""
+    __slots__ = (
+        "user_id", "guild_id", "channel_id", "started_at", "accrued_at", "carry",
+        "bot", "afk", "self_mute", "self_deaf",
+    )
+
+    def __init__(self, user_id: str, guild_id: int, channel_id: int, started_at: float):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.started_at = started_at
+        # Время до этого момента уже учтено (в carry или в очках)
+        self.accrued_at = started_at
+        # Засчитанные, но еще не превращенные в очки секунды
+        self.carry = 0.0
+        self.bot = False
+        self.afk = False
+        self.self_mute = False
+        self.self_deaf = False
+
+    def to_dict(self) -> dict:
+        # В контрольной точке started_at - момент, с которого время еще не засчитано
+        # (для точек, записанных до начисления по таймеру, это и есть начало сессии)
+        return {
+            "guild_id": self.guild_id,
+            "channel_id": self.channel_id,
+            "started_at": self.accrued_at,
+            "carry": self.carry,
+            "bot": self.bot,
+            "afk": self.afk,
+            "self_mute": self.self_mute,
+            "self_deaf": self.self_deaf,
+        }
+
+
+class VoiceLedger:
+    """Журнал открытых голосовых сессий с начислением времени по таймеру.
+
+    Время хранится как unix time, чтобы сессии переживали перезапуск бота.
+    События голосовых каналов только «досчитывают» время сессии до текущего
+    момента по ее прежнему состоянию (с учетом правил из ``exclude``) и
+    меняют состояние; очки выдает tick() одним пакетом, а неполные минуты
+    переносятся дальше, в том числе между сессиями.
+
+    ``confirmed_at`` - момент, до которого состояние журнала точно
+    соответствовало реальности (последняя контрольная точка или отключение
+    от шлюза). Сессии, которые пропали, пока бот не видел событий,
+    засчитываются только до этого момента.
+    """
+
+    def __init__(self, exclude: Iterable[str] = DEFAULT_VOICE_EXCLUDE):
+        exclude = frozenset(exclude)
+        unknown = exclude - set(VOICE_RULES)
+        if unknown:
+            raise ValueError(f"Неизвестные правила начисления за войс: {', '.join(sorted(unknown))}")
+        self.exclude = exclude
+        self.sessions: Dict[str, VoiceSession] = {}
+        self.confirmed_at: Optional[float] = None
+        # ID канала -> пользователи в нем и сколько среди них не ботов (для правила solo)
+        self._channels: Dict[int, Set[str]] = {}
+        self._humans: Dict[int, int] = {}
+        # Остаток неполной минуты после выхода: ID -> (секунды, когда вышел, ID сервера)
+        self._leftover: Dict[str, Tuple[float, float, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self.sessions
+
+    def eligible(self, session: VoiceSession) -> bool:
+        """Приносит ли сессия очки в текущем состоянии"""
+        exclude = self.exclude
+        if not exclude:
+            return True
+        if session.bot and "bots" in exclude:
+            return False
+        if session.afk and "afk" in exclude:
+            return False
+        if session.self_deaf and "self_deaf" in exclude:
+            return False
+        if session.self_mute and "self_mute" in exclude:
+            return False
+        if "solo" in exclude and self._humans.get(session.channel_id, 0) < 2:
+            return False
+        return True
+
+    def _settle(self, session: VoiceSession, now: float) -> None:
+        """Досчитать время сессии до now по ее текущему состоянию"""
+        elapsed = now - session.accrued_at
+        if elapsed <= 0:
+            return
+        if self.eligible(session):
+            session.carry += elapsed
+        session.accrued_at = now
+
+    def _settle_channel(self, session: VoiceSession, channel_id: int, joining: bool, now: float) -> None:
+        """Досчитать соседей по каналу, если вход/выход session меняет для них правило solo"""
+        if session.bot or "solo" not in self.exclude:
+            return
+        # Правило меняется только при переходе между 1 и 2 участниками (не ботами)
+        if self._humans.get(channel_id, 0) != (1 if joining else 2):
+            return
+        for user_id in self._channels.get(channel_id, ()):
+            self._settle(self.sessions[user_id], now)
+
+    def _join_channel(self, session: VoiceSession) -> None:
+        self._channels.setdefault(session.channel_id, set()).add(session.user_id)
+        if not session.bot:
+            self._humans[session.channel_id] = self._humans.get(session.channel_id, 0) + 1
+
+    def _leave_channel(self, session: VoiceSession) -> None:
+        members = self._channels.get(session.channel_id)
+        if members is not None:
+            members.discard(session.user_id)
+            if not members:
+                del self._channels[session.channel_id]
+        if not session.bot:
+            humans = self._humans.get(session.channel_id, 0) - 1
+            if humans > 0:
+                self._humans[session.channel_id] = humans
+            else:
+                self._humans.pop(session.channel_id, None)
+
+    def start(self, user_id, guild_id: int, channel_id: int, now: Optional[float] = None, *,
+              bot: bool = False, afk: bool = False, self_mute: bool = False, self_deaf: bool = False) -> VoiceSession:
+        """Открыть сессию (если уже открыта - перевести в канал и обновить состояние)"""
+        user_id = str(user_id)
+        now = time.time() if now is None else now
+        session = self.sessions.get(user_id)
+        if session is not None:
+            return self.move(user_id, guild_id, channel_id, now, afk=afk, self_mute=self_mute, self_deaf=self_deaf)
+        session = self.sessions[user_id] = VoiceSession(user_id, guild_id, channel_id, now)
+        session.bot = bot
+        session.afk = afk
+        session.self_mute = self_mute
+        session.self_deaf = self_deaf
+        leftover = self._leftover.pop(user_id, None)
+        if leftover is not None:
+            session.carry = leftover[0]
+        self._settle_channel(session, channel_id, True, now)
+        self._join_channel(session)
+        return session
+
+    def move(self, user_id, guild_id: int, channel_id: int, now: Optional[float] = None, *,
+             afk: bool = False, self_mute: Optional[bool] = None, self_deaf: Optional[bool] = None) -> VoiceSession:
+        """Переход в другой канал не прерывает сессию"""
+        user_id = str(user_id)
+        session = self.sessions.get(user_id)
+        if session is None:
+            return self.start(user_id, guild_id, channel_id, now, afk=afk,
+                              self_mute=bool(self_mute), self_deaf=bool(self_deaf))
+        now = time.time() if now is None else now
+        if session.channel_id != channel_id:
+            self._settle(session, now)
+            self._settle_channel(session, session.channel_id, False, now)
+            self._settle_channel(session, channel_id, True, now)
+            self._leave_channel(session)
+            session.guild_id = guild_id
+            session.channel_id = channel_id
+            self._join_channel(session)
+        else:
+            self._settle(session, now)
+        session.afk = afk
+        if self_mute is not None:
+            session.self_mute = self_mute
+        if self_deaf is not None:
+            session.self_deaf = self_deaf
+        return session
+
+    def update_flags(self, user_id, self_mute: bool, self_deaf: bool, now: Optional[float] = None) -> bool:
+        """Быстрый путь для включения/выключения микрофона и звука: только эта сессия, без записи.
+
+        Возвращает False, если открытой сессии нет (ее нужно открыть через start()).
+        """
+        session = self.sessions.get(str(user_id))
+        if session is None:
+            return False
+        if session.self_mute != self_mute or session.self_deaf != self_deaf:
+            self._settle(session, time.time() if now is None else now)
+            session.self_mute = self_mute
+            session.self_deaf = self_deaf
+        return True
+
+    def _close(self, session: VoiceSession, end: float, now: float) -> float:
+        """Закрыть сессию на момент end; неполная минута остается до следующей сессии"""
+        self._settle(session, end)
+        self._settle_channel(session, session.channel_id, False, end)
+        self._leave_channel(session)
+        del self.sessions[session.user_id]
+        if session.carry > 0:
+            self._leftover[session.user_id] = (session.carry, now, session.guild_id)
+        return max(end - session.started_at, 0.0)
+
+    def stop(self, user_id, now: Optional[float] = None) -> float:
+        """Закрыть сессию и вернуть ее длительность в секундах (очки начислит tick)"""
+        session = self.sessions.get(str(user_id))
+        if session is None:
+            return 0.0
+        now = time.time() if now is None else now
+        return self._close(session, now, now)
+
+    def tick(self, now: Optional[float] = None, guilds: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+        """Досчитать все сессии и превратить накопленное время в очки.
+
+        Возвращает ID пользователя -> очки за этот такт (только ненулевые);
+        дробные остатки переносятся на следующий такт. Если передан guilds,
+        в него записывается сервер, за время на котором начислены очки.
+        """
+        now = time.time() if now is None else now
+        credits: Dict[str, int] = {}
+        for session in self.sessions.values():
+            self._settle(session, now)
+            if session.carry >= SECONDS_PER_POINT:
+                points = int(session.carry // SECONDS_PER_POINT)
+                session.carry -= points * SECONDS_PER_POINT
+                credits[session.user_id] = points
+                if guilds is not None:
+                    guilds[session.user_id] = session.guild_id
+        expired = []
+        for user_id, (carry, left_at, guild_id) in self._leftover.items():
+            if carry >= SECONDS_PER_POINT:
+                points = int(carry // SECONDS_PER_POINT)
+                credits[user_id] = credits.get(user_id, 0) + points
+                if guilds is not None:
+                    guilds.setdefault(user_id, guild_id)
+                carry -= points * SECONDS_PER_POINT
+                self._leftover[user_id] = (carry, left_at, guild_id)
+            if carry <= 0 or now - left_at > CARRY_TTL:
+                expired.append(user_id)
+        for user_id in expired:
+            del self._leftover[user_id]
+        return credits
+
+    def mark_confirmed(self, now: Optional[float] = None) -> None:
+        self.confirmed_at = time.time() if now is None else now
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Состояние для контрольной точки"""
+        return {user_id: session.to_dict() for user_id, session in self.sessions.items()}
+
+    def leftovers(self) -> Dict[str, list]:
+        """Остатки неполных минут для контрольной точки: ID -> [секунды, когда вышел, ID сервера]"""
+        return {user_id: list(leftover) for user_id, leftover in self._leftover.items()}
+
+    def restore(self, saved: Dict[str, dict], checkpoint_at: Optional[float],
+                leftovers: Optional[Dict[str, list]] = None) -> None:
+        """Загрузить сессии и остатки из контрольной точки (не затирая уже известные)"""
+        for user_id, data in saved.items():
+            if user_id not in self.sessions:
+                session = self.sessions[user_id] = VoiceSession(
+                    user_id, data["guild_id"], data["channel_id"], data["started_at"]
+                )
+                # В точках старых версий остатка и состояния нет
+                session.carry = data.get("carry", 0.0)
+                session.bot = data.get("bot", False)
+                session.afk = data.get("afk", False)
+                session.self_mute = data.get("self_mute", False)
+                session.self_deaf = data.get("self_deaf", False)
+                self._join_channel(session)
+        for user_id, (carry, left_at, guild_id) in (leftovers or {}).items():
+            if user_id not in self.sessions and user_id not in self._leftover:
+                self._leftover[user_id] = (carry, left_at, guild_id)
+        if checkpoint_at is not None and (self.confirmed_at is None or checkpoint_at > self.confirmed_at):
+            self.confirmed_at = checkpoint_at
+
+    def reconcile(self, voice_members: Iterable[Tuple[str, int, int, dict]], now: Optional[float] = None) -> List[str]:
+        """Сверить журнал с фактическими участниками голосовых каналов.
+
+        ``voice_members`` - четверки (ID пользователя, ID сервера, ID канала,
+        состояние для start()), собранные за один проход по
+        ``guild.voice_channels``. Что происходило между ``confirmed_at`` и
+        текущим моментом, неизвестно, поэтому все сессии засчитываются по
+        прежнему состоянию только до ``confirmed_at``, а дальше - с текущего
+        момента. Сессии тех, кто еще в войсе, продолжаются (с фактическим
+        каналом и состоянием), новые участники получают сессию с текущего
+        момента, а пропавшие закрываются. Возвращает ID закрытых сессий.
+        """
+        now = time.time() if now is None else now
+        end = self.confirmed_at if self.confirmed_at is not None else now
+        cutoff = min(end, now)
+        # Сначала досчитываем всех до cutoff, пока каналы еще в прежнем составе (правило solo)
+        for session in self.sessions.values():
+            self._settle(session, cutoff)
+        for session in self.sessions.values():
+            session.accrued_at = max(session.accrued_at, now)
+
+        present = set()
+        for user_id, guild_id, channel_id, state in voice_members:
+            user_id = str(user_id)
+            present.add(user_id)
+            session = self.sessions.get(user_id)
+            if session is None:
+                self.start(user_id, guild_id, channel_id, now, **state)
+                continue
+            # С текущего момента сессия идет по фактическому каналу и состоянию
+            bot = state.get("bot", False)
+            self.move(user_id, guild_id, channel_id, now, afk=state.get("afk", False),
+                      self_mute=state.get("self_mute", False), self_deaf=state.get("self_deaf", False))
+            if session.bot != bot:
+                self._leave_channel(session)
+                session.bot = bot
+                self._join_channel(session)
+
+        closed = [user_id for user_id in self.sessions if user_id not in present]
+        for user_id in closed:
+            self._close(self.sessions[user_id], now, now)
+
+        self.confirmed_at = now
+        return closed
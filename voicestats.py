@@ -0,0 +1,206 @@
+import sys
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Дней в одном блоке ряда: блок хранится одной записью (BLOB) и целиком лежит в памяти
+BLOCK_DAYS = 366
+
+# Ряды: минуты пользователя и суммарные минуты сервера по дням
+USER_SERIES = "u"
+GUILD_SERIES = "g"
+
+# Тип элементов: у пользователя не больше 1440 минут в сутки, у сервера - без ограничения
+_TYPECODES = {USER_SERIES: "H", GUILD_SERIES: "I"}
+_LIMITS = {"H": 0xFFFF, "I": 0xFFFFFFFF}
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+# Ключ блока: (ряд, номер блока); изменения блока: индекс дня в блоке -> минуты
+BlockKey = Tuple[str, int]
+
+
+def series_key(kind: str, object_id) -> str:
+    return f"{kind}:{object_id}"
+
+
+def block_typecode(series: str) -> str:
+    return _TYPECODES[series.split(":", 1)[0]]
+
+
+def unpack_block(series: str, data: Optional[bytes]) -> array:
+    """Блок из хранилища (little-endian); пустой или короткий дополняется нулями"""
+    values = array(block_typecode(series))
+    if data:
+        values.frombytes(data)
+        if sys.byteorder != "little":
+            values.byteswap()
+    if len(values) < BLOCK_DAYS:
+        values.extend(bytes(BLOCK_DAYS - len(values)))
+    return values
+
+
+def pack_block(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def merge_block(series: str, data: Optional[bytes], deltas: Dict[int, int]) -> bytes:
+    """Прибавить минуты к сохраненному блоку (для записи приращениями из нескольких процессов)"""
+    values = unpack_block(series, data)
+    limit = _LIMITS[values.typecode]
+    for index, minutes in deltas.items():
+        values[index] = min(values[index] + minutes, limit)
+    return pack_block(values)
+
+
+def sparkline(values: List[int]) -> str:
+    peak = max(values, default=0)
+    if peak <= 0:
+        return SPARK_CHARS[0] * len(values)
+    scale = (len(SPARK_CHARS) - 1) / peak
+    return "".join(SPARK_CHARS[round(value * scale)] for value in values)
+
+
+class VoiceStats:
+    """Минуты в голосовых каналах по дням: для каждого пользователя и сервера.
+
+    Ряд разбит на блоки по BLOCK_DAYS дней; блок - массив array из 2-байтовых
+    (пользователи) или 4-байтовых (серверы) счетчиков, так что год истории
+    пользователя занимает меньше килобайта, а сумма за любой период -
+    это sum() по срезам массива. Новые минуты копятся в ``_pending`` и
+    записываются в хранилище приращениями (take_pending/refresh), поэтому
+    несколько процессов с одной базой не затирают друг друга.
+    """
+
+    def __init__(self, utc_offset: float = 0.0):
+        # Смещение часового пояса (ч), по которому считаются границы суток
+        self.offset = utc_offset * 3600
+        self._blocks: Dict[str, Dict[int, array]] = {}
+        self._pending: Dict[BlockKey, Dict[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def day(self, now: Optional[float] = None) -> int:
+        """Номер суток с начала эпохи с учетом смещения"""
+        now = time.time() if now is None else now
+        return int((now + self.offset) // 86400)
+
+    def load(self, rows: Iterable[Tuple[str, int, bytes]]) -> None:
+        """Загрузить блоки из хранилища: (ряд, номер блока, данные)"""
+        for series, block, data in rows:
+            self._blocks.setdefault(series, {})[block] = unpack_block(series, data)
+
+    def _add(self, series: str, day: int, minutes: int) -> None:
+        block, index = divmod(day, BLOCK_DAYS)
+        blocks = self._blocks.setdefault(series, {})
+        values = blocks.get(block)
+        if values is None:
+            values = blocks[block] = unpack_block(series, None)
+        values[index] = min(values[index] + minutes, _LIMITS[values.typecode])
+        pending = self._pending.setdefault((series, block), {})
+        pending[index] = pending.get(index, 0) + minutes
+
+    def record(self, minutes: Dict[str, int], guilds: Dict[str, int], now: Optional[float] = None) -> None:
+        """Учесть минуты за такт начисления.
+
+        minutes - ID пользователя -> минуты, guilds - ID пользователя -> ID
+        сервера, где он сейчас в войсе (для суммы по серверу).
+        """
+        day = self.day(now)
+        guild_minutes: Dict[int, int] = {}
+        for user_id, value in minutes.items():
+            if value <= 0:
+                continue
+            self._add(series_key(USER_SERIES, user_id), day, value)
+            guild_id = guilds.get(user_id)
+            if guild_id is not None:
+                guild_minutes[guild_id] = guild_minutes.get(guild_id, 0) + value
+        for guild_id, value in guild_minutes.items():
+            self._add(series_key(GUILD_SERIES, guild_id), day, value)
+
+    def take_pending(self) -> Dict[BlockKey, Dict[int, int]]:
+        """Забрать накопленные приращения для записи"""
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore_pending(self, pending: Dict[BlockKey, Dict[int, int]]) -> None:
+        """Вернуть приращения после неудачной записи (в памяти они уже учтены)"""
+        for key, deltas in pending.items():
+            current = self._pending.setdefault(key, {})
+            for index, minutes in deltas.items():
+                current[index] = current.get(index, 0) + minutes
+
+    def refresh(self, merged: Dict[BlockKey, bytes]) -> None:
+        """Заменить блоки записанными в хранилище (с минутами других процессов)"""
+        for (series, block), data in merged.items():
+            values = unpack_block(series, data)
+            # Минуты, начисленные, пока шла запись, еще не в хранилище
+            limit = _LIMITS[values.typecode]
+            for index, minutes in self._pending.get((series, block), {}).items():
+                values[index] = min(values[index] + minutes, limit)
+            self._blocks.setdefault(series, {})[block] = values
+
+    def days(self, series: str, first_day: int, count: int) -> List[int]:
+        """Минуты по дням начиная с first_day"""
+        blocks = self._blocks.get(series, {})
+        result: List[int] = []
+        day = first_day
+        while len(result) < count:
+            block, index = divmod(day, BLOCK_DAYS)
+            take = min(count - len(result), BLOCK_DAYS - index)
+            values = blocks.get(block)
+            if values is None:
+                result.extend([0] * take)
+            else:
+                result.extend(values[index:index + take])
+            day += take
+        return result
+
+    def total(self, series: str, first_day: int, count: int) -> int:
+        """Сумма минут за count дней начиная с first_day"""
+        blocks = self._blocks.get(series)
+        if not blocks:
+            return 0
+        total = 0
+        day = first_day
+        end = first_day + count
+        while day < end:
+            block, index = divmod(day, BLOCK_DAYS)
+            take = min(end - day, BLOCK_DAYS - index)
+            values = blocks.get(block)
+            if values is not None:
+                total += sum(values[index:index + take])
+            day += take
+        return total
+
+    def summary(self, series: str, now: Optional[float] = None, spark_days: int = 30) -> dict:
+        """Итоги ряда на сегодня: неделя, месяц, год, лучший день и спарклайн"""
+        today = self.day(now)
+        recent = self.days(series, today - 364, 365)
+        best = max(recent)
+        return {
+            "today": recent[-1],
+            "week": sum(recent[-7:]),
+            "month": sum(recent[-30:]),
+            "year": sum(recent),
+            "active_days": 365 - recent.count(0),
+            "best_day": best,
+            "best_day_ago": 364 - recent.index(best) if best else None,
+            "spark": sparkline(recent[-spark_days:]),
+        }
+
+    def stats(self) -> Dict[str, float]:
+        blocks = sum(len(series) for series in self._blocks.values())
+        memory = sum(
+            values.itemsize * len(values) for series in self._blocks.values() for values in series.values()
+        )
+        return {
+            "series": len(self._blocks),
+            "blocks": blocks,
+            "bytes": memory,
+            "pending_blocks": len(self._pending),
+        }